@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2011,2013 Christopher D. Lasher
+#
+# This software is released under the MIT License. Please see
+# LICENSE.txt for details.
+
+
+"""Compares the memory taken by a ``TwoWaySetDict`` and a
+``BitsetTwoWaySetDict`` holding the same sparse annotations, and the
+time of their reverse lookups.
+
+Requires Python 3.4 or newer, for ``tracemalloc``.
+
+Usage: python benchmarks/bitset_memory_benchmark.py [NUM_KEYS
+    [NUM_ITEMS [SET_SIZE]]]
+
+"""
+
+from __future__ import print_function
+
+import random
+import sys
+import timeit
+import tracemalloc
+
+from convutils import structs
+
+
+def make_annotations(num_keys, num_items, set_size):
+    items = ['term{0}'.format(i) for i in range(num_items)]
+    return [('gene{0}'.format(i), set(random.sample(items, set_size)))
+            for i in range(num_keys)]
+
+
+def measure(cls, annotations):
+    tracemalloc.start()
+    try:
+        # Copy the sets while tracing, since a TwoWaySetDict keeps the
+        # sets it is given.
+        d = cls((key, set(value)) for (key, value) in annotations)
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    items = list(d.reverse_keys())[:1000]
+    lookup_time = min(timeit.Timer(
+            lambda: [d.get_item_keys(item) for item in items]
+    ).repeat(3, 1))
+    return size, lookup_time
+
+
+def main(argv):
+    num_keys = int(argv[1]) if len(argv) > 1 else 50000
+    num_items = int(argv[2]) if len(argv) > 2 else 20000
+    set_size = int(argv[3]) if len(argv) > 3 else 20
+    random.seed(0)
+    annotations = make_annotations(num_keys, num_items, set_size)
+    print("{0:,d} keys of {1} items out of {2:,d}".format(
+            num_keys, set_size, num_items))
+    for cls in (structs.TwoWaySetDict, structs.BitsetTwoWaySetDict):
+        size, lookup_time = measure(cls, annotations)
+        print("  {0:<20} {1:8.1f} MB  1,000 reverse lookups: "
+              "{2:6.3f} s".format(cls.__name__, size / 1e6, lookup_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2011,2013 Christopher D. Lasher
+#
+# This software is released under the MIT License. Please see
+# LICENSE.txt for details.
+
+
+"""Compares lookups of hot keys in a ``CachedSortedTupleKeysDict``
+against a plain ``SortedTupleKeysDict``.
+
+Usage: python benchmarks/key_cache_benchmark.py [KEY_LENGTH]
+
+"""
+
+from __future__ import print_function
+
+import random
+import sys
+import timeit
+
+from convutils import structs
+
+
+NUM_KEYS = 1000
+NUM_PASSES = 200
+
+
+def make_keys(key_length):
+    elements = ['gene{0}'.format(i) for i in range(100)]
+    return [tuple(random.sample(elements, key_length)) for i in
+            range(NUM_KEYS)]
+
+
+def lookup_seconds(d, keys, repeat=5):
+    def lookup():
+        for i in range(NUM_PASSES):
+            for key in keys:
+                d[key]
+    return min(timeit.Timer(lookup).repeat(repeat, 1))
+
+
+def contains_seconds(d, keys, repeat=5):
+    def contains():
+        for i in range(NUM_PASSES):
+            for key in keys:
+                key in d
+    return min(timeit.Timer(contains).repeat(repeat, 1))
+
+
+def main(argv):
+    key_length = int(argv[1]) if len(argv) > 1 else 2
+    random.seed(0)
+    keys = make_keys(key_length)
+    items = [(key, i) for (i, key) in enumerate(keys)]
+    plain = structs.SortedTupleKeysDict(items)
+    cached = structs.CachedSortedTupleKeysDict(items)
+    print("{0:,d} passes over {1:,d} hot {2}-tuple keys".format(
+            NUM_PASSES, NUM_KEYS, key_length))
+    for name, measure in (('d[key]', lookup_seconds),
+                          ('key in d', contains_seconds)):
+        plain_time = measure(plain, keys)
+        cached_time = measure(cached, keys)
+        print("  {0:<9} plain: {1:6.3f} s  cached: {2:6.3f} s  "
+              "speedup: {3:4.2f}x".format(name, plain_time, cached_time,
+                                         plain_time / cached_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
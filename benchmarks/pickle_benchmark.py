@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2011,2013 Christopher D. Lasher
+#
+# This software is released under the MIT License. Please see
+# LICENSE.txt for details.
+
+
+"""Compares the size and round-trip time of pickles of
+``SortedTupleKeysDict`` and ``TwoWaySetDict`` in the compact format
+against pickles of their instance dictionaries, as pickled before the
+compact format.
+
+Usage: python benchmarks/pickle_benchmark.py [NUM_KEYS]
+
+"""
+
+from __future__ import print_function
+
+import pickle
+import random
+import sys
+import timeit
+
+from convutils import structs
+
+
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+
+def make_sorted_tuple_keys_dict(num_keys, num_elements):
+    elements = ['gene{0}'.format(i) for i in range(num_elements)]
+    return structs.SortedTupleKeysDict(
+            (tuple(random.sample(elements, 2)), random.random()) for i in
+            range(num_keys)
+    )
+
+
+def make_two_way_set_dict(num_keys, num_items, set_size):
+    items = ['term{0}'.format(i) for i in range(num_items)]
+    return structs.TwoWaySetDict(
+            ('gene{0}'.format(i), set(random.sample(items, set_size)))
+            for i in range(num_keys)
+    )
+
+
+def round_trip_seconds(obj, then=None, repeat=5):
+    def round_trip():
+        unpickled = pickle.loads(pickle.dumps(obj, PROTOCOL))
+        if then is not None:
+            then(unpickled)
+    timer = timeit.Timer(round_trip)
+    return min(timer.repeat(repeat, 1))
+
+
+def report(name, obj, old_state, then=None, then_name=None):
+    new_size = len(pickle.dumps(obj, PROTOCOL))
+    old_size = len(pickle.dumps(old_state, PROTOCOL))
+    new_time = round_trip_seconds(obj)
+    old_time = round_trip_seconds(old_state)
+    print(name)
+    print("  instance dictionary: {0:>12,d} bytes  {1:8.3f} s".format(
+            old_size, old_time))
+    print("  compact:             {0:>12,d} bytes  {1:8.3f} s".format(
+            new_size, new_time))
+    if then is not None:
+        print("  compact, {0:<11} {1:>12}        {2:8.3f} s".format(
+                then_name + ':', '', round_trip_seconds(obj, then)))
+    print("  size ratio:          {0:12.2f}".format(
+            float(new_size) / old_size))
+
+
+def main(argv):
+    num_keys = int(argv[1]) if len(argv) > 1 else 100000
+    random.seed(0)
+
+    d = make_sorted_tuple_keys_dict(num_keys, num_keys // 10)
+    report("SortedTupleKeysDict, {0:,d} keys".format(num_keys), d,
+           {'_store': d._store})
+
+    d = make_two_way_set_dict(num_keys, num_keys // 10, 10)
+    # The reverse dictionary of an unpickled TwoWaySetDict is built on
+    # the first reverse lookup, so time one as well.
+    report("TwoWaySetDict, {0:,d} keys of 10 items".format(num_keys), d,
+           {'_store': d._store, '_reverse_store': d._reverse_store},
+           lambda unpickled: unpickled.has_item('term0'), 'then lookup')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
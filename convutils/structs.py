@@ -11,13 +11,698 @@
 
 from __future__ import absolute_import
 
+from array import array
+import binascii
 import bisect
-from collections import defaultdict, MutableMapping
+from collections import (defaultdict, deque, namedtuple, Counter,
+                         Mapping, MutableMapping, MutableSet, Set)
+import functools
+import heapq
+import io
+import itertools
+import math
+import mmap
+import operator
+import os
+import pickle
 import random
+import sqlite3
+import struct
+import sys
+import threading
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    resource_tracker = shared_memory = None
 
 from convutils.utils import cumsum
 
 
+# Marks an omitted optional argument where ``None`` is a valid value.
+_MISSING = object()
+
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+FilterInfo = namedtuple(
+        'FilterInfo',
+        'capacity error_rate fill_ratio negatives false_positives '
+        'false_positive_rate'
+)
+
+
+class _ClockCache(object):
+    """A bounded mapping which evicts entries using the CLOCK
+    (second-chance) algorithm.
+
+    Each entry is a ``[value, uses, slot]`` list in :attr:`_table`. A
+    hit only increments the entry's count of uses, which serves as its
+    reference bit, so a hit may be made inline by a caller holding the
+    table. On eviction, a hand sweeps around the ring of slots, sparing
+    entries used since the hand last passed them, and moving their uses
+    into the count of hits.
+
+    """
+
+    def __init__(self, maxsize):
+        """
+        :param maxsize: the maximum number of entries to hold
+
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be a positive integer")
+        self.maxsize = maxsize
+        self.misses = 0
+        self._hits = 0
+        self._table = {}
+        self._slot_keys = []
+        self._free_slots = []
+        self._hand = 0
+
+
+    @property
+    def hits(self):
+        """The number of hits, including those of current entries."""
+        return self._hits + sum(entry[1] for entry in
+                                self._table.itervalues())
+
+
+    def __len__(self):
+        return len(self._table)
+
+
+    def __contains__(self, key):
+        return key in self._table
+
+
+    def get(self, key, default=None):
+        """Returns the value for the key, recording a hit or a miss.
+
+        """
+        entry = self._table.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        entry[1] += 1
+        return entry[0]
+
+
+    def peek(self, key, default=None):
+        """Returns the value for the key without recording a hit or a
+        miss, and without marking the entry as used.
+
+        """
+        entry = self._table.get(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+
+    def __setitem__(self, key, value):
+        entry = self._table.get(key)
+        if entry is not None:
+            entry[0] = value
+            return
+        if self._free_slots:
+            slot = self._free_slots.pop()
+            self._slot_keys[slot] = key
+        elif len(self._slot_keys) < self.maxsize:
+            slot = len(self._slot_keys)
+            self._slot_keys.append(key)
+        else:
+            slot = self._evict()
+            self._slot_keys[slot] = key
+        self._table[key] = [value, 0, slot]
+
+
+    def _evict(self):
+        """Evicts an entry and returns the slot it occupied."""
+        table = self._table
+        slot_keys = self._slot_keys
+        hand = self._hand
+        while True:
+            entry = table[slot_keys[hand]]
+            if not entry[1]:
+                break
+            self._hits += entry[1]
+            entry[1] = 0
+            hand = (hand + 1) % self.maxsize
+        key = slot_keys[hand]
+        del table[key]
+        self._discarded(key, entry[0])
+        self._hand = (hand + 1) % self.maxsize
+        return hand
+
+
+    def _discarded(self, key, value):
+        """Called with each entry evicted or popped from the cache."""
+        pass
+
+
+    def pop(self, key, default=None):
+        """Removes the key from the cache and returns its value, or the
+        default if the key is not cached.
+
+        """
+        entry = self._table.pop(key, None)
+        if entry is None:
+            return default
+        self._hits += entry[1]
+        slot = entry[2]
+        self._slot_keys[slot] = None
+        self._free_slots.append(slot)
+        self._discarded(key, entry[0])
+        return entry[0]
+
+
+    def clear(self):
+        """Removes all entries and resets the hit and miss counters."""
+        self._table.clear()
+        del self._slot_keys[:]
+        del self._free_slots[:]
+        self._hand = 0
+        self._hits = 0
+        self.misses = 0
+
+
+    def info(self):
+        """Returns a :class:`CacheInfo` of the cache statistics."""
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self._table))
+
+
+class _KeyCache(_ClockCache):
+    """A :class:`_ClockCache` from raw tuple keys to their sorted,
+    canonical forms.
+
+    The canonical forms are interned in a table of their own, which
+    holds each as long as some cached raw key maps to it, so that equal
+    keys share a single tuple whichever raw key was seen first.
+
+    """
+
+    def __init__(self, maxsize):
+        super(_KeyCache, self).__init__(maxsize)
+        # Maps canonical keys to [canonical key, number of raw keys].
+        self._interned = {}
+
+
+    def canonicalize(self, key):
+        """Returns the canonical form of a key not in the cache, and
+        caches it, if the key is hashable.
+
+        """
+        canonical = tuple(sorted(key))
+        try:
+            hash(key)
+        except TypeError:
+            return canonical
+        self.misses += 1
+        interned = self._interned.get(canonical)
+        if interned is None:
+            interned = self._interned[canonical] = [canonical, 0]
+        interned[1] += 1
+        self[key] = interned[0]
+        return interned[0]
+
+
+    def _discarded(self, key, value):
+        interned = self._interned[value]
+        interned[1] -= 1
+        if not interned[1]:
+            del self._interned[value]
+
+
+    def clear(self):
+        super(_KeyCache, self).clear()
+        self._interned.clear()
+
+
+class _LockContext(object):
+    """A context manager which calls one function on entry and another
+    on exit.
+
+    """
+    __slots__ = ('_acquire', '_release')
+
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+
+    def __enter__(self):
+        self._acquire()
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._release()
+
+
+class _ReadWriteLock(object):
+    """A reentrant readers-writer lock.
+
+    Any number of threads may hold the lock for reading at once, while
+    only one thread may hold it for writing, and then no other thread
+    may hold it at all. A thread may take the lock for reading or
+    writing again while it holds it, and the writing thread may also
+    take it for reading; a thread holding the lock only for reading
+    may not take it for writing, since two such threads would wait on
+    each other forever. Waiting writers keep new readers out, so that a
+    steady stream of readers cannot starve them.
+
+    The ``read_lock`` and ``write_lock`` attributes are context
+    managers for taking the lock either way.
+
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._write_depth = 0
+        self._writers_waiting = 0
+        # Each thread's stack of read holds; an entry is True for a
+        # read taken while the thread held the lock for writing.
+        self._local = threading.local()
+        self.read_lock = _LockContext(self.acquire_read, self.release_read)
+        self.write_lock = _LockContext(
+                self.acquire_write, self.release_write)
+
+
+    def _read_holds(self):
+        try:
+            return self._local.holds
+        except AttributeError:
+            holds = self._local.holds = []
+            return holds
+
+
+    def acquire_read(self):
+        holds = self._read_holds()
+        if self._writer is threading.current_thread():
+            self._write_depth += 1
+            holds.append(True)
+            return
+        if not holds:
+            with self._condition:
+                while self._writer is not None or self._writers_waiting:
+                    self._condition.wait()
+                self._readers += 1
+        holds.append(False)
+
+
+    def release_read(self):
+        holds = self._read_holds()
+        if not holds:
+            raise RuntimeError("cannot release un-acquired lock")
+        if holds.pop():
+            self.release_write()
+        elif not holds:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+
+    def acquire_write(self):
+        current_thread = threading.current_thread()
+        if self._writer is current_thread:
+            self._write_depth += 1
+            return
+        if self._read_holds():
+            raise RuntimeError(
+                    "cannot take a lock held for reading for writing")
+        with self._condition:
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = current_thread
+            self._write_depth = 1
+
+
+    def release_write(self):
+        if self._writer is not threading.current_thread():
+            raise RuntimeError("cannot release un-acquired lock")
+        self._write_depth -= 1
+        if not self._write_depth:
+            with self._condition:
+                self._writer = None
+                self._condition.notify_all()
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix_hash(obj):
+    """Returns a well-mixed 64-bit hash of the object.
+
+    Python hashes integers to themselves, so the hash is scrambled with
+    the SplitMix64 finalizer before bits are drawn from it.
+
+    """
+    h = hash(obj) & _MASK64
+    h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return h ^ (h >> 31)
+
+
+class _BloomFilter(object):
+    """A Bloom filter: a set of bits which answers whether an object
+    may have been added, with no false negatives and a bounded rate of
+    false positives.
+
+    The bit positions for an object are derived from a single hash by
+    double hashing.
+
+    """
+
+    def __init__(self, capacity, error_rate):
+        """
+        :param capacity: the number of objects for which the false
+            positive rate is to hold
+        :param error_rate: the rate of false positives at capacity,
+            between 0 and 1
+
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be a positive integer")
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        num_bits = int(math.ceil(
+                -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(
+                int(round(float(self.num_bits) / capacity * math.log(2))),
+                1
+        )
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._bits_set = 0
+
+
+    def _positions(self, obj):
+        h = _mix_hash(obj)
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in
+                xrange(self.num_hashes)]
+
+
+    def add(self, obj):
+        bits = self._bits
+        for position in self._positions(obj):
+            byte_index = position >> 3
+            mask = 1 << (position & 7)
+            if not bits[byte_index] & mask:
+                bits[byte_index] |= mask
+                self._bits_set += 1
+
+
+    def __contains__(self, obj):
+        bits = self._bits
+        for position in self._positions(obj):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+    def fill_ratio(self):
+        """Returns the fraction of bits which are set."""
+        return float(self._bits_set) / self.num_bits
+
+
+    def copy(self):
+        duplicate = _BloomFilter(self.capacity, self.error_rate)
+        duplicate._bits[:] = self._bits
+        duplicate._bits_set = self._bits_set
+        return duplicate
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("this operation requires NumPy")
+
+
+def _require_shared_memory():
+    if shared_memory is None:
+        raise ImportError("this operation requires "
+                          "multiprocessing.shared_memory (Python 3.8+)")
+
+
+def _lossless_common_dtype(columns):
+    """Returns ``True`` if the numeric arrays all convert without loss
+    to the type NumPy promotes them to together, or ``False`` if they do
+    not, or are not all numeric.
+
+    NumPy promotes, e.g., 64-bit integers mixed with floats, or signed
+    with unsigned 64-bit integers, to 64-bit floats, which cannot hold
+    every such integer exactly.
+
+    :param columns: a sequence of NumPy arrays
+
+    """
+    kinds = set(column.dtype.kind for column in columns)
+    if not kinds <= set('biuf'):
+        return False
+    if len(set(column.dtype for column in columns)) == 1:
+        return True
+    common_kind = numpy.result_type(*columns).kind
+    # Integers widen to integers, and floats to floats, exactly.
+    return common_kind in 'biu' or kinds == set('f')
+
+
+def _canonical_keys_from_arrays(columns):
+    """Sorts a batch of keys given as parallel arrays of their
+    components, and returns the sorted keys as a list of tuples.
+
+    :param columns: a sequence of one-dimensional arrays of equal
+        length; the ``i``-th key is made of the ``i``-th element of
+        each array
+
+    """
+    _require_numpy()
+    columns = [numpy.asarray(column) for column in columns]
+    if not columns:
+        raise ValueError("at least one array of key components needed")
+    for column in columns:
+        if column.ndim != 1 or len(column) != len(columns[0]):
+            raise ValueError(
+                    "key components should be one-dimensional arrays "
+                    "of equal length"
+            )
+    if len(columns) == 2 and _lossless_common_dtype(columns):
+        return zip(
+                numpy.minimum(columns[0], columns[1]).tolist(),
+                numpy.maximum(columns[0], columns[1]).tolist()
+        )
+    if len(set(column.dtype for column in columns)) > 1:
+        # Mixed types would be coerced to a common type when stacked.
+        columns = [column.astype(object) for column in columns]
+    sorted_rows = numpy.sort(numpy.column_stack(columns), axis=1)
+    return [tuple(row) for row in sorted_rows.tolist()]
+
+
+# The binary layout of a saved SortedTupleKeysDict is
+#
+#     header: magic, number of entries, number of slots, slots offset
+#     records: for each entry, the lengths of the encoded key and value,
+#         followed by the encoded key and the pickled value
+#     slots: an open-addressing hash table of (hash, record offset)
+#         pairs, probed linearly; an offset of 0 marks an empty slot
+#
+# All integers are little-endian.
+_MAPPED_DICT_MAGIC = b'CUSTKD\x00\x01'
+_MAPPED_DICT_HEADER = struct.Struct('<8sQQQ')
+_MAPPED_DICT_SLOT = struct.Struct('<QQ')
+_MAPPED_DICT_RECORD = struct.Struct('<II')
+_ELEMENT_LENGTH = struct.Struct('<I')
+_PICKLE_PROTOCOL = 2
+
+
+def _encode_key(key):
+    """Encodes a sorted key tuple as bytes.
+
+    Each element is pickled separately, so that equal keys always have
+    equal encodings, whether or not their elements are shared objects.
+
+    """
+    parts = []
+    for element in key:
+        pickled = pickle.dumps(element, _PICKLE_PROTOCOL)
+        parts.append(_ELEMENT_LENGTH.pack(len(pickled)))
+        parts.append(pickled)
+    return b''.join(parts)
+
+
+def _decode_key(data):
+    """Decodes a key encoded by :func:`_encode_key`."""
+    elements = []
+    position = 0
+    end = len(data)
+    while position < end:
+        (length,) = _ELEMENT_LENGTH.unpack_from(data, position)
+        position += _ELEMENT_LENGTH.size
+        elements.append(pickle.loads(data[position:position + length]))
+        position += length
+    return tuple(elements)
+
+
+def _hash_key_bytes(key_bytes):
+    return zlib.crc32(key_bytes) & 0xffffffff
+
+
+def _write_mapped_dict(fileh, items, num_entries):
+    """Writes pairs of sorted keys and values to a file in the layout
+    read by :class:`MappedSortedTupleKeysDict`.
+
+    :param fileh: a file handle opened for writing in binary mode
+    :param items: an iterable of pairs of sorted keys and values
+    :param num_entries: the number of pairs in ``items``
+
+    """
+    num_slots = 1
+    while num_slots < 2 * num_entries:
+        num_slots *= 2
+    slots = bytearray(num_slots * _MAPPED_DICT_SLOT.size)
+    mask = num_slots - 1
+    offset = _MAPPED_DICT_HEADER.size
+    fileh.write(b'\x00' * offset)
+    for key, value in items:
+        key_bytes = _encode_key(key)
+        value_bytes = pickle.dumps(value, _PICKLE_PROTOCOL)
+        fileh.write(_MAPPED_DICT_RECORD.pack(len(key_bytes),
+                                             len(value_bytes)))
+        fileh.write(key_bytes)
+        fileh.write(value_bytes)
+        key_hash = _hash_key_bytes(key_bytes)
+        slot = key_hash & mask
+        while _MAPPED_DICT_SLOT.unpack_from(
+                slots, slot * _MAPPED_DICT_SLOT.size)[1]:
+            slot = (slot + 1) & mask
+        _MAPPED_DICT_SLOT.pack_into(slots, slot * _MAPPED_DICT_SLOT.size,
+                                    key_hash, offset)
+        offset += (_MAPPED_DICT_RECORD.size + len(key_bytes) +
+                   len(value_bytes))
+    fileh.write(slots)
+    fileh.seek(0)
+    fileh.write(_MAPPED_DICT_HEADER.pack(_MAPPED_DICT_MAGIC, num_entries,
+                                         num_slots, offset))
+
+
+def _map_file(path):
+    """Returns a read-only memory map of an entire file."""
+    with open(path, 'rb') as fileh:
+        return mmap.mmap(fileh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _SortedList(object):
+    """A list which keeps its items in sorted order.
+
+    Items are held in a list of sorted sublists of bounded length, so
+    that adding or removing an item moves at most a sublist's worth of
+    references rather than the whole list.
+
+    """
+
+    _LOAD = 512
+
+    def __init__(self):
+        self._lists = []
+        # The last (greatest) item of each sublist.
+        self._maxes = []
+        self._len = 0
+
+
+    def __len__(self):
+        return self._len
+
+
+    def add(self, item):
+        """Inserts the item in sorted order."""
+        lists = self._lists
+        maxes = self._maxes
+        if not maxes:
+            lists.append([item])
+            maxes.append(item)
+        else:
+            i = bisect.bisect_left(maxes, item)
+            if i == len(maxes):
+                i -= 1
+                lists[i].append(item)
+                maxes[i] = item
+            else:
+                bisect.insort(lists[i], item)
+            if len(lists[i]) > 2 * self._LOAD:
+                tail = lists[i][self._LOAD:]
+                del lists[i][self._LOAD:]
+                maxes[i] = lists[i][-1]
+                lists.insert(i + 1, tail)
+                maxes.insert(i + 1, tail[-1])
+        self._len += 1
+
+
+    def remove(self, item):
+        """Removes the item, which must be present."""
+        i = bisect.bisect_left(self._maxes, item)
+        sublist = self._lists[i]
+        j = bisect.bisect_left(sublist, item)
+        if sublist[j] != item:
+            raise ValueError("item not in list")
+        del sublist[j]
+        if sublist:
+            self._maxes[i] = sublist[-1]
+        else:
+            del self._lists[i]
+            del self._maxes[i]
+        self._len -= 1
+
+
+    def clear(self):
+        del self._lists[:]
+        del self._maxes[:]
+        self._len = 0
+
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._lists)
+
+
+    def __reversed__(self):
+        for sublist in reversed(self._lists):
+            for item in reversed(sublist):
+                yield item
+
+
+    def iter_from(self, item):
+        """Iterates in order over the items not less than the given
+        item.
+
+        """
+        i = bisect.bisect_left(self._maxes, item)
+        if i == len(self._maxes):
+            return
+        sublist = self._lists[i]
+        for existing in itertools.islice(
+                sublist, bisect.bisect_left(sublist, item), None):
+            yield existing
+        for sublist in itertools.islice(self._lists, i + 1, None):
+            for existing in sublist:
+                yield existing
+
+
 class SortedTupleKeysDict(MutableMapping):
     """A dictionary that always sorts the items in its tuple keys."""
 
@@ -53,201 +738,4387 @@ class SortedTupleKeysDict(MutableMapping):
         self._store[self.__keytransform__(key)] = value
 
 
-    def __delitem__(self, key):
-        del self._store[self.__keytransform__(key)]
+    def __delitem__(self, key):
+        del self._store[self.__keytransform__(key)]
+
+
+    def __iter__(self):
+        return iter(self._store)
+
+
+    def __len__(self):
+        return len(self._store)
+
+
+    @classmethod
+    def from_arrays(cls, columns, values):
+        """Creates a new dictionary from parallel arrays of key
+        components and values.
+
+        Requires NumPy.
+
+        :param columns: a sequence of one-dimensional arrays of equal
+            length; the ``i``-th key is made of the ``i``-th element of
+            each array
+        :param values: a sequence or array of the values, one per key
+
+        """
+        new_dict = cls()
+        new_dict.set_many(columns, values)
+        return new_dict
+
+
+    def get_many(self, columns, default=None):
+        """Returns a list of the values for a batch of keys, sorting
+        all the keys at once.
+
+        Requires NumPy.
+
+        :param columns: a sequence of one-dimensional arrays of equal
+            length; the ``i``-th key is made of the ``i``-th element of
+            each array
+        :param default: the value given for keys not in the dictionary
+
+        """
+        store_get = self._store.get
+        return [store_get(key, default) for key in
+                _canonical_keys_from_arrays(columns)]
+
+
+    def set_many(self, columns, values):
+        """Sets the values for a batch of keys, sorting all the keys at
+        once.
+
+        Requires NumPy.
+
+        :param columns: a sequence of one-dimensional arrays of equal
+            length; the ``i``-th key is made of the ``i``-th element of
+            each array
+        :param values: a sequence or array of the values, one per key
+
+        """
+        keys = _canonical_keys_from_arrays(columns)
+        if isinstance(values, numpy.ndarray):
+            values = values.tolist()
+        if len(keys) != len(values):
+            raise ValueError("expected one value per key")
+        self._update_canonical(zip(keys, values))
+
+
+    def _update_canonical(self, items):
+        """Stores pairs of keys and values whose keys are already
+        sorted.
+
+        """
+        self._store.update(items)
+
+
+    def _init_kwargs(self):
+        """Returns the keyword arguments, besides the items, with which
+        to create a dictionary like this one.
+
+        """
+        return {}
+
+
+    def __reduce__(self):
+        # Pickle the keys as one flat list of their elements, which the
+        # pickle memo stores once each however often they recur, and the
+        # values as a list in the same order; the keys are already
+        # sorted, so they are stored again without sorting when
+        # unpickled.
+        keys = self._store.keys()
+        key_lengths = set(itertools.imap(len, keys))
+        if len(key_lengths) == 1:
+            key_lengths = key_lengths.pop()
+        else:
+            key_lengths = _pack_ids(itertools.imap(len, keys))
+        return (
+            _rebuild_sorted_tuple_keys_dict,
+            (self.__class__, self._init_kwargs(),
+             list(itertools.chain.from_iterable(keys)), key_lengths,
+             self._store.values())
+        )
+
+
+    def save(self, path):
+        """Saves the dictionary to a compact binary file, which may be
+        memory-mapped with :meth:`open`.
+
+        Keys and values must be picklable.
+
+        :param path: the path of the file to write
+
+        """
+        with open(path, 'wb') as fileh:
+            self._write(fileh)
+
+
+    def _write(self, fileh):
+        _write_mapped_dict(fileh, self._store.iteritems(), len(self._store))
+
+
+    @staticmethod
+    def open(path, mode='r'):
+        """Memory-maps a file written by :meth:`save`.
+
+        Returns a read-only :class:`MappedSortedTupleKeysDict`, which
+        reads entries from the file as they are looked up, so that
+        processes mapping the same file share its pages.
+
+        :param path: the path of the file
+        :param mode: the access mode; only ``'r'`` (read-only) is
+            supported
+
+        """
+        if mode != 'r':
+            raise ValueError("unsupported mode {0!r}".format(mode))
+        return MappedSortedTupleKeysDict(_map_file(path))
+
+
+class MappedSortedTupleKeysDict(Mapping):
+    """A read-only :class:`SortedTupleKeysDict` served from a buffer in
+    the layout written by :meth:`SortedTupleKeysDict.save`, such as a
+    memory-mapped file.
+
+    Entries are located through a hash table stored in the buffer, and
+    only the values looked up are unpickled, so opening even a very
+    large dictionary takes constant time.
+
+    Keys are matched by their pickled elements, so a key must be given
+    with elements of the same types as when it was saved (e.g., ``1``
+    does not match a saved ``1.0``).
+
+    """
+
+    def __init__(self, buffer):
+        """
+        :param buffer: a bytes-like object, such as a :class:`mmap.mmap`
+            of a file written by :meth:`SortedTupleKeysDict.save`
+
+        """
+        magic, num_entries, num_slots, slots_offset = (
+                _MAPPED_DICT_HEADER.unpack_from(buffer, 0))
+        if magic != _MAPPED_DICT_MAGIC:
+            raise ValueError("buffer is not a saved SortedTupleKeysDict")
+        self._buffer = buffer
+        self._len = num_entries
+        self._mask = num_slots - 1
+        self._slots_offset = slots_offset
+        self._shared_memory = None
+
+
+    def __keytransform__(self, key):
+        return tuple(sorted(key))
+
+
+    def _find_value(self, key):
+        """Returns the offset and length of the pickled value for the
+        key, or ``None`` if the key is not present.
+
+        """
+        try:
+            key_bytes = _encode_key(self.__keytransform__(key))
+        except TypeError:
+            return None
+        key_hash = _hash_key_bytes(key_bytes)
+        buffer = self._buffer
+        slot = key_hash & self._mask
+        while True:
+            slot_hash, offset = _MAPPED_DICT_SLOT.unpack_from(
+                    buffer,
+                    self._slots_offset + slot * _MAPPED_DICT_SLOT.size
+            )
+            if not offset:
+                return None
+            if slot_hash == key_hash:
+                key_length, value_length = (
+                        _MAPPED_DICT_RECORD.unpack_from(buffer, offset))
+                key_start = offset + _MAPPED_DICT_RECORD.size
+                value_start = key_start + key_length
+                if buffer[key_start:value_start] == key_bytes:
+                    return value_start, value_length
+            slot = (slot + 1) & self._mask
+
+
+    def __contains__(self, key):
+        return self._find_value(key) is not None
+
+
+    def __getitem__(self, key):
+        location = self._find_value(key)
+        if location is None:
+            raise KeyError(key)
+        value_start, value_length = location
+        return pickle.loads(
+                self._buffer[value_start:value_start + value_length])
+
+
+    def __iter__(self):
+        buffer = self._buffer
+        offset = _MAPPED_DICT_HEADER.size
+        for i in xrange(self._len):
+            key_length, value_length = _MAPPED_DICT_RECORD.unpack_from(
+                    buffer, offset)
+            key_start = offset + _MAPPED_DICT_RECORD.size
+            offset = key_start + key_length + value_length
+            yield _decode_key(buffer[key_start:key_start + key_length])
+
+
+    def __len__(self):
+        return self._len
+
+
+    def close(self):
+        """Releases the underlying buffer, closing it if it is a memory
+        map, and detaches any shared memory it is in.
+
+        """
+        if hasattr(self._buffer, 'close'):
+            self._buffer.close()
+        self._buffer = None
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+            self._shared_memory = None
+
+
+class CachedSortedTupleKeysDict(SortedTupleKeysDict):
+    """A :class:`SortedTupleKeysDict` which memoizes the sorting of its
+    keys.
+
+    Raw keys are mapped to their sorted, canonical form through a
+    bounded cache, so frequently used keys skip the sort and the
+    allocation of a new tuple. Canonical tuples are also interned, so
+    that equal keys share a single tuple.
+
+    Unhashable keys (e.g., lists) are sorted on every access, as with
+    :class:`SortedTupleKeysDict`.
+
+    """
+
+    def __init__(self, items=None, cache_size=65536, **kwargs):
+        """
+        :param items: an iterable of pairs of keys and values; keys
+            should be tuples
+        :param cache_size: the maximum number of raw keys for which to
+            remember the canonical form
+
+        """
+        self._key_cache = _KeyCache(cache_size)
+        # Hits are made inline, with the cache's table at hand.
+        self._key_table = self._key_cache._table
+        super(CachedSortedTupleKeysDict, self).__init__(items, **kwargs)
+
+
+    def _init_kwargs(self):
+        return {'cache_size': self._key_cache.maxsize}
+
+
+    # On a hit, each of these takes a single lookup in the cache's table
+    # and counts the use in the entry, rather than calling any method;
+    # on a miss, or for an unhashable key, the key is sorted.
+    def __keytransform__(self, key):
+        try:
+            entry = self._key_table[key]
+        except (KeyError, TypeError):
+            return self._key_cache.canonicalize(key)
+        entry[1] += 1
+        return entry[0]
+
+
+    def __contains__(self, key):
+        try:
+            entry = self._key_table[key]
+        except (KeyError, TypeError):
+            return self._key_cache.canonicalize(key) in self._store
+        entry[1] += 1
+        return entry[0] in self._store
+
+
+    def __getitem__(self, key):
+        try:
+            entry = self._key_table[key]
+        except (KeyError, TypeError):
+            canonical = self._key_cache.canonicalize(key)
+        else:
+            entry[1] += 1
+            canonical = entry[0]
+        return self._store[canonical]
+
+
+    def __setitem__(self, key, value):
+        try:
+            entry = self._key_table[key]
+        except (KeyError, TypeError):
+            canonical = self._key_cache.canonicalize(key)
+        else:
+            entry[1] += 1
+            canonical = entry[0]
+        self._store[canonical] = value
+
+
+    def __delitem__(self, key):
+        try:
+            entry = self._key_table[key]
+        except (KeyError, TypeError):
+            canonical = self._key_cache.canonicalize(key)
+        else:
+            entry[1] += 1
+            canonical = entry[0]
+        del self._store[canonical]
+
+
+    def cache_info(self):
+        """Returns a :class:`CacheInfo` named tuple with the hits,
+        misses, maximum size, and current size of the key cache.
+
+        """
+        return self._key_cache.info()
+
+
+    def clear_cache(self):
+        """Empties the key cache and resets its statistics."""
+        self._key_cache.clear()
+
+
+class IndexedSortedTupleKeysDict(SortedTupleKeysDict):
+    """A :class:`SortedTupleKeysDict` which also indexes its keys by
+    the elements they contain.
+
+    Finding the keys which contain an element takes time proportional
+    to the number of such keys, rather than to the size of the
+    dictionary, at the cost of maintaining the index whenever a key is
+    added or deleted.
+
+    """
+
+    def __init__(self, items=None, **kwargs):
+        """
+        :param items: an iterable of pairs of keys and values; keys
+            should be tuples
+
+        """
+        super(IndexedSortedTupleKeysDict, self).__init__(items, **kwargs)
+        self._element_index = {}
+        for key in self._store:
+            self._index_key(key)
+
+
+    def _index_key(self, key):
+        for element in key:
+            try:
+                self._element_index[element].add(key)
+            except KeyError:
+                self._element_index[element] = set([key])
+
+
+    def _unindex_key(self, key):
+        for element in set(key):
+            keys = self._element_index[element]
+            keys.remove(key)
+            if not keys:
+                del self._element_index[element]
+
+
+    def __setitem__(self, key, value):
+        key = self.__keytransform__(key)
+        if key not in self._store:
+            self._index_key(key)
+        self._store[key] = value
+
+
+    def __delitem__(self, key):
+        key = self.__keytransform__(key)
+        del self._store[key]
+        self._unindex_key(key)
+
+
+    def _update_canonical(self, items):
+        store = self._store
+        for key, value in items:
+            if key not in store:
+                self._index_key(key)
+            store[key] = value
+
+
+    def clear(self):
+        self._store.clear()
+        self._element_index.clear()
+
+
+    def keys_containing(self, element):
+        """Returns a ``set`` of all keys which contain the element.
+
+        Raises a ``KeyError`` if no key contains the element.
+
+        :param element: an element of one or more keys
+
+        """
+        return set(self._element_index[element])
+
+
+    def neighbors(self, element):
+        """Returns a ``set`` of all elements which share a key with the
+        element.
+
+        An element is its own neighbor only if some key contains it
+        more than once.
+
+        Raises a ``KeyError`` if no key contains the element.
+
+        :param element: an element of one or more keys
+
+        """
+        neighbors = set()
+        for key in self._element_index[element]:
+            others = list(key)
+            others.remove(element)
+            neighbors.update(others)
+        return neighbors
+
+
+class ValueOrderedSortedTupleKeysDict(SortedTupleKeysDict):
+    """A :class:`SortedTupleKeysDict` which also keeps its entries in
+    order of their values.
+
+    The entries with the highest or lowest values, or with values in a
+    range, can be found in time proportional to the number of entries
+    returned plus a logarithmic search, rather than by sorting the
+    whole dictionary. Values must be orderable among themselves.
+
+    """
+
+    def __init__(self, items=None, **kwargs):
+        """
+        :param items: an iterable of pairs of keys and values; keys
+            should be tuples
+
+        """
+        super(ValueOrderedSortedTupleKeysDict, self).__init__(
+                items, **kwargs)
+        # Entries are ordered as (value, serial, key), where the serial
+        # number is unique, so that keys are never compared.
+        self._serial_numbers = itertools.count()
+        self._key_serials = {}
+        self._ordered_entries = _SortedList()
+        for key, value in self._store.iteritems():
+            self._add_entry(key, value)
+
+
+    def _add_entry(self, key, value):
+        serial = next(self._serial_numbers)
+        self._key_serials[key] = serial
+        self._ordered_entries.add((value, serial, key))
+
+
+    def _remove_entry(self, key):
+        serial = self._key_serials.pop(key)
+        self._ordered_entries.remove((self._store[key], serial, key))
+
+
+    def __setitem__(self, key, value):
+        key = self.__keytransform__(key)
+        if key in self._store:
+            self._remove_entry(key)
+        self._add_entry(key, value)
+        self._store[key] = value
+
+
+    def __delitem__(self, key):
+        key = self.__keytransform__(key)
+        if key not in self._store:
+            raise KeyError(key)
+        self._remove_entry(key)
+        del self._store[key]
+
+
+    def _update_canonical(self, items):
+        store = self._store
+        for key, value in items:
+            if key in store:
+                self._remove_entry(key)
+            self._add_entry(key, value)
+            store[key] = value
+
+
+    def clear(self):
+        self._store.clear()
+        self._key_serials.clear()
+        self._ordered_entries.clear()
+
+
+    def top_k(self, k):
+        """Returns a list of the pairs of keys and values with the ``k``
+        highest values, from highest to lowest.
+
+        :param k: the number of pairs to return
+
+        """
+        return [(key, value) for (value, serial, key) in
+                itertools.islice(reversed(self._ordered_entries), k)]
+
+
+    def bottom_k(self, k):
+        """Returns a list of the pairs of keys and values with the ``k``
+        lowest values, from lowest to highest.
+
+        :param k: the number of pairs to return
+
+        """
+        return [(key, value) for (value, serial, key) in
+                itertools.islice(self._ordered_entries, k)]
+
+
+    def value_range(self, low, high):
+        """Returns a list of the pairs of keys and values whose values
+        lie between ``low`` and ``high``, inclusive, from lowest to
+        highest.
+
+        :param low: the least value to include
+        :param high: the greatest value to include
+
+        """
+        pairs = []
+        for value, serial, key in self._ordered_entries.iter_from(
+                (low,)):
+            if value > high:
+                break
+            pairs.append((key, value))
+        return pairs
+
+
+class ConcurrentSortedTupleKeysDict(MutableMapping):
+    """A thread-safe :class:`SortedTupleKeysDict` for filling from
+    several threads at once.
+
+    Keys are spread by the hash of their sorted form over a number of
+    stripes, each a separate dictionary guarded by its own lock, so
+    that threads writing to different stripes do not contend. Lookups
+    take no lock.
+
+    :meth:`update_value` and :meth:`setdefault` are atomic, making them
+    safe for accumulating values (e.g., counts) from several threads.
+    Iteration and :func:`len` visit the stripes one after another, and
+    so do not give a consistent snapshot while other threads write;
+    :meth:`items` and :meth:`values` take the entries of each stripe
+    under its lock, though, so never give a key deleted after it was
+    seen.
+
+    """
+
+    def __init__(self, items=None, num_stripes=16, **kwargs):
+        """
+        :param items: an iterable of pairs of keys and values; keys
+            should be tuples
+        :param num_stripes: the number of independently locked stripes
+
+        """
+        if num_stripes < 1:
+            raise ValueError("num_stripes must be a positive integer")
+        self._stripes = [{} for i in xrange(num_stripes)]
+        self._locks = [threading.Lock() for i in xrange(num_stripes)]
+        if items is not None:
+            for key, value in items:
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+
+    def __keytransform__(self, key):
+        return tuple(sorted(key))
+
+
+    def _stripe_index(self, key):
+        return hash(key) % len(self._stripes)
+
+
+    def __contains__(self, key):
+        key = self.__keytransform__(key)
+        return key in self._stripes[self._stripe_index(key)]
+
+
+    def __getitem__(self, key):
+        key = self.__keytransform__(key)
+        return self._stripes[self._stripe_index(key)][key]
+
+
+    def __setitem__(self, key, value):
+        key = self.__keytransform__(key)
+        index = self._stripe_index(key)
+        with self._locks[index]:
+            self._stripes[index][key] = value
+
+
+    def __delitem__(self, key):
+        key = self.__keytransform__(key)
+        index = self._stripe_index(key)
+        with self._locks[index]:
+            del self._stripes[index][key]
+
+
+    def __iter__(self):
+        for stripe, lock in zip(self._stripes, self._locks):
+            with lock:
+                keys = list(stripe)
+            for key in keys:
+                yield key
+
+
+    def __len__(self):
+        return sum(len(stripe) for stripe in self._stripes)
+
+
+    def items(self):
+        items = []
+        for stripe, lock in zip(self._stripes, self._locks):
+            with lock:
+                items.extend(stripe.iteritems())
+        return items
+
+
+    def iteritems(self):
+        return iter(self.items())
+
+
+    def values(self):
+        values = []
+        for stripe, lock in zip(self._stripes, self._locks):
+            with lock:
+                values.extend(stripe.itervalues())
+        return values
+
+
+    def itervalues(self):
+        return iter(self.values())
+
+
+    def __reduce__(self):
+        return (self.__class__, (list(self.iteritems()), len(self._stripes)))
+
+
+    def clear(self):
+        for stripe, lock in zip(self._stripes, self._locks):
+            with lock:
+                stripe.clear()
+
+
+    def pop(self, key, default=_MISSING):
+        """Atomically removes the key and returns its value.
+
+        If the key is not present, returns the default if given, or
+        raises a ``KeyError`` otherwise.
+
+        """
+        key = self.__keytransform__(key)
+        index = self._stripe_index(key)
+        with self._locks[index]:
+            if default is _MISSING:
+                return self._stripes[index].pop(key)
+            return self._stripes[index].pop(key, default)
+
+
+    def setdefault(self, key, default=None):
+        """Atomically returns the value of the key, first setting it to
+        the default if the key is not present.
+
+        """
+        key = self.__keytransform__(key)
+        index = self._stripe_index(key)
+        with self._locks[index]:
+            return self._stripes[index].setdefault(key, default)
+
+
+    def update_value(self, key, func, default=_MISSING):
+        """Atomically replaces the value of the key with the result of
+        calling a function on it, and returns the new value.
+
+        For example, ``d.update_value(key, lambda n: n + 1, 0)`` counts
+        an occurrence of the key.
+
+        Raises a ``KeyError`` if the key is not present and no default
+        is given.
+
+        :param key: a key of the dictionary
+        :param func: a function taking the current value and returning
+            the new one; it runs while the key's stripe is locked, so
+            it must not access the dictionary itself
+        :param default: the value to pass to the function if the key
+            is not present
+
+        """
+        key = self.__keytransform__(key)
+        index = self._stripe_index(key)
+        stripe = self._stripes[index]
+        with self._locks[index]:
+            if default is _MISSING:
+                value = func(stripe[key])
+            else:
+                value = func(stripe.get(key, default))
+            stripe[key] = value
+        return value
+
+
+# The array type code of the combined ids of SortedPairKeysDict. Python
+# 2 has no 'Q', but its 'L' is 64 bits wide on 64-bit Unix platforms.
+try:
+    _PAIR_ID_TYPECODE = array('Q').typecode
+except ValueError:
+    _PAIR_ID_TYPECODE = 'L'
+
+
+class SortedPairKeysDict(MutableMapping):
+    """A dictionary specialized for keys which are unordered pairs,
+    which stores its entries in a compact hash table of arrays.
+
+    Behaves like a :class:`SortedTupleKeysDict` whose keys all have
+    exactly two elements. Elements are interned to integer ids, and each
+    pair is stored as a single 64-bit integer combining the ids of its
+    two elements, in an open-addressing hash table held in an
+    :class:`array.array`, with a parallel array of values of the given
+    type code. Values must therefore be numbers suited to the type code.
+    Each entry takes 8 bytes for its key plus the size of its value, in
+    a table kept between three eighths and three quarters full.
+    Lookups probe the table in Python, and so take a few times longer
+    than in a :class:`dict`. Keys are put in order by comparing their
+    two elements rather than by sorting.
+
+    Interning costs a dictionary entry and a list slot for each
+    element, once, however many pairs it appears in, so it is cheap
+    when elements recur across many pairs; where most elements appear
+    in only a pair or two, it outweighs the table. Elements which are
+    non-negative integers below ``2 ** 32 - 1`` may instead serve as
+    their own ids, with no interning at all, by passing
+    ``integer_elements=True``.
+
+    Element ids are never released, so elements stay interned after
+    every pair containing them has been deleted.
+
+    """
+
+    _ID_BITS = array(_PAIR_ID_TYPECODE).itemsize * 4
+    _ID_MASK = (1 << _ID_BITS) - 1
+    # The largest element id is never given out, so that no pair
+    # combines to this.
+    _EMPTY = (1 << (2 * _ID_BITS)) - 1
+    # Fibonacci hashing spreads the combined ids over the table.
+    _HASH_MULTIPLIER = 0x9E3779B97F4A7C15 >> (64 - 2 * _ID_BITS)
+    _MIN_CAPACITY = 8
+
+    def __init__(self, items=None, typecode='d', integer_elements=False,
+                 **kwargs):
+        """
+        :param items: an iterable of pairs of keys and values; keys
+            should be 2-tuples
+        :param typecode: the :mod:`array` type code for the values
+        :param integer_elements: whether all elements are non-negative
+            integers, to be used as their own ids rather than interned
+
+        """
+        if integer_elements:
+            self._element_ids = self._elements = None
+        else:
+            self._element_ids = {}
+            self._elements = []
+        self._typecode = typecode
+        self._allocate(self._MIN_CAPACITY)
+        if items is not None:
+            for key, value in items:
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+
+    def _allocate(self, capacity):
+        """Replaces the table with an empty one of the given capacity,
+        which must be a power of two.
+
+        """
+        self._pair_ids = array(_PAIR_ID_TYPECODE, [self._EMPTY]) * capacity
+        self._values = array(self._typecode, [0]) * capacity
+        self._mask = capacity - 1
+        self._shift = 2 * self._ID_BITS - (capacity.bit_length() - 1)
+        self._len = 0
+
+
+    def _integer_id(self, element):
+        """Returns the element as its own id.
+
+        Raises a ``ValueError`` if the element is not a non-negative
+        integer small enough to be an id.
+
+        """
+        try:
+            element_id = operator.index(element)
+        except TypeError:
+            element_id = -1
+        if not 0 <= element_id < self._ID_MASK:
+            raise ValueError(
+                    "element {0!r} is not an integer from 0 to {1}".format(
+                    element, self._ID_MASK - 1)
+            )
+        return element_id
+
+
+    def _intern(self, element):
+        """Returns the integer id of the element, assigning a new id if
+        the element has not been seen before.
+
+        """
+        if self._element_ids is None:
+            return self._integer_id(element)
+        element_id = self._element_ids.get(element)
+        if element_id is None:
+            element_id = len(self._elements)
+            if element_id >= self._ID_MASK:
+                raise OverflowError("too many distinct elements")
+            self._element_ids[element] = element_id
+            self._elements.append(element)
+        return element_id
+
+
+    def _lookup_pair_id(self, key):
+        """Returns the combined id of an existing pair of elements.
+
+        Raises a ``KeyError`` if the key is not a pair, or if either
+        element has never been seen.
+
+        """
+        element_ids = self._element_ids
+        try:
+            first, second = key
+            if element_ids is None:
+                first_id = self._integer_id(first)
+                second_id = self._integer_id(second)
+            else:
+                first_id = element_ids[first]
+                second_id = element_ids[second]
+        except (KeyError, TypeError, ValueError):
+            raise KeyError(key)
+        if first_id > second_id:
+            first_id, second_id = second_id, first_id
+        return (first_id << self._ID_BITS) | second_id
+
+
+    def _decode_pair_id(self, pair_id):
+        if self._elements is None:
+            return (pair_id >> self._ID_BITS, pair_id & self._ID_MASK)
+        first = self._elements[pair_id >> self._ID_BITS]
+        second = self._elements[pair_id & self._ID_MASK]
+        if second < first:
+            return (second, first)
+        return (first, second)
+
+
+    def _home_slot(self, pair_id):
+        return ((pair_id * self._HASH_MULTIPLIER) & self._EMPTY) >> self._shift
+
+
+    def _find_slot(self, pair_id):
+        """Returns the slot holding the combined id, or else the empty
+        slot at which its probe sequence ends.
+
+        """
+        pair_ids = self._pair_ids
+        mask = self._mask
+        empty = self._EMPTY
+        slot = ((pair_id * self._HASH_MULTIPLIER) & empty) >> self._shift
+        found = pair_ids[slot]
+        while found != pair_id and found != empty:
+            slot = (slot + 1) & mask
+            found = pair_ids[slot]
+        return slot
+
+
+    def _resize(self, capacity):
+        """Moves the entries into a new table of the given capacity."""
+        old_pair_ids = self._pair_ids
+        old_values = self._values
+        num_entries = self._len
+        self._allocate(capacity)
+        pair_ids = self._pair_ids
+        values = self._values
+        mask = self._mask
+        empty = self._EMPTY
+        home_slot = self._home_slot
+        for pair_id, value in itertools.izip(old_pair_ids, old_values):
+            if pair_id != empty:
+                slot = home_slot(pair_id)
+                while pair_ids[slot] != empty:
+                    slot = (slot + 1) & mask
+                pair_ids[slot] = pair_id
+                values[slot] = value
+        self._len = num_entries
+
+
+    def __contains__(self, key):
+        try:
+            pair_id = self._lookup_pair_id(key)
+        except KeyError:
+            return False
+        return self._pair_ids[self._find_slot(pair_id)] == pair_id
+
+
+    def __getitem__(self, key):
+        pair_id = self._lookup_pair_id(key)
+        slot = self._find_slot(pair_id)
+        if self._pair_ids[slot] != pair_id:
+            raise KeyError(key)
+        return self._values[slot]
+
+
+    def __setitem__(self, key, value):
+        try:
+            first, second = key
+        except (TypeError, ValueError):
+            raise ValueError("key {0!r} is not a pair".format(key))
+        first_id = self._intern(first)
+        second_id = self._intern(second)
+        if first_id > second_id:
+            first_id, second_id = second_id, first_id
+        pair_id = (first_id << self._ID_BITS) | second_id
+        slot = self._find_slot(pair_id)
+        if self._pair_ids[slot] != pair_id:
+            if 4 * (self._len + 1) > 3 * len(self._pair_ids):
+                self._resize(2 * len(self._pair_ids))
+                slot = self._find_slot(pair_id)
+            # Set the value first, so that a value unsuited to the type
+            # code leaves the key out.
+            self._values[slot] = value
+            self._pair_ids[slot] = pair_id
+            self._len += 1
+        else:
+            self._values[slot] = value
+
+
+    def __delitem__(self, key):
+        pair_id = self._lookup_pair_id(key)
+        pair_ids = self._pair_ids
+        values = self._values
+        hole = self._find_slot(pair_id)
+        if pair_ids[hole] != pair_id:
+            raise KeyError(key)
+        # Close the hole by moving back each later entry of the cluster
+        # whose probe sequence passes through it, rather than leaving a
+        # marker behind.
+        mask = self._mask
+        empty = self._EMPTY
+        slot = (hole + 1) & mask
+        moved_id = pair_ids[slot]
+        while moved_id != empty:
+            home = self._home_slot(moved_id)
+            if (slot - home) & mask >= (slot - hole) & mask:
+                pair_ids[hole] = moved_id
+                values[hole] = values[slot]
+                hole = slot
+            slot = (slot + 1) & mask
+            moved_id = pair_ids[slot]
+        pair_ids[hole] = empty
+        values[hole] = 0
+        self._len -= 1
+
+
+    def __iter__(self):
+        decode = self._decode_pair_id
+        empty = self._EMPTY
+        for pair_id in self._pair_ids:
+            if pair_id != empty:
+                yield decode(pair_id)
+
+
+    def __len__(self):
+        return self._len
+
+
+    def clear(self):
+        # Interned elements are kept, as after deleting every key.
+        self._allocate(self._MIN_CAPACITY)
+
+
+class DenseSortedPairKeysDict(MutableMapping):
+    """A dictionary of unordered pairs over a fixed set of elements,
+    which stores its values in a condensed upper-triangular array.
+
+    Every possible pair of elements, including an element paired with
+    itself, has a slot in an :class:`array.array` of the given type
+    code, plus one byte recording whether the slot is set. Values must
+    therefore be numbers suited to the type code. For ``n`` elements,
+    the dictionary occupies ``n * (n + 1) / 2`` slots however many
+    pairs are set, so it suits dense pairwise data; for sparse data,
+    use :class:`SortedPairKeysDict`.
+
+    """
+
+    def __init__(self, elements, items=None, typecode='d', **kwargs):
+        """
+        :param elements: an iterable of all elements which may appear
+            in the keys; elements must be orderable
+        :param items: an iterable of pairs of keys and values; keys
+            should be 2-tuples of the given elements
+        :param typecode: the :mod:`array` type code for the values
+
+        """
+        self._elements = sorted(set(elements))
+        self._element_ids = dict(
+                (element, i) for (i, element) in
+                enumerate(self._elements)
+        )
+        num_elements = len(self._elements)
+        # The slot of pair (i, j), with i <= j, is
+        # self._row_offsets[i] + j.
+        self._row_offsets = []
+        row_start = 0
+        for i in xrange(num_elements):
+            self._row_offsets.append(row_start - i)
+            row_start += num_elements - i
+        self._values = array(typecode, [0]) * row_start
+        self._is_set = bytearray(row_start)
+        self._len = 0
+        if items is not None:
+            for key, value in items:
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+
+    def _slot(self, key):
+        """Returns the index of the key's slot.
+
+        Raises a ``KeyError`` if the key is not a pair of known
+        elements.
+
+        """
+        try:
+            first, second = key
+            first_id = self._element_ids[first]
+            second_id = self._element_ids[second]
+        except (KeyError, TypeError, ValueError):
+            raise KeyError(key)
+        if first_id > second_id:
+            first_id, second_id = second_id, first_id
+        return self._row_offsets[first_id] + second_id
+
+
+    def __contains__(self, key):
+        try:
+            return bool(self._is_set[self._slot(key)])
+        except KeyError:
+            return False
+
+
+    def __getitem__(self, key):
+        slot = self._slot(key)
+        if not self._is_set[slot]:
+            raise KeyError(key)
+        return self._values[slot]
+
+
+    def __setitem__(self, key, value):
+        slot = self._slot(key)
+        self._values[slot] = value
+        if not self._is_set[slot]:
+            self._is_set[slot] = 1
+            self._len += 1
+
+
+    def __delitem__(self, key):
+        slot = self._slot(key)
+        if not self._is_set[slot]:
+            raise KeyError(key)
+        self._is_set[slot] = 0
+        self._values[slot] = 0
+        self._len -= 1
+
+
+    def __iter__(self):
+        elements = self._elements
+        is_set = self._is_set
+        num_elements = len(elements)
+        for i, offset in enumerate(self._row_offsets):
+            row_end = offset + num_elements
+            slot = is_set.find(b'\x01', offset + i, row_end)
+            while slot != -1:
+                yield (elements[i], elements[slot - offset])
+                slot = is_set.find(b'\x01', slot + 1, row_end)
+
+
+    def __len__(self):
+        return self._len
+
+
+class ValueSetProxy(MutableSet):
+    """A live view of the set belonging to a key of a
+    :class:`TwoWaySetDict`, through which the set may be changed in
+    place, as given by :meth:`TwoWaySetDict.value_proxy`.
+
+    Changes made through the view are passed on to the dictionary,
+    which updates its reverse dictionary at a cost proportional to the
+    number of items changed, rather than to the size of the set.
+
+    A view pickles, and is copied into dictionaries, as a plain
+    :class:`set`.
+
+    """
+
+    __slots__ = ('_owner', '_key')
+
+    def __init__(self, owner, key):
+        """
+        :param owner: a :class:`TwoWaySetDict`
+        :param key: a key of the dictionary
+
+        """
+        self._owner = owner
+        self._key = key
+
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        # Results of set operations are plain sets.
+        return set(iterable)
+
+
+    def _get_set(self):
+        return self._owner._store[self._key]
+
+
+    def __contains__(self, item):
+        return item in self._get_set()
+
+
+    def __iter__(self):
+        return iter(self._get_set())
+
+
+    def __len__(self):
+        return len(self._get_set())
+
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self._get_set())
+
+
+    def __reduce__(self):
+        return (set, (list(self._get_set()),))
+
+
+    def copy(self):
+        """Returns a copy of the set as a :class:`set`."""
+        return set(self._get_set())
+
+
+    def union(self, *others):
+        return self._get_set().union(*others)
+
+
+    def intersection(self, *others):
+        return self._get_set().intersection(*others)
+
+
+    def difference(self, *others):
+        return self._get_set().difference(*others)
+
+
+    def symmetric_difference(self, other):
+        return self._get_set().symmetric_difference(other)
+
+
+    def issubset(self, other):
+        return self._get_set().issubset(other)
+
+
+    def issuperset(self, other):
+        return self._get_set().issuperset(other)
+
+
+    def add(self, item):
+        if item not in self:
+            self._owner.add_item(self._key, item)
+
+
+    def discard(self, item):
+        if item in self:
+            self._owner.remove_item(self._key, item)
+
+
+    def remove(self, item):
+        self._owner.remove_item(self._key, item)
+
+
+    def clear(self):
+        self._owner.apply_delta(self._key, removed=self.copy())
+
+
+    def update(self, *others):
+        for other in others:
+            self._owner.add_items(self._key, other)
+
+
+    def difference_update(self, *others):
+        for other in others:
+            self._owner.apply_delta(self._key, removed=other)
+
+
+    def intersection_update(self, *others):
+        removed = self.copy()
+        removed.difference_update(removed.intersection(*others))
+        self._owner.apply_delta(self._key, removed=removed)
+
+
+    def symmetric_difference_update(self, other):
+        other = set(other)
+        current = self._get_set()
+        self._owner.apply_delta(
+                self._key,
+                added=other - current,
+                removed=other & current
+        )
+
+
+def _dict_of_sets(args, kwargs):
+    """Returns a dictionary built like ``dict(*args, **kwargs)``,
+    checking that every value is a ``set``.
+
+    Values which are :class:`ValueSetProxy` instances are copied to new
+    sets.
+
+    """
+    new_values = dict(*args, **kwargs)
+    for key, value in new_values.items():
+        if isinstance(value, ValueSetProxy):
+            new_values[key] = value.copy()
+        elif not isinstance(value, set):
+            raise ValueError(
+                    "Value {value} is not an instance "
+                    "of set in pair ({key}, {value})".format(
+                    key=key, value=value)
+            )
+    return new_values
+
+
+def _as_value_set(value):
+    """Returns the value as a ``set`` to store in a
+    :class:`TwoWaySetDict`, copying :class:`ValueSetProxy` instances.
+
+    Raises a ``ValueError`` if the value is not a ``set``.
+
+    """
+    if isinstance(value, ValueSetProxy):
+        return value.copy()
+    if not isinstance(value, set):
+        raise ValueError("value should be an instance of set")
+    return value
+
+
+class TwoWaySetDict(MutableMapping):
+    """A dictionary that has sets as values, and allows looking up the
+    key of any item that is in at least one set within the values.
+
+    """
+
+    def __init__(self, items=None, **kwargs):
+        """
+        :param items: an iterable of pairs of keys and values; values
+            should be :class:`set` instances
+
+        """
+        if items is None:
+            items = []
+        self._store = {}
+        self._reverse_store = {}
+        self._reverse_rows = None
+        self._dicts_shared = False
+        self._owned_keys = None
+        self._owned_items = None
+        self.update(items, **kwargs)
+
+
+    def _build_reverse_store(self):
+        """Returns a new reverse dictionary built from the main
+        dictionary in one pass.
+
+        """
+        reverse_store = {}
+        for key, value in self._store.iteritems():
+            for item in value:
+                keys = reverse_store.get(item)
+                if keys is None:
+                    reverse_store[item] = set([key])
+                else:
+                    keys.add(key)
+        return reverse_store
+
+
+    def _mark_shared(self):
+        """Marks the dictionaries, and every set in them, as shared
+        with a copy.
+
+        """
+        self._dicts_shared = True
+        self._owned_keys = set()
+        self._owned_items = set()
+
+
+    def _share_from(self, other):
+        """Makes this dictionary share the main and reverse
+        dictionaries of another until either is changed.
+
+        """
+        other._mark_shared()
+        self._store = other._store
+        self._reverse_store = other._reverse_store
+        self._mark_shared()
+
+
+    def _load_rows(self, store, rows):
+        """Replaces the contents of this empty dictionary with an
+        unpickled main dictionary, leaving the reverse dictionary to be
+        built from the pickled rows when first needed.
+
+        :param store: the main dictionary
+        :param rows: the arguments with which to build the reverse
+            dictionary by :func:`_rows_to_reverse_store`
+
+        """
+        self._store = store
+        del self._reverse_store
+        self._reverse_rows = rows
+
+
+    def __getattr__(self, name):
+        # Only reached once the reverse dictionary of an unpickled
+        # dictionary is first needed; see _load_rows().
+        rows = self.__dict__.get('_reverse_rows')
+        if name != '_reverse_store' or rows is None:
+            raise AttributeError("{0!r} object has no attribute {1!r}".format(
+                    self.__class__.__name__, name))
+        reverse_store = self.__dict__.setdefault(
+                '_reverse_store', _rows_to_reverse_store(*rows))
+        self._reverse_rows = None
+        return reverse_store
+
+
+    def _own_dicts(self):
+        """Gives this dictionary its own main and reverse dictionaries
+        if they are shared with a copy.
+
+        The sets are not copied; see :meth:`_writable_value` and
+        :meth:`_writable_item_keys`.
+
+        """
+        if self._dicts_shared:
+            self._store = dict(self._store)
+            self._reverse_store = dict(self._reverse_store)
+            self._dicts_shared = False
+
+
+    def _set_value(self, key, value):
+        """Sets the set belonging to the key.
+
+        The key is marked as owning its set unless the set is the one
+        already stored, which may still be shared with a copy.
+
+        """
+        owned = self._owned_keys
+        if owned is not None and self._store.get(key) is not value:
+            owned.add(key)
+        self._store[key] = value
+
+
+    def _set_values(self, new_values):
+        """Sets the sets belonging to several keys, like
+        :meth:`_set_value`.
+
+        :param new_values: a dictionary of keys and their new sets
+
+        """
+        owned = self._owned_keys
+        if owned is not None:
+            store = self._store
+            owned.update(key for key, value in new_values.iteritems()
+                         if store.get(key) is not value)
+        self._store.update(new_values)
+
+
+    def _writable_value(self, key):
+        """Returns the set belonging to the key, first replacing it with
+        a clone if it is shared with a copy.
+
+        Raises a ``KeyError`` if the key does not exist.
+
+        """
+        value = self._store[key]
+        owned = self._owned_keys
+        if owned is not None and key not in owned:
+            value = self._store[key] = set(value)
+            owned.add(key)
+        return value
+
+
+    def _writable_item_keys(self, item):
+        """Returns the set of keys for the item in the reverse
+        dictionary, first replacing it with a clone if it is shared with
+        a copy.
+
+        Raises a ``KeyError`` if the item is not present in any of the
+        values.
+
+        """
+        keys = self._reverse_store[item]
+        owned = self._owned_items
+        if owned is not None and item not in owned:
+            keys = self._reverse_store[item] = set(keys)
+            owned.add(item)
+        return keys
+
+
+    def _set_item_keys(self, item, keys):
+        """Sets the set of keys for the item in the reverse dictionary
+        to a set not shared with any copy.
+
+        """
+        self._reverse_store[item] = keys
+        if self._owned_items is not None:
+            self._owned_items.add(item)
+
+
+    def _add_reverse_mapping(self, key, value_item):
+        if self._owned_items is None:
+            # Never copied, so no set is shared.
+            keys = self._reverse_store.get(value_item)
+        else:
+            try:
+                keys = self._writable_item_keys(value_item)
+            except KeyError:
+                keys = None
+        if keys is None:
+            self._set_item_keys(value_item, set([key]))
+        else:
+            keys.add(key)
+
+
+    def _add_reverse_mappings(self, value_item, keys):
+        """Adds mappings from the reverse key to each of the keys."""
+        try:
+            item_keys = self._writable_item_keys(value_item)
+        except KeyError:
+            self._set_item_keys(value_item, set(keys))
+        else:
+            item_keys.update(keys)
+
+
+    def __contains__(self, key):
+        return key in self._store
+
+
+    def __getitem__(self, key):
+        return self._store[key]
+
+
+    def __setitem__(self, key, value):
+        value = _as_value_set(value)
+        self._own_dicts()
+
+        old_value = self._store.get(key)
+        if old_value is not None:
+            # remove the old reverse mappings
+            for item in old_value:
+                if item not in value:
+                    self._remove_reverse_mapping(item, key)
+
+        for item in value:
+            self._add_reverse_mapping(key, item)
+
+        self._set_value(key, value)
+
+
+    def __delitem__(self, key):
+        self._own_dicts()
+        value = self._store[key]
+        for item in value:
+            self._remove_reverse_mapping(item, key)
+        del self._store[key]
+
+
+    def _remove_reverse_mapping(self, reverse_key, key):
+        """Removes the reverse key to key mapping from the reverse
+        dictionary, removing the reverse key from the reverse dictionary
+        if it no longer maps to any keys.
+
+        """
+        if self._owned_items is None:
+            remaining = self._reverse_store[reverse_key]
+        else:
+            remaining = self._writable_item_keys(reverse_key)
+        remaining.remove(key)
+        if not remaining:
+            del self._reverse_store[reverse_key]
+
+
+    def _remove_reverse_mappings(self, reverse_key, keys):
+        """Removes the mappings from the reverse key to each of the
+        keys, removing the reverse key from the reverse dictionary if it
+        no longer maps to any keys.
+
+        """
+        remaining = self._writable_item_keys(reverse_key)
+        remaining.difference_update(keys)
+        if not remaining:
+            del self._reverse_store[reverse_key]
+
+
+    def __iter__(self):
+        return iter(self._store)
+
+
+    def __len__(self):
+        return len(self._store)
+
+
+    def copy(self):
+        """Return a shallow copy.
+
+        The copy is made in constant time: the copy and this dictionary
+        share their main and reverse dictionaries, and the sets in them,
+        until either is changed. The first change to either then copies
+        the main and reverse dictionaries themselves, though not their
+        sets, which takes time proportional to the numbers of keys and
+        items. A shared set is cloned only when it is first changed, so
+        each later change to a key costs time proportional to the size
+        of its set, not of the dictionary.
+
+        State which subclasses keep besides, such as the degree counters
+        of :class:`DegreeTrackingTwoWaySetDict` and the filter of
+        :class:`BloomFilteredTwoWaySetDict`, is likewise shared, and
+        copied on that first change. Both dictionaries then keep track
+        of which of their sets are still shared, which makes each of
+        their changes a little slower than those of a dictionary never
+        copied.
+
+        """
+        duplicate = self.__class__()
+        duplicate._share_from(self)
+        return duplicate
+
+
+    def clear(self):
+        # New dictionaries, rather than clearing these, which may be
+        # shared with a copy.
+        self._store = {}
+        self._reverse_store = {}
+        self._reverse_rows = None
+        self._dicts_shared = False
+        self._owned_keys = None
+        self._owned_items = None
+
+
+    def reverse_keys(self):
+        """Returns a list of the keys of the reverse dictionary.
+
+        These items are the items in the value sets of the main
+        dictionary.
+
+        """
+        return self._reverse_store.keys()
+
+
+    def reverse_iterkeys(self):
+        """Returns an iterable of the keys of the reverse dictionary.
+
+        These items are the items in the value sets of the main
+        dictionary.
+
+        """
+        return self._reverse_store.iterkeys()
+
+
+    def reverse_values(self):
+        """Returns a list of the values of the reverse dictionary.
+
+        These values are sets of the keys in the main dictionary.
+
+        """
+        return self._reverse_store.values()
+
+
+    def reverse_itervalues(self):
+        """Returns an iterable of the values of the reverse dictionary.
+
+        These values are sets of the keys in the main dictionary.
+
+        """
+        return self._reverse_store.itervalues()
+
+
+    def reverse_items(self):
+        """Returns a list of tuples for reverse key and value pairs.
+
+        """
+        return self._reverse_store.items()
+
+
+    def reverse_iteritems(self):
+        """Yields individual key-value pairs for the reversed items.
+
+        """
+        return self._reverse_store.iteritems()
+
+
+    def has_item(self, item):
+        """Performs a reverse-lookup to see if an item exists among the
+        sets in the dictionary's values.
+
+        Returns ``True`` if the item is among the values, or ``False``
+        if the item is not.
+
+        :param item: an item that may be among the ``set``s in the
+          main dictionary's values
+
+        """
+        if item in self._reverse_store:
+            return True
+        else:
+            return False
+
+
+    def item_has_key(self, item, key):
+        """See if an item in the values of the dictionary has a reverse
+        mapping to an item.
+
+        Raises a ``KeyError`` if the item is not present in any of the
+        values.
+
+        Returns True if the item has a reverse mapping to the key, or
+        False if the item has no reverse mapping to the key.
+
+        :param item: an item in one of the value sets
+        :param key: a key of the dictionary
+
+        """
+        if key in self._reverse_store[item]:
+            return True
+        else:
+            return False
+
+
+    def get_item_keys(self, item):
+        """Returns a ``set`` of all keys whose ``set`` values the item
+        is present in.
+
+        Raises a ``KeyError`` if the item is not present in any of the
+        values.
+
+        :param item: an item in one of the value sets
+
+        """
+        return self._reverse_store[item]
+
+
+    def add_item(self, key, item):
+        """Adds a item to the set belonging to the key.
+
+        Raises a ``KeyError`` if the key does not exist.
+
+        :param key: a key in the main dictionary
+        :param item: an item to be added to the set belonging to the key
+
+        """
+        if self._owned_keys is None:
+            # Never copied, so no set is shared.
+            self._store[key].add(item)
+        else:
+            self._own_dicts()
+            self._writable_value(key).add(item)
+        self._add_reverse_mapping(key, item)
+
+
+    def remove_item(self, key, item):
+        """Removes an item from the set belonging to the key.
+
+        Raises a ``KeyError`` if the key does not exist, or if the item
+        is not present in the set belonging to the key.
+
+        :param key: a key in the main dictionary
+        :param item: an item to be removed from the set belonging to the
+          key
+
+        """
+        if self._owned_keys is None:
+            self._store[key].remove(item)
+        else:
+            self._own_dicts()
+            self._writable_value(key).remove(item)
+        self._remove_reverse_mapping(item, key)
+
+
+    def remove_item_from_all_keys(self, item):
+        """Removes an item from all ``set`` values in the main
+        dictionary to which it belongs.
+
+        Raises a ``KeyError`` if the item is not present in any of the
+        values.
+
+        :param item: an item to be removed from all sets of values
+
+        """
+        self._own_dicts()
+        for key in self._reverse_store[item]:
+            self._writable_value(key).remove(item)
+        del self._reverse_store[item]
+
+
+    def update(*args, **kwargs):
+        """Updates the dictionary with the key-value pairs from a
+        mapping or an iterable of pairs, and from keyword arguments,
+        like :meth:`dict.update`.
+
+        Rather than setting each key in turn, the changes to the reverse
+        dictionary are grouped by item and applied in one pass, which is
+        much faster for large updates.
+
+        Raises a ``ValueError``, and leaves the dictionary unchanged, if
+        any value is not a ``set``.
+
+        """
+        # Take self from args so that "self" may be used as a keyword.
+        if not args:
+            raise TypeError("update() needs an instance")
+        self = args[0]
+        if len(args) > 2:
+            raise TypeError(
+                    "update() takes at most 1 positional argument "
+                    "({0} given)".format(len(args) - 1)
+            )
+        new_values = _dict_of_sets(args[1:], kwargs)
+        self._own_dicts()
+
+        added = defaultdict(list)
+        removed = defaultdict(list)
+        for key, value in new_values.iteritems():
+            old_value = self._store.get(key)
+            if old_value is None or old_value is value:
+                # The set may have been changed in place, so map all of
+                # its items.
+                new_items = value
+            else:
+                for item in old_value - value:
+                    removed[item].append(key)
+                new_items = value - old_value
+            for item in new_items:
+                added[item].append(key)
+        self._set_values(new_values)
+
+        for item, keys in removed.iteritems():
+            self._remove_reverse_mappings(item, keys)
+        for item, keys in added.iteritems():
+            self._add_reverse_mappings(item, keys)
+
+
+    def add_items(self, key, items):
+        """Adds several items to the set belonging to the key.
+
+        Raises a ``KeyError`` if the key does not exist.
+
+        :param key: a key in the main dictionary
+        :param items: an iterable of items to be added to the set
+            belonging to the key
+
+        """
+        self._own_dicts()
+        value = self._writable_value(key)
+        new_items = set(items)
+        new_items.difference_update(value)
+        value.update(new_items)
+        for item in new_items:
+            self._add_reverse_mapping(key, item)
+
+
+    def remove_items(self, key, items):
+        """Removes several items from the set belonging to the key.
+
+        Raises a ``KeyError``, and leaves the set unchanged, if the key
+        does not exist, or if any of the items is not present in the set
+        belonging to the key.
+
+        :param key: a key in the main dictionary
+        :param items: an iterable of items to be removed from the set
+            belonging to the key
+
+        """
+        value = self._store[key]
+        items = set(items)
+        missing = items - value
+        if missing:
+            raise KeyError(missing.pop())
+        self._own_dicts()
+        self._writable_value(key).difference_update(items)
+        for item in items:
+            self._remove_reverse_mapping(item, key)
+
+
+    def remove_items_from_all_keys(self, items):
+        """Removes several items from all ``set`` values in the main
+        dictionary to which they belong.
+
+        The items are grouped by key, so that each key's set is updated
+        once.
+
+        Raises a ``KeyError``, and leaves the dictionary unchanged, if
+        any of the items is not present in any of the values.
+
+        :param items: an iterable of items to be removed from all sets
+            of values
+
+        """
+        items = set(items)
+        for item in items:
+            if item not in self._reverse_store:
+                raise KeyError(item)
+        self._own_dicts()
+        items_by_key = defaultdict(list)
+        for item in items:
+            for key in self._reverse_store.pop(item):
+                items_by_key[key].append(item)
+        for key, key_items in items_by_key.iteritems():
+            self._writable_value(key).difference_update(key_items)
+
+
+    def value_proxy(self, key):
+        """Returns a :class:`ValueSetProxy` of the set belonging to the
+        key, through which the set may be changed in place while
+        keeping the reverse dictionary up to date.
+
+        Raises a ``KeyError`` if the key does not exist.
+
+        :param key: a key in the main dictionary
+
+        """
+        if key not in self._store:
+            raise KeyError(key)
+        return ValueSetProxy(self, key)
+
+
+    def apply_delta(self, key, added=(), removed=()):
+        """Removes and adds items to the set belonging to the key,
+        updating the reverse dictionary at a cost proportional to the
+        number of items changed rather than to the size of the set.
+
+        Items to remove which are not in the set are ignored. The
+        removals are made before the additions, so an item both removed
+        and added stays in the set.
+
+        Raises a ``KeyError`` if the key does not exist.
+
+        :param key: a key in the main dictionary
+        :param added: an iterable of items to add to the set
+        :param removed: an iterable of items to remove from the set
+
+        """
+        self._own_dicts()
+        value = self._writable_value(key)
+        removed = value.intersection(removed)
+        value.difference_update(removed)
+        for item in removed:
+            self._remove_reverse_mapping(item, key)
+        added = set(added)
+        added.difference_update(value)
+        value.update(added)
+        for item in added:
+            self._add_reverse_mapping(key, item)
+
+
+    def _postings(self, items):
+        """Returns a list of the sets of keys for each of the distinct
+        items present, smallest first.
+
+        """
+        reverse_store = self._reverse_store
+        postings = [reverse_store[item] for item in set(items) if item
+                    in reverse_store]
+        postings.sort(key=len)
+        return postings
+
+
+    def keys_containing_all(self, items):
+        """Returns a ``set`` of the keys whose sets contain every one of
+        the items.
+
+        The sets of keys for the items are intersected from the
+        smallest up, stopping as soon as the intersection is empty.
+
+        :param items: an iterable of items
+
+        """
+        items = set(items)
+        if not items:
+            return set(self._store)
+        postings = self._postings(items)
+        if len(postings) < len(items):
+            return set()
+        keys = set(postings[0])
+        for posting in postings[1:]:
+            if not keys:
+                break
+            keys.intersection_update(posting)
+        return keys
+
+
+    def keys_containing_any(self, items):
+        """Returns a ``set`` of the keys whose sets contain at least one
+        of the items.
+
+        :param items: an iterable of items
+
+        """
+        keys = set()
+        for posting in self._postings(items):
+            keys.update(posting)
+        return keys
+
+
+    def keys_containing_at_least(self, items, n):
+        """Returns a ``set`` of the keys whose sets contain at least
+        ``n`` of the items.
+
+        :param items: an iterable of items
+        :param n: the least number of the items a key's set must contain
+
+        """
+        if n <= 0:
+            return set(self._store)
+        postings = self._postings(items)
+        if n > len(postings):
+            return set()
+        # A key which lacks no more than len(postings) - n of the items
+        # must be among the keys of any len(postings) - n + 1 of them;
+        # take the smallest as candidates.
+        candidates = set()
+        for posting in postings[:len(postings) - n + 1]:
+            candidates.update(posting)
+        if n == 1:
+            return candidates
+        keys = set()
+        for key in candidates:
+            count = 0
+            for posting in postings:
+                if key in posting:
+                    count += 1
+                    if count == n:
+                        keys.add(key)
+                        break
+        return keys
+
+
+    def top_overlap(self, key, k):
+        """Returns a list of up to ``k`` pairs of other keys and the
+        number of items their sets share with the key's set, from most
+        to fewest shared items.
+
+        Only keys sharing at least one item are considered, and they are
+        found through the reverse dictionary rather than by comparing
+        the key's set with every other set.
+
+        Raises a ``KeyError`` if the key does not exist.
+
+        :param key: a key in the main dictionary
+        :param k: the number of keys to return
+
+        """
+        counts = Counter()
+        for item in self._store[key]:
+            counts.update(self._reverse_store[item])
+        del counts[key]
+        return counts.most_common(k)
+
+
+    def freeze(self):
+        """Returns a read-only :class:`FrozenTwoWaySetDict` with the
+        same contents, which may be saved to a file and memory-mapped.
+
+        """
+        return FrozenTwoWaySetDict(*_sets_to_csr(self._store))
+
+
+    def _init_kwargs(self):
+        """Returns the keyword arguments, besides the items, with which
+        to create a dictionary like this one.
+
+        """
+        return {}
+
+
+    def __reduce__(self):
+        # Pickle only the main dictionary, as the distinct items and the
+        # ids of each key's items; the reverse dictionary is rebuilt
+        # from them when first needed (see _load_rows()).
+        keys = self._store.keys()
+        values = self._store.values()
+        items, item_ids = _flatten_typed(values)
+        return (
+            _rebuild_two_way_set_dict,
+            (self.__class__, self._init_kwargs(), keys, items,
+             _pack_ids(itertools.imap(len, values)), _pack_ids(item_ids))
+        )
+
+
+    # TODO: implement the following
+    #def reverse_pop(self):
+    #def reverse_popitem(self):
+
+
+class LazyTwoWaySetDict(TwoWaySetDict):
+    """A :class:`TwoWaySetDict` which builds its reverse dictionary
+    only when first needed.
+
+    Until the first reverse lookup (e.g., :meth:`get_item_keys`,
+    :meth:`has_item`, or :meth:`reverse_items`), changes to the
+    dictionary touch only the main dictionary. The reverse dictionary is
+    then built in one pass, and kept up to date from then on, as in
+    :class:`TwoWaySetDict`. This suits loading a large dictionary before
+    making any reverse lookups, or never making any at all.
+
+    """
+
+    def __init__(self, items=None, **kwargs):
+        """
+        :param items: an iterable of pairs of keys and values; values
+            should be :class:`set` instances
+
+        """
+        if items is None:
+            items = []
+        self._store = {}
+        self._lazy_reverse_store = None
+        self._dicts_shared = False
+        self._owned_keys = None
+        self._owned_items = None
+        self.update(items, **kwargs)
+
+
+    @property
+    def _reverse_store(self):
+        if self._lazy_reverse_store is None:
+            self._lazy_reverse_store = self._build_reverse_store()
+        return self._lazy_reverse_store
+
+
+    @_reverse_store.setter
+    def _reverse_store(self, reverse_store):
+        self._lazy_reverse_store = reverse_store
+
+
+    def reverse_store_built(self):
+        """Returns ``True`` if the reverse dictionary has been built, or
+        ``False`` if it has not.
+
+        """
+        return self._lazy_reverse_store is not None
+
+
+    def _share_from(self, other):
+        # Share the reverse dictionary only if it has been built, rather
+        # than building it to share it.
+        other._mark_shared()
+        self._store = other._store
+        self._lazy_reverse_store = other._lazy_reverse_store
+        self._mark_shared()
+
+
+    def _load_rows(self, store, rows):
+        # The reverse dictionary is built from the main one when first
+        # needed, as always.
+        self._store = store
+
+
+    def _own_dicts(self):
+        if self._dicts_shared:
+            self._store = dict(self._store)
+            if self._lazy_reverse_store is not None:
+                self._lazy_reverse_store = dict(self._lazy_reverse_store)
+            self._dicts_shared = False
+
+
+    def __setitem__(self, key, value):
+        if self._lazy_reverse_store is not None:
+            super(LazyTwoWaySetDict, self).__setitem__(key, value)
+        else:
+            value = _as_value_set(value)
+            self._own_dicts()
+            self._set_value(key, value)
+
+
+    def __delitem__(self, key):
+        if self._lazy_reverse_store is not None:
+            super(LazyTwoWaySetDict, self).__delitem__(key)
+        else:
+            self._own_dicts()
+            del self._store[key]
+
+
+    def clear(self):
+        super(LazyTwoWaySetDict, self).clear()
+        self._lazy_reverse_store = None
+
+
+    def update(*args, **kwargs):
+        if not args:
+            raise TypeError("update() needs an instance")
+        self = args[0]
+        if self._lazy_reverse_store is not None:
+            return TwoWaySetDict.update(*args, **kwargs)
+        if len(args) > 2:
+            raise TypeError(
+                    "update() takes at most 1 positional argument "
+                    "({0} given)".format(len(args) - 1)
+            )
+        new_values = _dict_of_sets(args[1:], kwargs)
+        self._own_dicts()
+        self._set_values(new_values)
+
+
+    def add_item(self, key, item):
+        if self._lazy_reverse_store is not None:
+            super(LazyTwoWaySetDict, self).add_item(key, item)
+        else:
+            self._own_dicts()
+            self._writable_value(key).add(item)
+
+
+    def add_items(self, key, items):
+        if self._lazy_reverse_store is not None:
+            super(LazyTwoWaySetDict, self).add_items(key, items)
+        else:
+            self._own_dicts()
+            self._writable_value(key).update(items)
+
+
+    def remove_item(self, key, item):
+        if self._lazy_reverse_store is not None:
+            super(LazyTwoWaySetDict, self).remove_item(key, item)
+        else:
+            self._own_dicts()
+            self._writable_value(key).remove(item)
+
+
+    def remove_items(self, key, items):
+        if self._lazy_reverse_store is not None:
+            super(LazyTwoWaySetDict, self).remove_items(key, items)
+        else:
+            value = self._store[key]
+            items = set(items)
+            missing = items - value
+            if missing:
+                raise KeyError(missing.pop())
+            self._own_dicts()
+            self._writable_value(key).difference_update(items)
+
+
+    def apply_delta(self, key, added=(), removed=()):
+        if self._lazy_reverse_store is not None:
+            super(LazyTwoWaySetDict, self).apply_delta(key, added, removed)
+        else:
+            self._own_dicts()
+            value = self._writable_value(key)
+            value.difference_update(removed)
+            value.update(added)
+
+
+class BloomFilteredTwoWaySetDict(TwoWaySetDict):
+    """A :class:`TwoWaySetDict` which keeps a Bloom filter of the items
+    in its values, so that reverse lookups of absent items can return
+    without consulting the reverse dictionary.
+
+    This pays off when most reverse lookups are misses and the reverse
+    dictionary is costly to probe. A Bloom filter cannot forget items,
+    so items removed from every set still pass the filter, and show up
+    as false positives; :meth:`rebuild_filter` clears them out.
+    :meth:`filter_info` reports how full the filter is and how often it
+    has given false positives, to help size it.
+
+    """
+
+    def __init__(self, items=None, capacity=65536, error_rate=0.01,
+                 **kwargs):
+        """
+        :param items: an iterable of pairs of keys and values; values
+            should be :class:`set` instances
+        :param capacity: the number of distinct items for which the
+            filter is sized
+        :param error_rate: the rate of false positives the filter is to
+            give when holding ``capacity`` items
+
+        """
+        self._filter = _BloomFilter(capacity, error_rate)
+        self._filter_negatives = 0
+        self._filter_false_positives = 0
+        super(BloomFilteredTwoWaySetDict, self).__init__(items, **kwargs)
+
+
+    def _share_from(self, other):
+        super(BloomFilteredTwoWaySetDict, self)._share_from(other)
+        self._filter = other._filter
+
+
+    def _own_dicts(self):
+        if self._dicts_shared:
+            self._filter = self._filter.copy()
+        super(BloomFilteredTwoWaySetDict, self)._own_dicts()
+
+
+    def _load_rows(self, store, rows):
+        super(BloomFilteredTwoWaySetDict, self)._load_rows(store, rows)
+        keys, items, key_lengths, item_ids = rows
+        for item in items:
+            self._filter.add(item)
+
+
+    def _init_kwargs(self):
+        return {
+            'capacity': self._filter.capacity,
+            'error_rate': self._filter.error_rate
+        }
+
+
+    def _set_item_keys(self, item, keys):
+        # Every item newly added to the reverse dictionary passes
+        # through here.
+        self._filter.add(item)
+        super(BloomFilteredTwoWaySetDict, self)._set_item_keys(item, keys)
+
+
+    def _lookup_item(self, item):
+        """Returns the set of keys for the item, or ``None`` if the
+        item is not present in any of the values, consulting the filter
+        first.
+
+        """
+        if item not in self._filter:
+            self._filter_negatives += 1
+            return None
+        keys = self._reverse_store.get(item)
+        if keys is None:
+            self._filter_false_positives += 1
+        return keys
+
+
+    def clear(self):
+        super(BloomFilteredTwoWaySetDict, self).clear()
+        # A new filter, rather than clearing this one, which may be
+        # shared with a copy.
+        self._filter = _BloomFilter(self._filter.capacity,
+                                    self._filter.error_rate)
+
+
+    def has_item(self, item):
+        return self._lookup_item(item) is not None
+
+
+    def item_has_key(self, item, key):
+        keys = self._lookup_item(item)
+        if keys is None:
+            raise KeyError(item)
+        return key in keys
+
+
+    def get_item_keys(self, item):
+        keys = self._lookup_item(item)
+        if keys is None:
+            raise KeyError(item)
+        return keys
+
+
+    def filter_info(self):
+        """Returns a :class:`FilterInfo` named tuple with the capacity,
+        target error rate, and fill ratio of the filter, the number of
+        lookups the filter has answered as definite misses, the number
+        of false positives it has given, and the rate of false positives
+        among lookups of absent items.
+
+        """
+        negatives = self._filter_negatives
+        false_positives = self._filter_false_positives
+        absent_lookups = negatives + false_positives
+        if absent_lookups:
+            false_positive_rate = float(false_positives) / absent_lookups
+        else:
+            false_positive_rate = 0.0
+        return FilterInfo(
+                self._filter.capacity,
+                self._filter.error_rate,
+                self._filter.fill_ratio(),
+                negatives,
+                false_positives,
+                false_positive_rate
+        )
+
+
+    def rebuild_filter(self, capacity=None, error_rate=None):
+        """Rebuilds the filter from the items currently in the values,
+        dropping removed items, and resets the lookup statistics.
+
+        :param capacity: the number of distinct items for which to size
+            the new filter [default: the larger of the current capacity
+            and the current number of items]
+        :param error_rate: the target rate of false positives for the
+            new filter [default: the current target]
+
+        """
+        if capacity is None:
+            capacity = max(self._filter.capacity, len(self._reverse_store))
+        if error_rate is None:
+            error_rate = self._filter.error_rate
+        new_filter = _BloomFilter(capacity, error_rate)
+        for item in self._reverse_store:
+            new_filter.add(item)
+        self._filter = new_filter
+        self._filter_negatives = 0
+        self._filter_false_positives = 0
+
+
+class _DegreeCounter(object):
+    """Counts the degree of each of a collection of objects, keeping
+    the objects bucketed by degree so that the objects of highest
+    degree can be found without a scan.
+
+    Objects of degree zero are not held.
+
+    """
+
+    def __init__(self):
+        self._degrees = {}
+        self._buckets = {}
+        self._sorted_degrees = _SortedList()
+
+
+    def __len__(self):
+        return len(self._degrees)
+
+
+    def get(self, obj):
+        return self._degrees.get(obj, 0)
+
+
+    def adjust(self, obj, change):
+        """Changes the degree of the object by the given amount."""
+        if not change:
+            return
+        old_degree = self._degrees.get(obj, 0)
+        new_degree = old_degree + change
+        if old_degree:
+            bucket = self._buckets[old_degree]
+            bucket.remove(obj)
+            if not bucket:
+                del self._buckets[old_degree]
+                self._sorted_degrees.remove(old_degree)
+        if new_degree:
+            self._degrees[obj] = new_degree
+            bucket = self._buckets.get(new_degree)
+            if bucket is None:
+                bucket = self._buckets[new_degree] = set()
+                self._sorted_degrees.add(new_degree)
+            bucket.add(obj)
+        else:
+            del self._degrees[obj]
+
+
+    def histogram(self):
+        """Returns a dictionary of the number of objects with each
+        degree.
+
+        """
+        return dict((degree, len(bucket)) for (degree, bucket) in
+                    self._buckets.iteritems())
+
+
+    def most_common(self, k):
+        """Returns a list of up to ``k`` pairs of objects and their
+        degrees, from highest to lowest degree.
+
+        """
+        top = []
+        for degree in reversed(self._sorted_degrees):
+            for obj in self._buckets[degree]:
+                if len(top) >= k:
+                    return top
+                top.append((obj, degree))
+        return top
+
+
+    def copy(self):
+        duplicate = _DegreeCounter()
+        duplicate._degrees = self._degrees.copy()
+        duplicate._buckets = dict((degree, set(bucket)) for
+                                  (degree, bucket) in
+                                  self._buckets.iteritems())
+        for degree in self._sorted_degrees:
+            duplicate._sorted_degrees.add(degree)
+        return duplicate
+
+
+class DegreeTrackingTwoWaySetDict(TwoWaySetDict):
+    """A :class:`TwoWaySetDict` which keeps statistics of the degrees
+    of its keys and items up to date as it changes.
+
+    The degree of a key is the size of its set, and the degree of an
+    item the number of keys whose sets it is in. Every membership added
+    or removed adjusts both, so the degree histograms and the keys and
+    items of highest degree are found without scanning the dictionary.
+
+    Keys whose sets are empty have degree zero; they are counted in
+    :meth:`key_degree_histogram`, but never given by :meth:`top_keys`.
+
+    """
+
+    def __init__(self, items=None, **kwargs):
+        """
+        :param items: an iterable of pairs of keys and values; values
+            should be :class:`set` instances
+
+        """
+        self._key_degrees = _DegreeCounter()
+        self._item_degrees = _DegreeCounter()
+        super(DegreeTrackingTwoWaySetDict, self).__init__(items, **kwargs)
+
+
+    def _share_from(self, other):
+        super(DegreeTrackingTwoWaySetDict, self)._share_from(other)
+        self._key_degrees = other._key_degrees
+        self._item_degrees = other._item_degrees
+
+
+    def _own_dicts(self):
+        if self._dicts_shared:
+            self._key_degrees = self._key_degrees.copy()
+            self._item_degrees = self._item_degrees.copy()
+        super(DegreeTrackingTwoWaySetDict, self)._own_dicts()
+
+
+    def _load_rows(self, store, rows):
+        super(DegreeTrackingTwoWaySetDict, self)._load_rows(store, rows)
+        for key, value in store.iteritems():
+            self._key_degrees.adjust(key, len(value))
+        for item, keys in self._reverse_store.iteritems():
+            self._item_degrees.adjust(item, len(keys))
+
+
+    def _add_reverse_mapping(self, key, value_item):
+        keys = self._reverse_store.get(value_item)
+        if keys is None or key not in keys:
+            self._key_degrees.adjust(key, 1)
+            self._item_degrees.adjust(value_item, 1)
+        super(DegreeTrackingTwoWaySetDict, self)._add_reverse_mapping(
+                key, value_item)
+
+
+    def _add_reverse_mappings(self, value_item, keys):
+        existing = self._reverse_store.get(value_item, ())
+        new_keys = [key for key in set(keys) if key not in existing]
+        for key in new_keys:
+            self._key_degrees.adjust(key, 1)
+        self._item_degrees.adjust(value_item, len(new_keys))
+        super(DegreeTrackingTwoWaySetDict, self)._add_reverse_mappings(
+                value_item, new_keys)
+
+
+    def _remove_reverse_mapping(self, reverse_key, key):
+        super(DegreeTrackingTwoWaySetDict, self)._remove_reverse_mapping(
+                reverse_key, key)
+        self._key_degrees.adjust(key, -1)
+        self._item_degrees.adjust(reverse_key, -1)
+
+
+    def _remove_reverse_mappings(self, reverse_key, keys):
+        existing = self._reverse_store[reverse_key]
+        removed_keys = [key for key in set(keys) if key in existing]
+        super(DegreeTrackingTwoWaySetDict, self)._remove_reverse_mappings(
+                reverse_key, removed_keys)
+        for key in removed_keys:
+            self._key_degrees.adjust(key, -1)
+        self._item_degrees.adjust(reverse_key, -len(removed_keys))
+
+
+    def _items_removed(self, item, keys):
+        """Records the removal of the item from the sets of the keys.
+
+        """
+        for key in keys:
+            self._key_degrees.adjust(key, -1)
+        self._item_degrees.adjust(item, -len(keys))
+
+
+    def remove_item_from_all_keys(self, item):
+        keys = list(self._reverse_store[item])
+        super(DegreeTrackingTwoWaySetDict, self).remove_item_from_all_keys(
+                item)
+        self._items_removed(item, keys)
+
+
+    def remove_items_from_all_keys(self, items):
+        items = set(items)
+        keys_by_item = [(item, list(self._reverse_store[item])) for item
+                        in items if item in self._reverse_store]
+        super(DegreeTrackingTwoWaySetDict,
+              self).remove_items_from_all_keys(items)
+        for item, keys in keys_by_item:
+            self._items_removed(item, keys)
+
+
+    def clear(self):
+        super(DegreeTrackingTwoWaySetDict, self).clear()
+        # New counters, rather than clearing these, which may be shared
+        # with a copy.
+        self._key_degrees = _DegreeCounter()
+        self._item_degrees = _DegreeCounter()
+
+
+    def key_degree(self, key):
+        """Returns the number of items in the set belonging to the key.
+
+        Raises a ``KeyError`` if the key does not exist.
+
+        :param key: a key in the main dictionary
+
+        """
+        return len(self._store[key])
+
+
+    def item_degree(self, item):
+        """Returns the number of keys whose sets the item is in, which
+        is zero if the item is not present in any of the values.
+
+        :param item: an item that may be among the sets in the
+          dictionary's values
+
+        """
+        return self._item_degrees.get(item)
+
+
+    def key_degree_histogram(self):
+        """Returns a dictionary of the number of keys with each degree,
+        including degree zero if any key's set is empty.
+
+        """
+        histogram = self._key_degrees.histogram()
+        num_empty = len(self._store) - len(self._key_degrees)
+        if num_empty:
+            histogram[0] = num_empty
+        return histogram
+
+
+    def item_degree_histogram(self):
+        """Returns a dictionary of the number of items with each
+        degree.
+
+        """
+        return self._item_degrees.histogram()
+
+
+    def top_keys(self, k):
+        """Returns a list of up to ``k`` pairs of the keys with the
+        largest sets and the sizes of their sets, from largest to
+        smallest.
+
+        :param k: the number of keys to return
+
+        """
+        return self._key_degrees.most_common(k)
+
+
+    def top_items(self, k):
+        """Returns a list of up to ``k`` pairs of the items in the most
+        keys' sets and their numbers of keys, from most to fewest.
+
+        :param k: the number of items to return
+
+        """
+        return self._item_degrees.most_common(k)
+
+
+def _reading(method):
+    """Wraps a method to run with the instance's lock held for
+    reading.
+
+    """
+    @functools.wraps(method)
+    def locked(*args, **kwargs):
+        with args[0]._lock.read_lock:
+            return method(*args, **kwargs)
+    return locked
+
+
+def _writing(method):
+    """Wraps a method to run with the instance's lock held for
+    writing.
+
+    """
+    @functools.wraps(method)
+    def locked(*args, **kwargs):
+        with args[0]._lock.write_lock:
+            return method(*args, **kwargs)
+    return locked
+
+
+def _proxy_writing(method):
+    """Wraps a method of a :class:`ValueSetProxy` to run with its
+    dictionary's lock held for writing.
+
+    """
+    @functools.wraps(method)
+    def locked(*args, **kwargs):
+        with args[0]._owner._lock.write_lock:
+            return method(*args, **kwargs)
+    return locked
+
+
+class _ConcurrentValueSetProxy(ValueSetProxy):
+    """A :class:`ValueSetProxy` of a :class:`ConcurrentTwoWaySetDict`,
+    which reads the set under the dictionary's lock, and makes each
+    change, including working out what to change, while holding the
+    lock for writing.
+
+    """
+
+    __slots__ = ()
+
+    def _get_set(self):
+        # A snapshot, since other threads may change the set while it
+        # is read.
+        return self._owner[self._key]
+
+
+    def __contains__(self, item):
+        with self._owner._lock.read_lock:
+            return item in self._owner._store[self._key]
+
+
+    def __len__(self):
+        with self._owner._lock.read_lock:
+            return len(self._owner._store[self._key])
+
+
+    add = _proxy_writing(ValueSetProxy.add)
+    discard = _proxy_writing(ValueSetProxy.discard)
+    pop = _proxy_writing(ValueSetProxy.pop)
+    clear = _proxy_writing(ValueSetProxy.clear)
+    update = _proxy_writing(ValueSetProxy.update)
+    difference_update = _proxy_writing(ValueSetProxy.difference_update)
+    intersection_update = _proxy_writing(ValueSetProxy.intersection_update)
+    symmetric_difference_update = _proxy_writing(
+            ValueSetProxy.symmetric_difference_update)
+    __ior__ = _proxy_writing(ValueSetProxy.__ior__)
+    __iand__ = _proxy_writing(ValueSetProxy.__iand__)
+    __ixor__ = _proxy_writing(ValueSetProxy.__ixor__)
+    __isub__ = _proxy_writing(ValueSetProxy.__isub__)
+
+
+class ConcurrentTwoWaySetDict(TwoWaySetDict):
+    """A thread-safe :class:`TwoWaySetDict` for serving lookups from
+    many threads while others change it.
+
+    The dictionary is guarded by a reentrant readers-writer lock:
+    lookups, in either direction, hold it for reading and so run
+    alongside each other (in parallel, on interpreters without a global
+    interpreter lock), while each change holds it for writing, which
+    makes the change to the main and reverse dictionaries atomic.
+    :meth:`pop`, :meth:`popitem`, and :meth:`setdefault` are atomic too.
+
+    Lookups return snapshots rather than live views: values and sets of
+    keys are given as :class:`frozenset` instances, and iteration runs
+    over a list of the keys taken when it starts; :meth:`items` and
+    :meth:`values` likewise take their snapshot under a single lock.
+    Change values with :meth:`add_item`, :meth:`remove_item`,
+    :meth:`apply_delta`, or by assigning a new set. The views given by
+    :meth:`value_proxy` read snapshots too, and make each change
+    atomically.
+
+    """
+
+    def __init__(self, items=None, **kwargs):
+        """
+        :param items: an iterable of pairs of keys and values; values
+            should be :class:`set` instances
+
+        """
+        self._lock = _ReadWriteLock()
+        super(ConcurrentTwoWaySetDict, self).__init__(items, **kwargs)
+
+
+    def __getitem__(self, key):
+        with self._lock.read_lock:
+            return frozenset(self._store[key])
+
+
+    def __iter__(self):
+        with self._lock.read_lock:
+            keys = list(self._store)
+        return iter(keys)
+
+
+    def values(self):
+        with self._lock.read_lock:
+            return [frozenset(value) for value in self._store.itervalues()]
+
+
+    def itervalues(self):
+        return iter(self.values())
+
+
+    def items(self):
+        with self._lock.read_lock:
+            return [(key, frozenset(value)) for (key, value) in
+                    self._store.iteritems()]
+
+
+    def iteritems(self):
+        return iter(self.items())
+
+
+    def get_item_keys(self, item):
+        with self._lock.read_lock:
+            return frozenset(self._reverse_store[item])
+
+
+    def reverse_keys(self):
+        with self._lock.read_lock:
+            return list(self._reverse_store)
+
+
+    def reverse_iterkeys(self):
+        return iter(self.reverse_keys())
+
+
+    def reverse_values(self):
+        with self._lock.read_lock:
+            return [frozenset(keys) for keys in
+                    self._reverse_store.itervalues()]
+
+
+    def reverse_itervalues(self):
+        return iter(self.reverse_values())
+
+
+    def reverse_items(self):
+        with self._lock.read_lock:
+            return [(item, frozenset(keys)) for (item, keys) in
+                    self._reverse_store.iteritems()]
+
+
+    def reverse_iteritems(self):
+        return iter(self.reverse_items())
+
+
+    def value_proxy(self, key):
+        with self._lock.read_lock:
+            if key not in self._store:
+                raise KeyError(key)
+        return _ConcurrentValueSetProxy(self, key)
+
+
+    __contains__ = _reading(TwoWaySetDict.__contains__)
+    __len__ = _reading(TwoWaySetDict.__len__)
+    has_item = _reading(TwoWaySetDict.has_item)
+    item_has_key = _reading(TwoWaySetDict.item_has_key)
+    keys_containing_all = _reading(TwoWaySetDict.keys_containing_all)
+    keys_containing_any = _reading(TwoWaySetDict.keys_containing_any)
+    keys_containing_at_least = _reading(
+            TwoWaySetDict.keys_containing_at_least)
+    top_overlap = _reading(TwoWaySetDict.top_overlap)
+    freeze = _reading(TwoWaySetDict.freeze)
+    __reduce__ = _reading(TwoWaySetDict.__reduce__)
+
+    __setitem__ = _writing(TwoWaySetDict.__setitem__)
+    __delitem__ = _writing(TwoWaySetDict.__delitem__)
+    # Copying marks this dictionary's sets as shared, so it writes.
+    copy = _writing(TwoWaySetDict.copy)
+    clear = _writing(TwoWaySetDict.clear)
+    update = _writing(TwoWaySetDict.update)
+    add_item = _writing(TwoWaySetDict.add_item)
+    add_items = _writing(TwoWaySetDict.add_items)
+    remove_item = _writing(TwoWaySetDict.remove_item)
+    remove_items = _writing(TwoWaySetDict.remove_items)
+    remove_item_from_all_keys = _writing(
+            TwoWaySetDict.remove_item_from_all_keys)
+    remove_items_from_all_keys = _writing(
+            TwoWaySetDict.remove_items_from_all_keys)
+    apply_delta = _writing(TwoWaySetDict.apply_delta)
+    pop = _writing(TwoWaySetDict.pop)
+    popitem = _writing(TwoWaySetDict.popitem)
+    setdefault = _writing(TwoWaySetDict.setdefault)
+
+
+# The binary layout of a saved FrozenTwoWaySetDict is
+#
+#     header: magic, number of keys, number of items, number of
+#         memberships, offset and length of the pickled tables
+#     key_indptr, key_indices: the items of each key, in compressed
+#         sparse row (CSR) form, as 64-bit offsets and 32-bit item ids
+#     item_indptr, item_indices: the keys of each item, likewise
+#     tables: a pickled pair of the list of keys and the list of items,
+#         in order of their ids
+#
+# All integers are little-endian.
+_FROZEN_DICT_MAGIC = b'CUTWSD\x00\x01'
+_FROZEN_DICT_HEADER = struct.Struct('<8sQQQQQ')
+_INDPTR_FORMAT = 'Q'
+_INDICES_FORMAT = 'I'
+
+# Converts arrays to and from bytes under either major version of Python.
+_array_to_bytes = getattr(array, 'tobytes', None) or array.tostring
+_array_from_bytes = getattr(array, 'frombytes', None) or array.fromstring
+
+
+def _sets_to_csr(store):
+    """Converts a dictionary of sets into compressed sparse row arrays
+    for both directions.
+
+    Returns a tuple of the list of keys, the list of items, and the
+    ``indptr`` and ``indices`` arrays of the items of each key and of
+    the keys of each item. Each row of indices is sorted.
+
+    :param store: a dictionary whose values are sets
+
+    """
+    keys = list(store)
+    items = []
+    item_ids = {}
+    key_indptr = array('L', [0])
+    key_indices = array('L')
+    for key in keys:
+        row = []
+        for item in store[key]:
+            item_id = item_ids.get(item)
+            if item_id is None:
+                item_id = item_ids[item] = len(items)
+                items.append(item)
+            row.append(item_id)
+        row.sort()
+        key_indices.extend(row)
+        key_indptr.append(len(key_indices))
+
+    # Transpose by counting the keys of each item, then placing each key
+    # id; visiting key ids in order leaves each item's row sorted.
+    counts = [0] * len(items)
+    for item_id in key_indices:
+        counts[item_id] += 1
+    item_indptr = array('L', [0])
+    item_indptr.extend(cumsum(counts))
+    positions = list(item_indptr[:-1])
+    item_indices = array('L', [0]) * len(key_indices)
+    for key_id in xrange(len(keys)):
+        for item_id in key_indices[key_indptr[key_id]:
+                                   key_indptr[key_id + 1]]:
+            item_indices[positions[item_id]] = key_id
+            positions[item_id] += 1
+    return keys, items, key_indptr, key_indices, item_indptr, item_indices
+
+
+class _PackedArray(object):
+    """A read-only sequence of little-endian integers packed in a
+    buffer, unpacked only as they are accessed.
+
+    """
+
+    def __init__(self, buffer, offset, length, format_char):
+        """
+        :param buffer: a bytes-like object
+        :param offset: the offset of the first integer in the buffer
+        :param length: the number of integers
+        :param format_char: the :mod:`struct` format character of the
+            integers
+
+        """
+        self._buffer = buffer
+        self._offset = offset
+        self._length = length
+        self._format_char = format_char
+        self._struct = struct.Struct('<' + format_char)
+
+
+    def __len__(self):
+        return self._length
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                raise ValueError("slice step must be 1")
+            return struct.unpack_from(
+                    '<{0}{1}'.format(max(stop - start, 0),
+                                     self._format_char),
+                    self._buffer,
+                    self._offset + start * self._struct.size
+            )
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("index out of range")
+        return self._struct.unpack_from(
+                self._buffer, self._offset + index * self._struct.size)[0]
+
+
+    def __iter__(self):
+        chunk_size = 4096
+        for start in xrange(0, self._length, chunk_size):
+            for value in self[start:start + chunk_size]:
+                yield value
+
+
+def _write_packed(fileh, values, format_char):
+    """Writes integers to a file as little-endian packed values."""
+    chunk_size = 4096
+    for start in xrange(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        fileh.write(struct.pack(
+                '<{0}{1}'.format(len(chunk), format_char), *chunk))
+
+
+def _id_typecode(largest):
+    """Returns the :mod:`array` type code of the narrowest unsigned
+    integers that hold ids up to the given one.
+
+    """
+    if largest < 1 << 8:
+        return 'B'
+    elif largest < 1 << 16:
+        return 'H'
+    return _INDICES_FORMAT
+
+
+def _pack_ids(ids):
+    """Returns a sequence of non-negative integer ids packed into bytes,
+    each in as few bytes as the largest id needs.
+
+    :param ids: an array of ids, packed with its own type code, or any
+        other iterable of ids
+
+    """
+    if not isinstance(ids, array):
+        ids = list(ids)
+        ids = array(_id_typecode(max(ids) if ids else 0), ids)
+    if sys.byteorder == 'big':
+        ids = array(ids.typecode, ids)
+        ids.byteswap()
+    return ids.typecode.encode('ascii') + _array_to_bytes(ids)
+
+
+def _unpack_ids(data):
+    """Returns an array of the integer ids packed by :func:`_pack_ids`.
+
+    """
+    ids = array(str(data[:1].decode('ascii')))
+    _array_from_bytes(ids, data[1:])
+    if sys.byteorder == 'big':
+        ids.byteswap()
+    return ids
+
+
+def _flatten_typed(rows):
+    """Lists the distinct objects of a sequence of iterables, and the
+    index in that list of each object of each iterable, in order.
+
+    Objects are told apart by type as well as by value, so that, e.g.,
+    ``1`` and ``1.0`` are listed separately and keep their types.
+
+    Returns a tuple of the list of distinct objects and an array of the
+    indices.
+
+    :param rows: a sequence of iterables of hashable objects
+
+    """
+    # Building lists first, rather than arrays straight from iterators,
+    # is the faster way to fill the arrays.
+    members = list(itertools.chain.from_iterable(rows))
+    objects = list(dict.fromkeys(members))
+    object_ids = dict(itertools.izip(objects, itertools.count()))
+    ids = map(object_ids.__getitem__, members)
+    if (len(set(itertools.imap(type, objects))) > 1 and
+            map(type, members) !=
+            map(type, itertools.imap(objects.__getitem__, ids))):
+        # Some objects equal others of different types; list them again,
+        # keyed by type as well.
+        typed_members = zip(itertools.imap(type, members), members)
+        typed_objects = list(dict.fromkeys(typed_members))
+        object_ids = dict(itertools.izip(typed_objects, itertools.count()))
+        objects = [obj for obj_type, obj in typed_objects]
+        ids = map(object_ids.__getitem__, typed_members)
+    return objects, array(_id_typecode(len(objects)), ids)
+
+
+def _rebuild_sorted_tuple_keys_dict(cls, kwargs, key_elements,
+                                    key_lengths, values):
+    """Recreates a pickled :class:`SortedTupleKeysDict`; see
+    :meth:`SortedTupleKeysDict.__reduce__`.
+
+    """
+    key_elements = iter(key_elements)
+    if isinstance(key_lengths, int):
+        # Group the elements into tuples of the common length.
+        keys = itertools.izip(*[key_elements] * key_lengths)
+    else:
+        keys = itertools.imap(
+                tuple,
+                itertools.imap(itertools.islice,
+                               itertools.repeat(key_elements),
+                               _unpack_ids(key_lengths))
+        )
+    d = cls(**kwargs)
+    d._update_canonical(itertools.izip(keys, values))
+    return d
+
+
+def _rows_to_reverse_store(keys, items, key_lengths, item_ids):
+    """Builds the reverse dictionary of a :class:`TwoWaySetDict` from
+    the rows of item ids pickled by :meth:`TwoWaySetDict.__reduce__`.
+
+    :param keys: the list of keys
+    :param items: the list of distinct items
+    :param key_lengths: the number of items of each key
+    :param item_ids: the ids of the items of each key, in turn
+
+    """
+    # Transpose by adding each key to the set of each of its items; the
+    # loops run in C, so this takes far less time than update().
+    item_keys = [set() for item in items]
+    deque(itertools.imap(
+            set.add,
+            itertools.imap(item_keys.__getitem__, item_ids),
+            itertools.chain.from_iterable(
+                itertools.imap(itertools.repeat, keys, key_lengths))
+    ), maxlen=0)
+    reverse_store = dict(itertools.izip(items, item_keys))
+    if len(reverse_store) < len(items):
+        # Equal items of different types, such as 1 and 1.0, share one
+        # entry in the reverse dictionary.
+        reverse_store = {}
+        for item, keys_of_item in itertools.izip(items, item_keys):
+            existing = reverse_store.get(item)
+            if existing is None:
+                reverse_store[item] = keys_of_item
+            else:
+                existing.update(keys_of_item)
+    return reverse_store
+
+
+def _rebuild_two_way_set_dict(cls, kwargs, keys, items, key_lengths,
+                              item_ids):
+    """Recreates a pickled :class:`TwoWaySetDict`; see
+    :meth:`TwoWaySetDict.__reduce__`.
+
+    """
+    key_lengths = _unpack_ids(key_lengths)
+    item_ids = _unpack_ids(item_ids)
+    # Cut the items of all the keys into the set of each key.
+    key_items = itertools.imap(items.__getitem__, item_ids)
+    islice = itertools.islice
+    store = {}
+    for key, key_length in itertools.izip(keys, key_lengths):
+        store[key] = set(islice(key_items, key_length))
+    d = cls(**kwargs)
+    d._load_rows(store, (keys, items, key_lengths, item_ids))
+    return d
+
+
+class FrozenTwoWaySetDict(Mapping):
+    """A read-only :class:`TwoWaySetDict` which stores its memberships
+    compactly as compressed sparse row (CSR) arrays, in both directions.
+
+    Create one with :meth:`TwoWaySetDict.freeze`. It may be saved to a
+    file with :meth:`save`, and loaded with :meth:`load`, which
+    memory-maps the file so that the membership arrays are read in place
+    and shared among the processes loading the same file; only the
+    lists of keys and items are unpickled.
+
+    Values are given as :class:`frozenset` instances.
+
+    """
+
+    def __init__(self, keys, items, key_indptr, key_indices,
+                 item_indptr, item_indices):
+        """
+        :param keys: a list of the keys, in order of their ids
+        :param items: a list of the items, in order of their ids
+        :param key_indptr: the offsets of each key's row in
+            ``key_indices``
+        :param key_indices: the sorted ids of the items of each key
+        :param item_indptr: the offsets of each item's row in
+            ``item_indices``
+        :param item_indices: the sorted ids of the keys of each item
+
+        """
+        self._keys = keys
+        self._items = items
+        self._key_ids = dict((key, i) for (i, key) in enumerate(keys))
+        self._item_ids = dict((item, i) for (i, item) in
+                              enumerate(items))
+        self._key_indptr = key_indptr
+        self._key_indices = key_indices
+        self._item_indptr = item_indptr
+        self._item_indices = item_indices
+        self._buffer = None
+        self._shared_memory = None
+
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Creates a dictionary reading from a buffer in the layout
+        written by :meth:`save`, without copying its membership arrays.
+
+        :param buffer: a bytes-like object, such as a
+            :class:`mmap.mmap`
+
+        """
+        (magic, num_keys, num_items, num_memberships, tables_offset,
+         tables_length) = _FROZEN_DICT_HEADER.unpack_from(buffer, 0)
+        if magic != _FROZEN_DICT_MAGIC:
+            raise ValueError("buffer is not a saved FrozenTwoWaySetDict")
+        keys, items = pickle.loads(
+                buffer[tables_offset:tables_offset + tables_length])
+        offset = _FROZEN_DICT_HEADER.size
+        arrays = []
+        for length, format_char in (
+                (num_keys + 1, _INDPTR_FORMAT),
+                (num_memberships, _INDICES_FORMAT),
+                (num_items + 1, _INDPTR_FORMAT),
+                (num_memberships, _INDICES_FORMAT)):
+            packed = _PackedArray(buffer, offset, length, format_char)
+            arrays.append(packed)
+            offset += length * packed._struct.size
+        frozen = cls(keys, items, *arrays)
+        frozen._buffer = buffer
+        return frozen
+
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps a file written by :meth:`save`.
+
+        :param path: the path of the file
+
+        """
+        return cls.from_buffer(_map_file(path))
+
+
+    def save(self, path):
+        """Saves the dictionary to a file, which may be memory-mapped
+        with :meth:`load`.
+
+        Keys and items must be picklable.
+
+        :param path: the path of the file to write
+
+        """
+        with open(path, 'wb') as fileh:
+            self._write(fileh)
+
+
+    def _write(self, fileh):
+        tables = pickle.dumps((self._keys, self._items), _PICKLE_PROTOCOL)
+        num_memberships = len(self._key_indices)
+        tables_offset = (
+                _FROZEN_DICT_HEADER.size +
+                (len(self._keys) + len(self._items) + 2) *
+                struct.calcsize(_INDPTR_FORMAT) +
+                2 * num_memberships * struct.calcsize(_INDICES_FORMAT)
+        )
+        fileh.write(_FROZEN_DICT_HEADER.pack(
+                _FROZEN_DICT_MAGIC, len(self._keys), len(self._items),
+                num_memberships, tables_offset, len(tables)))
+        _write_packed(fileh, self._key_indptr, _INDPTR_FORMAT)
+        _write_packed(fileh, self._key_indices, _INDICES_FORMAT)
+        _write_packed(fileh, self._item_indptr, _INDPTR_FORMAT)
+        _write_packed(fileh, self._item_indices, _INDICES_FORMAT)
+        fileh.write(tables)
+
+
+    def close(self):
+        """Releases the buffer the dictionary was loaded from, closing
+        it if it is a memory map, and detaches any shared memory it is
+        in.
+
+        """
+        if hasattr(self._buffer, 'close'):
+            self._buffer.close()
+        self._buffer = None
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+            self._shared_memory = None
+
+
+    def _key_row(self, key_id):
+        return self._key_indices[self._key_indptr[key_id]:
+                                 self._key_indptr[key_id + 1]]
+
+
+    def _item_row(self, item_id):
+        return self._item_indices[self._item_indptr[item_id]:
+                                  self._item_indptr[item_id + 1]]
+
+
+    def __contains__(self, key):
+        return key in self._key_ids
+
+
+    def __getitem__(self, key):
+        items = self._items
+        return frozenset(items[item_id] for item_id in
+                         self._key_row(self._key_ids[key]))
+
+
+    def __iter__(self):
+        return iter(self._keys)
+
+
+    def __len__(self):
+        return len(self._keys)
+
+
+    def thaw(self):
+        """Returns a new, mutable :class:`TwoWaySetDict` with the same
+        contents.
+
+        """
+        return TwoWaySetDict((key, set(value)) for (key, value) in
+                             self.iteritems())
+
+
+    def reverse_keys(self):
+        """Returns a list of the items in the value sets."""
+        return list(self._items)
+
+
+    def reverse_iterkeys(self):
+        """Returns an iterable of the items in the value sets."""
+        return iter(self._items)
+
+
+    def reverse_values(self):
+        """Returns a list of the sets of keys to which each item
+        belongs.
+
+        """
+        return list(self.reverse_itervalues())
+
+
+    def reverse_itervalues(self):
+        """Returns an iterable of the sets of keys to which each item
+        belongs.
+
+        """
+        for item in self._items:
+            yield self.get_item_keys(item)
+
+
+    def reverse_items(self):
+        """Returns a list of tuples for reverse key and value pairs."""
+        return list(self.reverse_iteritems())
+
+
+    def reverse_iteritems(self):
+        """Yields individual key-value pairs for the reversed items."""
+        for item in self._items:
+            yield (item, self.get_item_keys(item))
+
+
+    def has_item(self, item):
+        """Returns ``True`` if the item is among the sets in the
+        dictionary's values, or ``False`` if it is not.
+
+        :param item: an item that may be among the sets in the
+          dictionary's values
+
+        """
+        return item in self._item_ids
+
+
+    def item_has_key(self, item, key):
+        """Returns ``True`` if the item is in the set belonging to the
+        key, or ``False`` if it is not.
+
+        Raises a ``KeyError`` if the item is not present in any of the
+        values.
+
+        :param item: an item in one of the value sets
+        :param key: a key of the dictionary
+
+        """
+        row = self._item_row(self._item_ids[item])
+        key_id = self._key_ids.get(key)
+        if key_id is None:
+            return False
+        position = bisect.bisect_left(row, key_id)
+        return position < len(row) and row[position] == key_id
+
+
+    def get_item_keys(self, item):
+        """Returns a ``frozenset`` of all keys whose sets the item is
+        present in.
+
+        Raises a ``KeyError`` if the item is not present in any of the
+        values.
+
+        :param item: an item in one of the value sets
+
+        """
+        keys = self._keys
+        return frozenset(keys[key_id] for key_id in
+                         self._item_row(self._item_ids[item]))
+
+
+def publish_shared(d, name=None):
+    """Publishes a read-only copy of a dictionary into a new block of
+    shared memory, from which other processes may attach it with
+    :func:`attach_shared`, reading it in place rather than each
+    receiving a pickled copy.
+
+    A :class:`SortedTupleKeysDict` is published in the layout written
+    by :meth:`SortedTupleKeysDict.save`, and a :class:`TwoWaySetDict`
+    or :class:`FrozenTwoWaySetDict` in the layout written by
+    :meth:`FrozenTwoWaySetDict.save`.
+
+    Returns the :class:`multiprocessing.shared_memory.SharedMemory`
+    block, whose ``name`` attribute names it for :func:`attach_shared`.
+    The caller owns the block, and must call its ``close()`` method,
+    and its ``unlink()`` method once no process needs it any longer.
+
+    Before Python 3.13, a process which is not the publisher nor one of
+    its :mod:`multiprocessing` children, and whose resource tracker is
+    already running when it first attaches the block, registers the
+    block with its own tracker, which unlinks it when that process
+    exits; such processes should attach the block before using other
+    shared resources.
+
+    Raises a ``TypeError`` if the dictionary is of another type.
+
+    :param d: the dictionary to publish
+    :param name: the name for the block [default: a unique name]
+
+    """
+    _require_shared_memory()
+    if isinstance(d, TwoWaySetDict):
+        d = d.freeze()
+    if not isinstance(d, (SortedTupleKeysDict, FrozenTwoWaySetDict)):
+        raise TypeError(
+                "cannot publish {0} instances".format(type(d).__name__))
+    fileh = io.BytesIO()
+    d._write(fileh)
+    data = fileh.getvalue()
+    block = shared_memory.SharedMemory(name=name, create=True,
+                                       size=len(data))
+    block.buf[:len(data)] = data
+    _published_names.add(block.name)
+    return block
+
+
+# The names of the blocks published by this process or its ancestors,
+# and the process id of the resource tracker started by attaching a
+# block, if any; see _attach_shared_memory().
+_published_names = set()
+_attach_tracker_pid = None
+
+
+def _attach_shared_memory(name):
+    global _attach_tracker_pid
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Before Python 3.13, which added ``track``, attaching a block
+    # registers it with this process's resource tracker, which unlinks
+    # the blocks registered with it once every process using it has
+    # exited. If the publisher registered the block with the same
+    # tracker -- as when the publisher attaches it, or its child
+    # processes do, since they share its tracker -- registering it
+    # again changes nothing, whereas unregistering it would undo the
+    # publisher's registration. So the block is unregistered only if
+    # the tracker was started by attaching, and so cannot be the
+    # publisher's.
+    tracker = resource_tracker._resource_tracker
+    tracker_was_running = tracker._fd is not None
+    block = shared_memory.SharedMemory(name=name)
+    if os.name == 'posix' and name not in _published_names:
+        if not tracker_was_running:
+            _attach_tracker_pid = tracker._pid
+        if (_attach_tracker_pid is not None and
+                tracker._pid == _attach_tracker_pid):
+            resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+
+def attach_shared(name):
+    """Attaches a dictionary published with :func:`publish_shared`.
+
+    Returns a :class:`MappedSortedTupleKeysDict` or a
+    :class:`FrozenTwoWaySetDict`, according to what was published,
+    which reads from the shared memory in place. Call its ``close()``
+    method to detach it.
+
+    :param name: the name of the shared memory block
+
+    """
+    _require_shared_memory()
+    block = _attach_shared_memory(name)
+    magic = bytes(block.buf[:len(_MAPPED_DICT_MAGIC)])
+    if magic == _MAPPED_DICT_MAGIC:
+        shared = MappedSortedTupleKeysDict(block.buf)
+    elif magic == _FROZEN_DICT_MAGIC:
+        shared = FrozenTwoWaySetDict.from_buffer(block.buf)
+    else:
+        block.close()
+        raise ValueError("shared memory holds no published dictionary")
+    shared._shared_memory = block
+    return shared
+
+
+class _Interner(object):
+    """Assigns small integer ids to hashable objects, reusing the ids
+    of released objects so that ids stay dense.
+
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.objects = []
+        self._free_ids = []
+
+
+    def intern(self, obj):
+        """Returns the id of the object, assigning one if needed."""
+        obj_id = self.ids.get(obj)
+        if obj_id is None:
+            if self._free_ids:
+                obj_id = self._free_ids.pop()
+                self.objects[obj_id] = obj
+            else:
+                obj_id = len(self.objects)
+                self.objects.append(obj)
+            self.ids[obj] = obj_id
+        return obj_id
+
+
+    def release(self, obj):
+        """Frees the id of the object for reuse."""
+        obj_id = self.ids.pop(obj)
+        self.objects[obj_id] = None
+        self._free_ids.append(obj_id)
+
+
+    def clear(self):
+        self.ids.clear()
+        del self.objects[:]
+        del self._free_ids[:]
+
+
+def _iter_bits(bits):
+    """Yields the positions of the set bits of a non-negative integer,
+    from lowest to highest.
+
+    """
+    # Reverse the binary digits, less the '0b' prefix, so that string
+    # indices are bit positions.
+    digits = bin(bits)[:1:-1]
+    position = digits.find('1')
+    while position != -1:
+        yield position
+        position = digits.find('1', position + 1)
+
+
+def _bits_from_ids(ids):
+    """Returns an integer with the bits at the given positions set."""
+    ids = list(ids)
+    if not ids:
+        return 0
+    octets = bytearray((max(ids) >> 3) + 1)
+    for position in ids:
+        octets[position >> 3] |= 1 << (position & 7)
+    octets.reverse()
+    return int(binascii.hexlify(octets), 16)
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+
+# A _Bitmap splits each id into its high 16 bits, which pick a
+# container, and its low 16 bits, which the container holds. A container
+# holding at most _MAX_ARRAY_SIZE ids is a sorted array of them, and is
+# then no larger than a bitmap of all 65536 low ids would be (8 KiB);
+# a fuller container is a (bits, count) pair of such a bitmap, as a
+# Python integer, and the number of its set bits.
+_CONTAINER_SHIFT = 16
+_CONTAINER_MASK = (1 << _CONTAINER_SHIFT) - 1
+_MAX_ARRAY_SIZE = 4096
+
+
+def _make_container(lows):
+    """Returns a container of a sorted list of distinct low ids."""
+    if len(lows) > _MAX_ARRAY_SIZE:
+        return (_bits_from_ids(lows), len(lows))
+    return array('H', lows)
+
+
+def _container_from_bits(bits):
+    count = _popcount(bits)
+    if count > _MAX_ARRAY_SIZE:
+        return (bits, count)
+    return array('H', _iter_bits(bits))
+
+
+def _container_bits(container):
+    if isinstance(container, tuple):
+        return container[0]
+    return _bits_from_ids(container)
+
+
+def _container_len(container):
+    if isinstance(container, tuple):
+        return container[1]
+    return len(container)
+
+
+def _copy_container(container):
+    if isinstance(container, tuple):
+        return container
+    return array('H', container)
+
+
+def _container_lows(container):
+    if isinstance(container, tuple):
+        return _iter_bits(container[0])
+    return container
+
+
+def _containers_and(first, second):
+    if isinstance(first, tuple) or isinstance(second, tuple):
+        return _container_from_bits(
+                _container_bits(first) & _container_bits(second))
+    return array('H', sorted(set(first).intersection(second)))
+
+
+def _containers_or(first, second):
+    if isinstance(first, tuple) or isinstance(second, tuple):
+        return _container_from_bits(
+                _container_bits(first) | _container_bits(second))
+    return _make_container(sorted(set(first).union(second)))
+
+
+def _containers_and_not(first, second):
+    if isinstance(first, tuple) or isinstance(second, tuple):
+        return _container_from_bits(
+                _container_bits(first) & ~_container_bits(second))
+    return array('H', sorted(set(first).difference(second)))
+
+
+class _Bitmap(object):
+    """A compressed set of non-negative integer ids, in the manner of a
+    roaring bitmap.
+
+    Ids are grouped by their high bits into containers, each of which
+    is a sorted array while sparse, and a bitmap once dense, so that
+    the bitmap takes space proportional to the number of ids it holds
+    rather than to the largest of them.
+
+    """
+    __slots__ = ('_highs', '_containers')
+
+    def __init__(self, ids=()):
+        """
+        :param ids: an iterable of non-negative integers
+
+        """
+        highs = []
+        containers = []
+        ids = sorted(set(ids))
+        shift = _CONTAINER_SHIFT
+        mask = _CONTAINER_MASK
+        for high, group in itertools.groupby(ids, lambda i: i >> shift):
+            highs.append(high)
+            containers.append(_make_container([i & mask for i in group]))
+        # Copying the lists drops the room left for appending to them.
+        self._highs = list(highs)
+        self._containers = list(containers)
+
+
+    @classmethod
+    def _from_containers(cls, highs, containers):
+        """Returns a bitmap of the given containers, less any empty
+        ones.
+
+        """
+        bitmap = cls()
+        nonempty = [i for (i, container) in enumerate(containers) if
+                    _container_len(container)]
+        bitmap._highs = [highs[i] for i in nonempty]
+        bitmap._containers = [containers[i] for i in nonempty]
+        return bitmap
+
+
+    def _find(self, high):
+        """Returns the index of the container for the high bits, or
+        ``None`` if there is none.
+
+        """
+        highs = self._highs
+        index = bisect.bisect_left(highs, high)
+        if index < len(highs) and highs[index] == high:
+            return index
+        return None
+
+
+    def __contains__(self, i):
+        index = self._find(i >> _CONTAINER_SHIFT)
+        if index is None:
+            return False
+        container = self._containers[index]
+        low = i & _CONTAINER_MASK
+        if isinstance(container, tuple):
+            return bool(container[0] >> low & 1)
+        position = bisect.bisect_left(container, low)
+        return position < len(container) and container[position] == low
+
+
+    def __iter__(self):
+        shift = _CONTAINER_SHIFT
+        for high, container in zip(self._highs, self._containers):
+            base = high << shift
+            for low in _container_lows(container):
+                yield base + low
+
+
+    def __len__(self):
+        return sum(_container_len(container) for container in
+                   self._containers)
+
+
+    def __nonzero__(self):
+        return bool(self._highs)
+
+
+    def add(self, i):
+        """Adds the id, returning ``True`` if it was not already
+        present.
+
+        """
+        high = i >> _CONTAINER_SHIFT
+        low = i & _CONTAINER_MASK
+        index = self._find(high)
+        if index is None:
+            index = bisect.bisect_left(self._highs, high)
+            self._highs.insert(index, high)
+            self._containers.insert(index, array('H', [low]))
+            return True
+        container = self._containers[index]
+        if isinstance(container, tuple):
+            bits, count = container
+            if bits >> low & 1:
+                return False
+            self._containers[index] = (bits | 1 << low, count + 1)
+            return True
+        position = bisect.bisect_left(container, low)
+        if position < len(container) and container[position] == low:
+            return False
+        container.insert(position, low)
+        if len(container) > _MAX_ARRAY_SIZE:
+            self._containers[index] = (_bits_from_ids(container),
+                                       len(container))
+        return True
+
+
+    def discard(self, i):
+        """Removes the id, returning ``True`` if it was present."""
+        index = self._find(i >> _CONTAINER_SHIFT)
+        if index is None:
+            return False
+        container = self._containers[index]
+        low = i & _CONTAINER_MASK
+        if isinstance(container, tuple):
+            bits, count = container
+            if not bits >> low & 1:
+                return False
+            bits &= ~(1 << low)
+            count -= 1
+            if count > _MAX_ARRAY_SIZE:
+                self._containers[index] = (bits, count)
+            else:
+                self._containers[index] = array('H', _iter_bits(bits))
+            return True
+        position = bisect.bisect_left(container, low)
+        if position == len(container) or container[position] != low:
+            return False
+        del container[position]
+        if not container:
+            del self._highs[index]
+            del self._containers[index]
+        return True
+
+
+    def copy(self):
+        bitmap = _Bitmap()
+        bitmap._highs = list(self._highs)
+        bitmap._containers = [_copy_container(container) for container
+                              in self._containers]
+        return bitmap
+
+
+    def __and__(self, other):
+        highs = []
+        containers = []
+        other_containers = dict(zip(other._highs, other._containers))
+        for high, container in zip(self._highs, self._containers):
+            other_container = other_containers.get(high)
+            if other_container is not None:
+                highs.append(high)
+                containers.append(
+                        _containers_and(container, other_container))
+        return _Bitmap._from_containers(highs, containers)
+
+
+    def __or__(self, other):
+        merged = dict(zip(other._highs, other._containers))
+        for high, container in zip(self._highs, self._containers):
+            other_container = merged.get(high)
+            if other_container is None:
+                merged[high] = container
+            else:
+                merged[high] = _containers_or(container, other_container)
+        highs = sorted(merged)
+        return _Bitmap._from_containers(
+                highs, [_copy_container(merged[high]) for high in highs])
+
+
+    def __sub__(self, other):
+        highs = []
+        containers = []
+        other_containers = dict(zip(other._highs, other._containers))
+        for high, container in zip(self._highs, self._containers):
+            other_container = other_containers.get(high)
+            if other_container is None:
+                container = _copy_container(container)
+            else:
+                container = _containers_and_not(container, other_container)
+            highs.append(high)
+            containers.append(container)
+        return _Bitmap._from_containers(highs, containers)
+
+
+class BitsetTwoWaySetDict(MutableMapping):
+    """A :class:`TwoWaySetDict` which stores its memberships, in both
+    directions, as compressed bitmaps.
+
+    Keys and items are each interned to small integer ids. Each key's
+    set of items, and each item's set of keys, is stored as a
+    roaring-style bitmap of the ids of its members: the ids are grouped
+    into containers of 65536, each kept as a sorted array of 16-bit ids
+    while sparse and as a bitmap once dense. A membership thus takes
+    about two bytes in each direction for sparse sets, such as those of
+    gene annotations, and about a bit in each direction for dense ones.
+    Membership tests and set algebra between keys work container by
+    container. The ids of deleted keys and removed items are reused,
+    keeping the ids dense.
+
+    Values are given as :class:`frozenset` instances built from the
+    bitmaps; change them with :meth:`add_item`, :meth:`remove_item`, or
+    by assigning a new set.
+
+    """
+
+    def __init__(self, items=None, **kwargs):
+        """
+        :param items: an iterable of pairs of keys and values; values
+            should be :class:`set` or :class:`frozenset` instances
+
+        """
+        if items is None:
+            items = []
+        self._keys = _Interner()
+        self._items = _Interner()
+        # Maps keys to bitmaps of item ids.
+        self._store = {}
+        # Maps items to bitmaps of key ids.
+        self._reverse_store = {}
+        for key, value in dict(items, **kwargs).iteritems():
+            self[key] = value
+
+
+    def _decode_items(self, bitmap):
+        items = self._items.objects
+        return frozenset(items[item_id] for item_id in bitmap)
+
+
+    def _decode_keys(self, bitmap):
+        keys = self._keys.objects
+        return frozenset(keys[key_id] for key_id in bitmap)
+
+
+    def _add_reverse_id(self, item, key_id):
+        try:
+            self._reverse_store[item].add(key_id)
+        except KeyError:
+            self._reverse_store[item] = _Bitmap([key_id])
+
+
+    def _discard_reverse_id(self, item, key_id):
+        """Removes the key's id from the item's bitmap, releasing the
+        item if it belongs to no more keys.
+
+        """
+        key_ids = self._reverse_store[item]
+        key_ids.discard(key_id)
+        if not key_ids:
+            del self._reverse_store[item]
+            self._items.release(item)
+
+
+    def __contains__(self, key):
+        return key in self._store
+
+
+    def __getitem__(self, key):
+        return self._decode_items(self._store[key])
+
+
+    def __setitem__(self, key, value):
+        if not isinstance(value, Set):
+            raise ValueError("value should be an instance of set")
+        key_id = self._keys.intern(key)
+        intern_item = self._items.intern
+        new_ids = _Bitmap(intern_item(item) for item in value)
+        old_ids = self._store.get(key)
+        self._store[key] = new_ids
+        items = self._items.objects
+        if old_ids is None:
+            added = new_ids
+        else:
+            added = new_ids - old_ids
+            for item_id in old_ids - new_ids:
+                self._discard_reverse_id(items[item_id], key_id)
+        for item_id in added:
+            self._add_reverse_id(items[item_id], key_id)
+
+
+    def __delitem__(self, key):
+        item_ids = self._store.pop(key)
+        key_id = self._keys.ids[key]
+        items = self._items.objects
+        for item_id in item_ids:
+            self._discard_reverse_id(items[item_id], key_id)
+        self._keys.release(key)
+
+
+    def __iter__(self):
+        return iter(self._store)
+
+
+    def __len__(self):
+        return len(self._store)
+
+
+    def copy(self):
+        """Return a shallow copy."""
+        return self.__class__(self)
+
+
+    def clear(self):
+        self._reverse_store.clear()
+        self._store.clear()
+        self._keys.clear()
+        self._items.clear()
+
+
+    def reverse_keys(self):
+        """Returns a list of the items in the value sets."""
+        return self._reverse_store.keys()
+
+
+    def reverse_iterkeys(self):
+        """Returns an iterable of the items in the value sets."""
+        return self._reverse_store.iterkeys()
+
+
+    def reverse_values(self):
+        """Returns a list of the sets of keys to which each item
+        belongs.
+
+        """
+        return list(self.reverse_itervalues())
+
+
+    def reverse_itervalues(self):
+        """Returns an iterable of the sets of keys to which each item
+        belongs.
+
+        """
+        for key_ids in self._reverse_store.itervalues():
+            yield self._decode_keys(key_ids)
+
+
+    def reverse_items(self):
+        """Returns a list of tuples for reverse key and value pairs."""
+        return list(self.reverse_iteritems())
+
+
+    def reverse_iteritems(self):
+        """Yields individual key-value pairs for the reversed items."""
+        for item, key_ids in self._reverse_store.iteritems():
+            yield (item, self._decode_keys(key_ids))
+
+
+    def has_item(self, item):
+        """Returns ``True`` if the item is among the sets in the
+        dictionary's values, or ``False`` if it is not.
+
+        :param item: an item that may be among the sets in the
+          dictionary's values
+
+        """
+        return item in self._reverse_store
+
+
+    def item_has_key(self, item, key):
+        """Returns ``True`` if the item is in the set belonging to the
+        key, or ``False`` if it is not.
+
+        Raises a ``KeyError`` if the item is not present in any of the
+        values.
+
+        :param item: an item in one of the value sets
+        :param key: a key of the dictionary
+
+        """
+        key_ids = self._reverse_store[item]
+        key_id = self._keys.ids.get(key)
+        if key_id is None:
+            return False
+        return key_id in key_ids
+
+
+    def get_item_keys(self, item):
+        """Returns a ``frozenset`` of all keys whose sets the item is
+        present in.
+
+        Raises a ``KeyError`` if the item is not present in any of the
+        values.
+
+        :param item: an item in one of the value sets
+
+        """
+        return self._decode_keys(self._reverse_store[item])
+
+
+    def add_item(self, key, item):
+        """Adds an item to the set belonging to the key.
+
+        Raises a ``KeyError`` if the key does not exist.
+
+        :param key: a key in the main dictionary
+        :param item: an item to be added to the set belonging to the key
+
+        """
+        item_ids = self._store[key]
+        if item_ids.add(self._items.intern(item)):
+            self._add_reverse_id(item, self._keys.ids[key])
+
+
+    def remove_item(self, key, item):
+        """Removes an item from the set belonging to the key.
+
+        Raises a ``KeyError`` if the key does not exist, or if the item
+        is not present in the set belonging to the key.
+
+        :param key: a key in the main dictionary
+        :param item: an item to be removed from the set belonging to the
+          key
+
+        """
+        item_ids = self._store[key]
+        item_id = self._items.ids.get(item)
+        if item_id is None or not item_ids.discard(item_id):
+            raise KeyError(item)
+        self._discard_reverse_id(item, self._keys.ids[key])
+
+
+    def remove_item_from_all_keys(self, item):
+        """Removes an item from all sets in the main dictionary to
+        which it belongs.
+
+        Raises a ``KeyError`` if the item is not present in any of the
+        values.
+
+        :param item: an item to be removed from all sets of values
+
+        """
+        key_ids = self._reverse_store.pop(item)
+        item_id = self._items.ids[item]
+        keys = self._keys.objects
+        for key_id in key_ids:
+            self._store[keys[key_id]].discard(item_id)
+        self._items.release(item)
+
+
+    def _key_bitmaps(self, keys):
+        return [self._store[key] for key in keys]
+
+
+    def key_intersection(self, *keys):
+        """Returns a ``frozenset`` of the items in the sets of all the
+        given keys.
+
+        Raises a ``KeyError`` if any key does not exist.
+
+        """
+        bitmaps = self._key_bitmaps(keys)
+        if not bitmaps:
+            return frozenset()
+        # Intersecting the smallest sets first keeps the intermediate
+        # results small.
+        bitmaps.sort(key=len)
+        result = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            result &= bitmap
+        return self._decode_items(result)
+
+
+    def key_union(self, *keys):
+        """Returns a ``frozenset`` of the items in the set of any of the
+        given keys.
+
+        Raises a ``KeyError`` if any key does not exist.
+
+        """
+        result = _Bitmap()
+        for bitmap in self._key_bitmaps(keys):
+            result |= bitmap
+        return self._decode_items(result)
+
+
+    def key_difference(self, key, *others):
+        """Returns a ``frozenset`` of the items in the set of the key
+        but not in the sets of any of the other keys.
+
+        Raises a ``KeyError`` if any key does not exist.
+
+        """
+        result = self._store[key]
+        for bitmap in self._key_bitmaps(others):
+            result -= bitmap
+        return self._decode_items(result)
+
+
+    def key_overlap(self, key, other):
+        """Returns the number of items the sets of both keys share.
+
+        Raises a ``KeyError`` if either key does not exist.
+
+        """
+        return len(self._store[key] & self._store[other])
+
+
+_SQLITE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS keys (key BLOB PRIMARY KEY)",
+    "CREATE TABLE IF NOT EXISTS memberships ("
+    "key BLOB NOT NULL, item BLOB NOT NULL, PRIMARY KEY (key, item))",
+    "CREATE INDEX IF NOT EXISTS memberships_by_item "
+    "ON memberships (item, key)",
+)
+
+
+def _dump_blob(obj):
+    """Pickles an object as a blob.
+
+    The pickler's memo is disabled, so that equal objects always have
+    equal blobs, whether or not their parts are shared objects.
+
+    """
+    fileh = io.BytesIO()
+    pickler = pickle.Pickler(fileh, _PICKLE_PROTOCOL)
+    pickler.fast = True
+    pickler.dump(obj)
+    return sqlite3.Binary(fileh.getvalue())
 
 
-    def __iter__(self):
-        return iter(self._store)
+def _load_blob(blob):
+    return pickle.loads(bytes(blob))
 
 
-    def __len__(self):
-        return len(self._store)
+class SqliteTwoWaySetDict(MutableMapping):
+    """A :class:`TwoWaySetDict` which keeps its memberships, in both
+    directions, in an SQLite database, for dictionaries too large to
+    hold in memory.
 
+    Each membership of an item in a key's set is a row of a table
+    indexed both by key and by item, so lookups in either direction
+    read only the rows they need. Keys and items are stored pickled,
+    without the pickler's memo, and so must pickle identically whenever
+    they are equal (as, e.g., strings, integers, and tuples of these
+    do); keys and items may not contain cycles.
 
-class TwoWaySetDict(MutableMapping):
-    """A dictionary that has sets as values, and allows looking up the
-    key of any item that is in at least one set within the values.
+    The sets of recently used keys are kept in a bounded cache with
+    CLOCK eviction. Values are given as :class:`frozenset` instances;
+    change them with :meth:`add_item`, :meth:`remove_item`, or by
+    assigning a new set. A cached set is thawed into a :class:`set` by
+    its first change and then changed in place, and frozen again when
+    next looked up, so a run of changes to a key costs constant time
+    each however large its set.
+
+    Changes are made in a transaction, which is committed every
+    ``batch_size`` changes, by :meth:`flush`, and by :meth:`close`;
+    changes not yet committed are lost if the process ends without
+    calling either.
 
     """
 
-    def __init__(self, items=None, **kwargs):
+    def __init__(self, path, items=None, cache_size=4096,
+                 batch_size=10000, **kwargs):
         """
+        :param path: the path of the database file, which is created if
+            it does not exist; ``':memory:'`` keeps the database in
+            memory
         :param items: an iterable of pairs of keys and values; values
-            should be :class:`set` instances
+            should be :class:`set` or :class:`frozenset` instances
+        :param cache_size: the maximum number of sets to cache
+        :param batch_size: the number of changes after which to commit
+            the transaction
 
         """
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer")
+        self._connection = sqlite3.connect(path)
+        for statement in _SQLITE_SCHEMA:
+            self._connection.execute(statement)
+        self._connection.commit()
+        self._cache = _ClockCache(cache_size)
+        self.batch_size = batch_size
+        self._pending = 0
         if items is None:
             items = []
-        self._store = dict(items, **kwargs)
+        self.update(items, **kwargs)
 
-        self._reverse_store = {}
-        for key, value in self._store.iteritems():
-            if not isinstance(value, set):
-                raise ValueError(
-                        "Value %(value)s is not an instance "
-                        "of set in pair ({key}, {value})".format(
-                        key=key, value=value)
-                )
-            for item in value:
-                self._add_reverse_mapping(key, item)
 
+    def _execute(self, statement, *parameters):
+        return self._connection.execute(statement, parameters)
 
-    def _add_reverse_mapping(self, key, value_item):
-        try:
-            self._reverse_store[value_item].add(key)
-        except KeyError:
-            self._reverse_store[value_item] = set([key])
 
+    def _changed(self, num_changes=1):
+        """Records changes, committing the transaction once a batch's
+        worth have been made.
 
-    def __getitem__(self, key):
-        return self._store[key]
+        """
+        self._pending += num_changes
+        if self._pending >= self.batch_size:
+            self.flush()
 
 
-    def __setitem__(self, key, value):
-        if not isinstance(value, set):
-            raise ValueError("value should be an instance of set")
+    def _has_encoded_key(self, encoded_key):
+        return self._execute(
+                "SELECT 1 FROM keys WHERE key = ?", encoded_key
+        ).fetchone() is not None
 
-        if key in self:
-            # remove the old reverse mappings
-            for item in self[key]:
-                if item not in value:
-                    self._remove_reverse_mapping(item, key)
 
-        for item in value:
-            self._add_reverse_mapping(key, item)
+    def _encoded_key_or_error(self, key):
+        """Returns the encoded key, raising a ``KeyError`` if the key
+        does not exist.
 
-        self._store[key] = value
+        """
+        encoded_key = _dump_blob(key)
+        if key not in self._cache and not self._has_encoded_key(
+                encoded_key):
+            raise KeyError(key)
+        return encoded_key
 
 
-    def __delitem__(self, key):
-        value = self[key]
-        for item in value:
-            self._remove_reverse_mapping(item, key)
-        del self._store[key]
+    def _item_keys(self, encoded_item):
+        return frozenset(_load_blob(row[0]) for row in self._execute(
+                "SELECT key FROM memberships WHERE item = ?",
+                encoded_item
+        ))
 
 
-    def _remove_reverse_mapping(self, reverse_key, key):
-        """Removes the reverse key to key mapping from the reverse
-        dictionary, removing the reverse key from the reverse dictionary
-        if it no longer maps to any keys.
+    def __contains__(self, key):
+        if key in self._cache:
+            return True
+        return self._has_encoded_key(_dump_blob(key))
+
+
+    def __getitem__(self, key):
+        value = self._cache.get(key)
+        if value is None:
+            encoded_key = _dump_blob(key)
+            if not self._has_encoded_key(encoded_key):
+                raise KeyError(key)
+            value = frozenset(_load_blob(row[0]) for row in self._execute(
+                    "SELECT item FROM memberships WHERE key = ?",
+                    encoded_key
+            ))
+            self._cache[key] = value
+        elif not isinstance(value, frozenset):
+            # Changed in place since last looked up; see
+            # _changeable_cached_value().
+            value = frozenset(value)
+            self._cache[key] = value
+        return value
+
+
+    def _changeable_cached_value(self, key):
+        """Returns the cached set of the key as a :class:`set` to be
+        changed in place, thawing a cached :class:`frozenset`, or
+        ``None`` if the key's set is not cached.
 
         """
-        self._reverse_store[reverse_key].remove(key)
-        if not self._reverse_store[reverse_key]:
-            del self._reverse_store[reverse_key]
+        value = self._cache.peek(key)
+        if isinstance(value, frozenset):
+            value = set(value)
+            self._cache[key] = value
+        return value
+
+
+    def __setitem__(self, key, value):
+        if not isinstance(value, Set):
+            raise ValueError("value should be an instance of set")
+        value = frozenset(value)
+        encoded_key = _dump_blob(key)
+        self._execute("INSERT OR IGNORE INTO keys VALUES (?)", encoded_key)
+        self._execute(
+                "DELETE FROM memberships WHERE key = ?", encoded_key)
+        self._connection.executemany(
+                "INSERT INTO memberships VALUES (?, ?)",
+                ((encoded_key, _dump_blob(item)) for item in value)
+        )
+        self._cache[key] = value
+        self._changed(len(value) + 1)
+
+
+    def __delitem__(self, key):
+        encoded_key = self._encoded_key_or_error(key)
+        self._execute(
+                "DELETE FROM memberships WHERE key = ?", encoded_key)
+        self._execute("DELETE FROM keys WHERE key = ?", encoded_key)
+        self._cache.pop(key)
+        self._changed()
 
 
     def __iter__(self):
-        return iter(self._store)
+        for row in self._execute("SELECT key FROM keys"):
+            yield _load_blob(row[0])
 
 
     def __len__(self):
-        return len(self._store)
+        return self._execute("SELECT COUNT(*) FROM keys").fetchone()[0]
 
 
-    def copy(self):
-        """Return a shallow copy."""
-        return self.__class__(self)
+    def clear(self):
+        self._execute("DELETE FROM memberships")
+        self._execute("DELETE FROM keys")
+        self._cache.clear()
+        self._changed()
 
 
-    def clear(self):
-        self._reverse_store.clear()
-        self._store.clear()
+    def flush(self):
+        """Commits the changes made since the last commit."""
+        self._connection.commit()
+        self._pending = 0
 
 
-    def reverse_keys(self):
-        """Returns a list of the keys of the reverse dictionary.
+    def close(self):
+        """Commits any outstanding changes and closes the database."""
+        self.flush()
+        self._connection.close()
 
-        These items are the items in the value sets of the main
-        dictionary.
+
+    def cache_info(self):
+        """Returns a :class:`CacheInfo` named tuple with the hits,
+        misses, maximum size, and current size of the cache of sets.
 
         """
-        return self._reverse_store.keys()
+        return self._cache.info()
 
 
-    def reverse_iterkeys(self):
-        """Returns an iterable of the keys of the reverse dictionary.
+    def reverse_keys(self):
+        """Returns a list of the items in the value sets."""
+        return list(self.reverse_iterkeys())
 
-        These items are the items in the value sets of the main
-        dictionary.
 
-        """
-        return self._reverse_store.iterkeys()
+    def reverse_iterkeys(self):
+        """Returns an iterable of the items in the value sets."""
+        for row in self._execute(
+                "SELECT DISTINCT item FROM memberships ORDER BY item"):
+            yield _load_blob(row[0])
 
 
     def reverse_values(self):
-        """Returns a list of the values of the reverse dictionary.
-
-        These values are sets of the keys in the main dictionary.
+        """Returns a list of the sets of keys to which each item
+        belongs.
 
         """
-        return self._reverse_store.values()
+        return list(self.reverse_itervalues())
 
 
     def reverse_itervalues(self):
-        """Returns an iterable of the values of the reverse dictionary.
-
-        These values are sets of the keys in the main dictionary.
+        """Returns an iterable of the sets of keys to which each item
+        belongs.
 
         """
-        return self._reverse_store.itervalues()
+        for item, keys in self.reverse_iteritems():
+            yield keys
 
 
     def reverse_items(self):
-        """Returns a list of tuples for reverse key and value pairs.
-
-        """
-        return self._reverse_store.items()
+        """Returns a list of tuples for reverse key and value pairs."""
+        return list(self.reverse_iteritems())
 
 
     def reverse_iteritems(self):
         """Yields individual key-value pairs for the reversed items.
 
+        The memberships are read in order of item, so only one item's
+        keys are held in memory at a time.
+
         """
-        return self._reverse_store.iteritems()
+        rows = self._execute(
+                "SELECT item, key FROM memberships ORDER BY item")
+        for encoded_item, item_rows in itertools.groupby(
+                rows, lambda row: bytes(row[0])):
+            yield (
+                _load_blob(encoded_item),
+                frozenset(_load_blob(row[1]) for row in item_rows)
+            )
 
 
     def has_item(self, item):
-        """Performs a reverse-lookup to see if an item exists among the
-        sets in the dictionary's values.
-
-        Returns ``True`` if the item is among the values, or ``False``
-        if the item is not.
+        """Returns ``True`` if the item is among the sets in the
+        dictionary's values, or ``False`` if it is not.
 
-        :param item: an item that may be among the ``set``s in the
-          main dictionary's values
+        :param item: an item that may be among the sets in the
+          dictionary's values
 
         """
-        if item in self._reverse_store:
-            return True
-        else:
-            return False
+        return self._execute(
+                "SELECT 1 FROM memberships WHERE item = ? LIMIT 1",
+                _dump_blob(item)
+        ).fetchone() is not None
 
 
     def item_has_key(self, item, key):
-        """See if an item in the values of the dictionary has a reverse
-        mapping to an item.
+        """Returns ``True`` if the item is in the set belonging to the
+        key, or ``False`` if it is not.
 
         Raises a ``KeyError`` if the item is not present in any of the
         values.
 
-        Returns True if the item has a reverse mapping to the key, or
-        False if the item has no reverse mapping to the key.
-
         :param item: an item in one of the value sets
         :param key: a key of the dictionary
 
         """
-        if key in self._reverse_store[item]:
-            return True
-        else:
-            return False
+        if not self.has_item(item):
+            raise KeyError(item)
+        return self._execute(
+                "SELECT 1 FROM memberships WHERE key = ? AND item = ?",
+                _dump_blob(key),
+                _dump_blob(item)
+        ).fetchone() is not None
 
 
     def get_item_keys(self, item):
-        """Returns a ``set`` of all keys whose ``set`` values the item
-        is present in.
+        """Returns a ``frozenset`` of all keys whose sets the item is
+        present in.
 
         Raises a ``KeyError`` if the item is not present in any of the
         values.
@@ -255,11 +5126,14 @@ class TwoWaySetDict(MutableMapping):
         :param item: an item in one of the value sets
 
         """
-        return self._reverse_store[item]
+        keys = self._item_keys(_dump_blob(item))
+        if not keys:
+            raise KeyError(item)
+        return keys
 
 
     def add_item(self, key, item):
-        """Adds a item to the set belonging to the key.
+        """Adds an item to the set belonging to the key.
 
         Raises a ``KeyError`` if the key does not exist.
 
@@ -267,11 +5141,16 @@ class TwoWaySetDict(MutableMapping):
         :param item: an item to be added to the set belonging to the key
 
         """
-        self[key].add(item)
-        try:
-            self._reverse_store[item].add(key)
-        except KeyError:
-            self._reverse_store[item] = set([key])
+        encoded_key = self._encoded_key_or_error(key)
+        self._execute(
+                "INSERT OR IGNORE INTO memberships VALUES (?, ?)",
+                encoded_key,
+                _dump_blob(item)
+        )
+        value = self._changeable_cached_value(key)
+        if value is not None:
+            value.add(item)
+        self._changed()
 
 
     def remove_item(self, key, item):
@@ -285,13 +5164,23 @@ class TwoWaySetDict(MutableMapping):
           key
 
         """
-        self[key].remove(item)
-        self._remove_reverse_mapping(item, key)
+        encoded_key = self._encoded_key_or_error(key)
+        cursor = self._execute(
+                "DELETE FROM memberships WHERE key = ? AND item = ?",
+                encoded_key,
+                _dump_blob(item)
+        )
+        if not cursor.rowcount:
+            raise KeyError(item)
+        value = self._changeable_cached_value(key)
+        if value is not None:
+            value.discard(item)
+        self._changed()
 
 
     def remove_item_from_all_keys(self, item):
-        """Removes an item from all ``set`` values in the main
-        dictionary to which it belongs.
+        """Removes an item from all sets in the main dictionary to
+        which it belongs.
 
         Raises a ``KeyError`` if the item is not present in any of the
         values.
@@ -299,17 +5188,15 @@ class TwoWaySetDict(MutableMapping):
         :param item: an item to be removed from all sets of values
 
         """
-        for key in self._reverse_store[item]:
-            self[key].remove(item)
-        del self._reverse_store[item]
-
-
-    # TODO: implement the following
-    #def pop(self):
-    #def popitem(self):
-    #def reverse_pop(self):
-    #def reverse_popitem(self):
-    #def update(self, *other):
+        encoded_item = _dump_blob(item)
+        keys = self._item_keys(encoded_item)
+        if not keys:
+            raise KeyError(item)
+        self._execute(
+                "DELETE FROM memberships WHERE item = ?", encoded_item)
+        for key in keys:
+            self._cache.pop(key)
+        self._changed(len(keys))
 
 
 def sample_list_dict(d, k):
@@ -341,7 +5228,8 @@ def sample_list_dict_low_mem(d, k):
     of sub-elements uniformly at random.
 
     Consumes less memory than :func:`dict_list_random_sample` for large
-    dictionaries.
+    dictionaries. To draw several samples from the same dictionary,
+    build a :class:`SampleIndex` once instead.
 
     :param d: a dictionary whose values are lists or other enumerable,
         iterable types
@@ -349,41 +5237,540 @@ def sample_list_dict_low_mem(d, k):
     :returns: a dictionary with the given number of sub-elements
 
     """
-    # Let's say our data structure is
-    #     d = {
-    #         'key1': [1, 5, 9],
-    #         'key2': [6, 42],
-    #         'key3': [7, 9001]
-    #     }
-    #
-    # Conceptually, we will be flattening this data structure to
-    # something like
-    #
-    #     [('key1', 1), ('key1', 5), ('key1', 9), ('key2', 6),
-    #      ('key2', 42), ('key3', 7), ('key3', 9001)]
-    #
-    # but we are retaining the data structure as is and instead
-    # flattening the index into it.
-
-    # Change d.keys() to list(d.keys()) in Python 3.
-    keys = d.keys()                 # keys == ['key1', 'key2', 'key3']
-    cum_index_bins = list(cumsum(len(v) for v in d.values()))
-    # We'll shift all the indices over by one so that we can pull a
-    # subtraction trick below to get the sub-index.
-    cum_index_bins.insert(0, 0)     # cum_index_bins == [0, 3, 5, 7]
-
-    total_num_elements = cum_index_bins[-1]     # total_num_elements == 7
-    sampled_indices = random.sample(range(total_num_elements), k)
-    sampled_d = defaultdict(list)
-    for index in sampled_indices:
-        # say index == 3 (the fourth item, ('key2', 6) in this case)
-        cum_index = bisect.bisect(cum_index_bins, index)    # cum_index == 2
-        key_index = cum_index - 1   # key_index == 1
-        key = keys[key_index]       # key == 'key2'
-        # A trick to get the index into the list of d at that key.
-        value_index = (index - cum_index_bins[key_index])   # value_index == (3 - 3) = 0
-        actual_value = d[key][value_index]  # actual_value == 6
-        sampled_d[key].append(actual_value)
+    return SampleIndex(d).sample(k)
+
+
+class SampleIndex(object):
+    """An index of a dictionary with lists as values, for repeatedly
+    sampling its sub-elements uniformly at random.
+
+    The index holds the dictionary's keys and the cumulative lengths of
+    their lists, computed once, so that each sample costs time
+    depending on its size rather than on the size of the dictionary.
+
+    The index goes stale if the dictionary changes. Sampling raises a
+    ``RuntimeError`` if the dictionary has gained or lost keys, or if a
+    list sampled from has changed length; :meth:`is_stale` checks the
+    whole dictionary, and :meth:`refresh` rebuilds the index.
+
+    """
+
+    def __init__(self, d):
+        """
+        :param d: a dictionary whose values are lists or other
+            sequences
+
+        """
+        self._d = d
+        self.refresh()
+
+
+    def refresh(self):
+        """Rebuilds the index from the dictionary's current contents."""
+        # Let's say our data structure is
+        #     d = {
+        #         'key1': [1, 5, 9],
+        #         'key2': [6, 42],
+        #         'key3': [7, 9001]
+        #     }
+        #
+        # Conceptually, we will be flattening this data structure to
+        # something like
+        #
+        #     [('key1', 1), ('key1', 5), ('key1', 9), ('key2', 6),
+        #      ('key2', 42), ('key3', 7), ('key3', 9001)]
+        #
+        # but we are retaining the data structure as is and instead
+        # flattening the index into it.
+        d = self._d
+        self._keys = list(d)        # ['key1', 'key2', 'key3']
+        self._lengths = [len(d[key]) for key in self._keys]
+        cum_index_bins = list(cumsum(self._lengths))
+        # We'll shift all the indices over by one so that we can pull a
+        # subtraction trick below to get the sub-index.
+        cum_index_bins.insert(0, 0)     # [0, 3, 5, 7]
+        self._cum_index_bins = cum_index_bins
+
+
+    def __len__(self):
+        """Returns the total number of sub-elements indexed."""
+        return self._cum_index_bins[-1]
+
+
+    def is_stale(self):
+        """Returns ``True`` if the dictionary's keys or the lengths of
+        its lists have changed since the index was built, or ``False``
+        if they have not.
+
+        """
+        d = self._d
+        if len(d) != len(self._keys):
+            return True
+        for key, length in zip(self._keys, self._lengths):
+            if key not in d or len(d[key]) != length:
+                return True
+        return False
+
+
+    def _sample_from_indices(self, indices):
+        """Returns a dictionary of the sub-elements at the given
+        indices into the flattened dictionary.
+
+        :param indices: the indices, in ascending order
+
+        """
+        d = self._d
+        keys = self._keys
+        lengths = self._lengths
+        cum_index_bins = self._cum_index_bins
+        num_bins = len(cum_index_bins)
+        if len(d) != len(keys):
+            raise RuntimeError("dictionary changed size since the "
+                               "sample index was built")
+        sampled_d = {}
+        # Since the indices are sorted, they are resolved in a single
+        # walk forward through the bins. The walk gallops, doubling its
+        # stride until it passes the index, so that sparse indices skip
+        # over runs of keys rather than stepping through each one.
+        key_index = 0
+        values = sampled_values = None
+        for index in indices:
+            # say index == 3 (the fourth item, ('key2', 6) in this case)
+            if cum_index_bins[key_index + 1] <= index:
+                lo = key_index + 1
+                stride = 1
+                hi = lo + stride
+                while hi < num_bins and cum_index_bins[hi] <= index:
+                    lo = hi
+                    stride *= 2
+                    hi = lo + stride
+                key_index = bisect.bisect(
+                        cum_index_bins, index, lo, min(hi, num_bins)) - 1
+                values = None
+            if values is None:
+                key = keys[key_index]       # key == 'key2'
+                values = d.get(key)
+                if values is None or len(values) != lengths[key_index]:
+                    raise RuntimeError("dictionary changed since the "
+                                       "sample index was built")
+                sampled_values = sampled_d.setdefault(key, [])
+            # A trick to get the index into the list of d at that key.
+            value_index = index - cum_index_bins[key_index]  # 3 - 3 == 0
+            sampled_values.append(values[value_index])   # 6
+        return sampled_d
+
+
+    def sample(self, k):
+        """Samples a given number of sub-elements without replacement.
+
+        :param k: number of sub-elements in the returned dictionary
+        :returns: a dictionary with the given number of sub-elements
+
+        """
+        return self._sample_from_indices(
+                _sample_sorted_indices(len(self), k))
+
+
+    def sample_many(self, k, n):
+        """Draws several independent samples, each of a given number of
+        sub-elements without replacement.
+
+        :param k: number of sub-elements in each sample
+        :param n: number of samples
+        :returns: a list of ``n`` dictionaries, each with ``k``
+            sub-elements
+
+        """
+        return [self.sample(k) for i in xrange(n)]
+
+
+    def sample_with_replacement(self, k):
+        """Samples a given number of sub-elements with replacement, as
+        for bootstrapping; a sub-element may be drawn more than once.
+
+        :param k: number of sub-elements in the returned dictionary
+        :returns: a dictionary with the given number of sub-elements
+
+        """
+        total_num_elements = len(self)
+        if not total_num_elements and k:
+            raise ValueError("cannot sample from an empty dictionary")
+        randrange = random.randrange
+        indices = [randrange(total_num_elements) for i in xrange(k)]
+        indices.sort()
+        return self._sample_from_indices(indices)
+
+
+def _sample_sorted_indices(n, k):
+    """Samples ``k`` distinct integers from ``range(n)`` uniformly at
+    random, and returns them in ascending order.
+
+    Uses Floyd's algorithm, which takes time and memory proportional to
+    ``k`` however large ``n`` is.
+
+    """
+    if not 0 <= k <= n:
+        raise ValueError("sample larger than population")
+    randint = random.randint
+    selected = set()
+    for j in xrange(n - k, n):
+        t = randint(0, j)
+        if t in selected:
+            t = j
+        selected.add(t)
+    return sorted(selected)
+
+
+class _AliasTable(object):
+    """A table for drawing indices at random in proportion to their
+    weights, in constant time per draw, by Vose's alias method.
+
+    """
+
+    def __init__(self, weights):
+        """
+        :param weights: a sequence of non-negative weights, at least one
+            of them positive
+
+        """
+        n = len(weights)
+        total = float(sum(weights))
+        self.prob = prob = array('d', [1.0]) * n
+        self.alias = alias = array('L', xrange(n))
+        scaled = [weight * n / total for weight in weights]
+        small = [i for (i, p) in enumerate(scaled) if p < 1.0]
+        large = [i for (i, p) in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # Whatever remains has, up to rounding, a probability of 1, and
+        # keeps the default of always drawing itself.
+
+
+    def __len__(self):
+        return len(self.prob)
+
+
+    def draw(self):
+        """Draws an index at random in proportion to its weight."""
+        i = random.randrange(len(self.prob))
+        if random.random() < self.prob[i]:
+            return i
+        return self.alias[i]
+
+
+class WeightedSampleIndex(SampleIndex):
+    """An index of a dictionary with lists as values, for repeatedly
+    sampling its sub-elements at random in proportion to weights given
+    either to its keys or to its sub-elements.
+
+    A key's weight is split evenly among the sub-elements in its list.
+    With neither kind of weight, all sub-elements weigh the same.
+    Sub-elements of zero weight are never drawn.
+
+    The weights are read from the given mappings when the index is
+    built, and again on :meth:`refresh`. Sampling with replacement uses
+    an alias table, built once, to draw each sub-element in constant
+    time; sampling without replacement gives each sub-element a random
+    key weighted by its weight and keeps those with the largest keys
+    (Efraimidis and Spirakis's "A-Res"), which takes time proportional
+    to the number of sub-elements.
 
+    """
+
+    def __init__(self, d, key_weights=None, element_weights=None):
+        """
+        :param d: a dictionary whose values are lists or other
+            sequences
+        :param key_weights: a mapping from each key of ``d`` to its
+            weight
+        :param element_weights: a mapping from each key of ``d`` to a
+            sequence of the weights of the sub-elements in its list, in
+            the same order
+
+        """
+        if key_weights is not None and element_weights is not None:
+            raise ValueError("give either key_weights or "
+                             "element_weights, not both")
+        self._key_weights = key_weights
+        self._element_weights = element_weights
+        super(WeightedSampleIndex, self).__init__(d)
+
+
+    def refresh(self):
+        super(WeightedSampleIndex, self).refresh()
+        # With weights on the keys, the alias table is over the keys,
+        # and a sub-element is then drawn uniformly from the key's list;
+        # otherwise it is over the sub-elements, at their flattened
+        # indices.
+        if self._element_weights is not None:
+            weights = array('d')
+            for key, length in zip(self._keys, self._lengths):
+                key_element_weights = self._element_weights[key]
+                if len(key_element_weights) != length:
+                    raise ValueError("element weights of key {0!r} do "
+                                     "not match its list".format(key))
+                weights.extend(key_element_weights)
+            num_weighted = sum(1 for weight in weights if weight)
+        else:
+            if self._key_weights is not None:
+                weights = array(
+                        'd',
+                        (self._key_weights[key] if length else 0.0 for
+                         (key, length) in zip(self._keys, self._lengths))
+                )
+            else:
+                # Weighing each key by its length weighs every
+                # sub-element the same.
+                weights = array('d', self._lengths)
+            num_weighted = sum(
+                    length for (weight, length) in
+                    zip(weights, self._lengths) if weight
+            )
+        if any(weight < 0 for weight in weights):
+            raise ValueError("weights must not be negative")
+        self._weights = weights
+        self._num_weighted = num_weighted
+        self._alias_table = None
+
+
+    def _element_weights_iter(self):
+        """Iterates over the weight of every sub-element, in the order
+        of their flattened indices.
+
+        """
+        if self._element_weights is not None:
+            return iter(self._weights)
+        return itertools.chain.from_iterable(
+                itertools.repeat(float(weight) / length, length) for
+                (weight, length) in zip(self._weights, self._lengths) if
+                length
+        )
+
+
+    def sample(self, k):
+        """Samples a given number of sub-elements without replacement,
+        each with probability in proportion to its weight.
+
+        :param k: number of sub-elements in the returned dictionary
+        :returns: a dictionary with the given number of sub-elements
+
+        """
+        if not 0 <= k <= self._num_weighted:
+            raise ValueError("sample larger than population")
+        log = math.log
+        rand = _random_open_unit
+        weighted_keys = (
+                (log(rand()) / weight, index) for (index, weight) in
+                enumerate(self._element_weights_iter()) if weight
+        )
+        indices = [index for (weighted_key, index) in
+                   heapq.nlargest(k, weighted_keys)]
+        indices.sort()
+        return self._sample_from_indices(indices)
+
+
+    def sample_with_replacement(self, k):
+        """Samples a given number of sub-elements with replacement, each
+        with probability in proportion to its weight; a sub-element may
+        be drawn more than once.
+
+        :param k: number of sub-elements in the returned dictionary
+        :returns: a dictionary with the given number of sub-elements
+
+        """
+        if not self._num_weighted:
+            if k:
+                raise ValueError("cannot sample when no sub-element has "
+                                 "weight")
+            return {}
+        if self._alias_table is None:
+            self._alias_table = _AliasTable(self._weights)
+        draw = self._alias_table.draw
+        if self._element_weights is not None:
+            indices = [draw() for i in xrange(k)]
+        else:
+            cum_index_bins = self._cum_index_bins
+            lengths = self._lengths
+            randrange = random.randrange
+            indices = []
+            for i in xrange(k):
+                key_index = draw()
+                indices.append(cum_index_bins[key_index] +
+                               randrange(lengths[key_index]))
+        indices.sort()
+        return self._sample_from_indices(indices)
+
+
+def sample_list_dict_weighted(d, k, key_weights=None,
+                              element_weights=None, replace=False):
+    """Given a dictionary with lists as values, samples a given number
+    of sub-elements at random in proportion to weights given either to
+    its keys or to its sub-elements.
+
+    To draw several samples from the same dictionary, build a
+    :class:`WeightedSampleIndex` once instead.
+
+    :param d: a dictionary whose values are lists or other sequences
+    :param k: number of sub-elements in the returned dictionary
+    :param key_weights: a mapping from each key of ``d`` to its weight,
+        split evenly among the sub-elements in its list
+    :param element_weights: a mapping from each key of ``d`` to a
+        sequence of the weights of the sub-elements in its list
+    :param replace: whether to sample with replacement [default:
+        ``False``]
+    :returns: a dictionary with the given number of sub-elements
+
+    """
+    index = WeightedSampleIndex(d, key_weights, element_weights)
+    if replace:
+        return index.sample_with_replacement(k)
+    return index.sample(k)
+
+
+def sample_list_dict_numpy(d, k, seed=None):
+    """Given a dictionary with lists as values, samples a given number
+    of sub-elements uniformly at random, using NumPy to draw and locate
+    all the samples at once.
+
+    Suits drawing very many sub-elements (e.g., millions) from very
+    large dictionaries, for which it is much faster than
+    :func:`sample_list_dict_low_mem`. The sub-elements sampled from each
+    key are in the order in which they appear in the key's list.
+
+    Requires NumPy 1.17 or newer.
+
+    :param d: a dictionary whose values are lists or other sequences
+    :param k: number of sub-elements in the returned dictionary
+    :param seed: a seed for, or an instance of,
+        :class:`numpy.random.Generator`, from which to draw the sample
+        [default: seed from the operating system]
+    :returns: a dictionary with the given number of sub-elements
+
+    """
+    _require_numpy()
+    if not hasattr(numpy.random, 'default_rng'):
+        raise ImportError("this operation requires NumPy 1.17 or newer")
+    keys = list(d)
+    lengths = numpy.fromiter((len(d[key]) for key in keys),
+                             dtype=numpy.int64, count=len(keys))
+    # The index one past each key's last sub-element, as if the
+    # dictionary's values were flattened into one list.
+    ends = numpy.cumsum(lengths)
+    total_num_elements = int(ends[-1]) if len(ends) else 0
+    if not 0 <= k <= total_num_elements:
+        raise ValueError("sample larger than population")
+    rng = numpy.random.default_rng(seed)
+    sampled_indices = rng.choice(total_num_elements, size=k,
+                                 replace=False, shuffle=False)
+    # Once the sampled indices are sorted, those of each key form a
+    # run, whose bounds are found by locating the keys' ends among
+    # them, rather than locating every index among the keys.
+    sampled_indices.sort()
+    sample_ends = numpy.searchsorted(sampled_indices, ends).tolist()
+    starts = (ends - lengths).tolist()
+    sampled_indices = sampled_indices.tolist()
+    sampled_d = {}
+    sample_start = 0
+    for key, start, sample_end in zip(keys, starts, sample_ends):
+        if sample_end > sample_start:
+            values = d[key]
+            sampled_d[key] = [
+                    values[index - start] for index in
+                    sampled_indices[sample_start:sample_end]
+            ]
+            sample_start = sample_end
+    return sampled_d
+
+
+def _random_open_unit():
+    """Returns a random float in the open interval (0, 1)."""
+    u = random.random()
+    while not u:
+        u = random.random()
+    return u
+
+
+def reservoir_sample_records(records, k):
+    """Given an iterable of ``(key, element)`` records, samples a given
+    number of the records uniformly at random in a single pass, and
+    returns them grouped as a dictionary with lists as values.
+
+    Uses memory proportional only to ``k``, so it suits streams too
+    large to hold in memory, such as the rows of a two-column file read
+    with :func:`convutils.utils.make_simple_tsv_reader`. The sampled
+    elements of each key are in the order in which they were read.
+
+    Uses Li's "Algorithm L", which draws how many records to skip before
+    the next one to keep, rather than a random number for every record.
+
+    :param records: an iterable of ``(key, element)`` pairs
+    :param k: number of sub-elements in the returned dictionary
+    :returns: a dictionary with the given number of sub-elements
+
+    """
+    if k < 0:
+        raise ValueError("sample larger than population")
+    records = iter(records)
+    # Each entry is (position in the stream, key, element), so that the
+    # sample may be put back in stream order at the end.
+    reservoir = [
+            (position, key, element) for (position, (key, element)) in
+            zip(xrange(k), records)
+    ]
+    if len(reservoir) < k:
+        raise ValueError("sample larger than population")
+    position = k
+    log = math.log
+    exp = math.exp
+    w = exp(log(_random_open_unit()) / k) if k else 0.0
+    # Once w underflows to zero, no later record would be kept.
+    while w > 0.0:
+        # w may round to 1.0 when k is very large, in which case the
+        # very next record is kept.
+        if w < 1.0:
+            skip = int(log(_random_open_unit()) / math.log1p(-w))
+        else:
+            skip = 0
+        try:
+            key, element = next(itertools.islice(records, skip, None))
+        except StopIteration:
+            break
+        position += skip
+        reservoir[random.randrange(k)] = (position, key, element)
+        position += 1
+        w *= exp(log(_random_open_unit()) / k)
+    reservoir.sort(key=lambda entry: entry[0])
+    sampled_d = defaultdict(list)
+    for position, key, element in reservoir:
+        sampled_d[key].append(element)
     return dict(sampled_d)
 
+
+def reservoir_sample_groups(groups, k):
+    """Given an iterable of ``(key, elements)`` pairs, samples a given
+    number of sub-elements uniformly at random in a single pass.
+
+    Like :func:`sample_list_dict`, but the groups of elements may be
+    iterators, generated on the fly, and need not fit in memory; only
+    ``k`` sub-elements are held at a time. See
+    :func:`reservoir_sample_records`.
+
+    :param groups: an iterable of ``(key, elements)`` pairs, such as the
+        ``items()`` of a dictionary, where ``elements`` is any iterable
+    :param k: number of sub-elements in the returned dictionary
+    :returns: a dictionary with the given number of sub-elements
+
+    """
+    records = (
+            (key, element) for (key, elements) in groups for element in
+            elements
+    )
+    return reservoir_sample_records(records, k)
@@ -9,9 +9,23 @@
 
 """Tests for structs.py"""
 
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+import multiprocessing
+import os.path
+import pickle
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 try:
     from unittest.mock import call, MagicMock, patch
 except ImportError:
@@ -77,6 +91,709 @@ class TestSortedTupleKeysDict(unittest.TestCase):
         self.assertEqual(len(self.d), 3)
 
 
+    def test_pickle(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            unpickled = pickle.loads(pickle.dumps(self.d, protocol))
+            self.assertEqual(type(unpickled), type(self.d))
+            self.assertEqual(dict(unpickled.items()),
+                             dict(self.d.items()))
+            self.assertEqual(unpickled[('b', 'c')], 'spam')
+            unpickled[(3, 1)] = 'z'
+            self.assertEqual(unpickled[(1, 3)], 'z')
+
+
+    def test_pickle_keys_of_different_lengths(self):
+        d = self.d.__class__()
+        d.update([((3,), 'a'), ((2, 1), 'b'), ((6, 4, 5), 'c')])
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            unpickled = pickle.loads(pickle.dumps(d, protocol))
+            self.assertEqual(dict(unpickled.items()), dict(d.items()))
+            self.assertEqual(unpickled[(5, 6, 4)], 'c')
+
+
+@unittest.skipIf(structs.numpy is None, "NumPy is not installed")
+class TestSortedTupleKeysDictArrays(unittest.TestCase):
+    """Tests for the array methods of SortedTupleKeysDict"""
+
+    def setUp(self):
+        self.d = structs.SortedTupleKeysDict((
+            ((2, 1), 'x'),
+            ((3, 5), 'y'),
+            (('c', 'b'), 'spam')
+        ))
+
+
+    def test_get_many_numeric(self):
+        firsts = structs.numpy.array([1, 5, 7])
+        seconds = structs.numpy.array([2, 3, 8])
+        self.assertEqual(
+                self.d.get_many((firsts, seconds)),
+                ['x', 'y', None]
+        )
+
+
+    def test_get_many_strings_with_default(self):
+        result = self.d.get_many((['c', 'a'], ['b', 'b']), default=0)
+        self.assertEqual(result, ['spam', 0])
+
+
+    def test_set_many(self):
+        self.d.set_many(
+                ([2, 9], [1, 4]),
+                structs.numpy.array([1.5, 2.5])
+        )
+        self.assertEqual(self.d[(1, 2)], 1.5)
+        self.assertEqual(self.d[(9, 4)], 2.5)
+        self.assertEqual(len(self.d), 4)
+
+
+    def test_set_many_mismatched_lengths(self):
+        self.assertRaises(
+                ValueError,
+                self.d.set_many,
+                ([1, 2], [3]),
+                [1, 2]
+        )
+        self.assertRaises(
+                ValueError,
+                self.d.set_many,
+                ([1, 2], [3, 4]),
+                [1]
+        )
+
+
+    def test_from_arrays_three_columns(self):
+        d = structs.SortedTupleKeysDict.from_arrays(
+                (['c', 'f'], ['a', 'd'], ['b', 'e']),
+                ['x', 'y']
+        )
+        self.assertEqual(d[('a', 'c', 'b')], 'x')
+        self.assertEqual(d[('f', 'e', 'd')], 'y')
+        self.assertEqual(set(d), set([('a', 'b', 'c'), ('d', 'e', 'f')]))
+
+
+    def test_from_arrays_mixed_column_types(self):
+        d = structs.SortedTupleKeysDict.from_arrays(
+                ([2, 9], [1.5, 0.5]),
+                ['x', 'y']
+        )
+        self.assertEqual(d[(2, 1.5)], 'x')
+        self.assertEqual(d[(0.5, 9)], 'y')
+
+
+    def test_from_arrays_keeps_integer_precision(self):
+        numpy = structs.numpy
+        big = 2 ** 53 + 1
+        d = structs.SortedTupleKeysDict.from_arrays(
+                (numpy.array([big]), numpy.array([0.5])),
+                ['x']
+        )
+        self.assertEqual(list(d), [(0.5, big)])
+        self.assertTrue(isinstance(list(d)[0][1], (int, long)))
+        d = structs.SortedTupleKeysDict.from_arrays(
+                (numpy.array([2 ** 63 + 1], dtype=numpy.uint64),
+                 numpy.array([big], dtype=numpy.int64)),
+                ['x']
+        )
+        self.assertEqual(list(d), [(big, 2 ** 63 + 1)])
+        d = structs.SortedTupleKeysDict.from_arrays(
+                (numpy.array([big], dtype=numpy.int64),
+                 numpy.array([3], dtype=numpy.int32)),
+                ['x']
+        )
+        self.assertEqual(list(d), [(3, big)])
+
+
+class TestMappedSortedTupleKeysDict(unittest.TestCase):
+    """Tests for SortedTupleKeysDict.save() and open()"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'd.bin')
+        shared = 'b'
+        self.original = structs.SortedTupleKeysDict((
+            ((2, 1), 'x'),
+            (('a',), {'waka': [1, 2]}),
+            (('c', 'b'), 'spam'),
+            ((shared, shared), 'eggs')
+        ))
+        self.original.save(self.path)
+        self.d = structs.SortedTupleKeysDict.open(self.path)
+
+
+    def tearDown(self):
+        self.d.close()
+        shutil.rmtree(self.tempdir)
+
+
+    def test_getitem(self):
+        self.assertEqual(self.d[(1, 2)], 'x')
+        self.assertEqual(self.d[(2, 1)], 'x')
+        self.assertEqual(self.d[('a',)], {'waka': [1, 2]})
+        self.assertEqual(self.d[('b', 'c')], 'spam')
+        self.assertEqual(self.d[('b', ''.join(['b']))], 'eggs')
+
+
+    def test_getitem_raises_key_error(self):
+        self.assertRaises(KeyError, self.d.__getitem__, ('m', 'n'))
+        self.assertRaises(KeyError, self.d.__getitem__, (1, 'a'))
+
+
+    def test_contains(self):
+        self.assertTrue(('c', 'b') in self.d)
+        self.assertFalse(('b', 'd') in self.d)
+
+
+    def test_len_and_iter(self):
+        self.assertEqual(len(self.d), 4)
+        self.assertEqual(set(self.d), set(self.original))
+        self.assertEqual(dict(self.d.items()), dict(self.original.items()))
+
+
+    def test_empty(self):
+        path = os.path.join(self.tempdir, 'empty.bin')
+        structs.SortedTupleKeysDict().save(path)
+        d = structs.SortedTupleKeysDict.open(path)
+        self.assertEqual(len(d), 0)
+        self.assertFalse((1, 2) in d)
+        d.close()
+
+
+    def test_many_entries(self):
+        path = os.path.join(self.tempdir, 'many.bin')
+        original = structs.SortedTupleKeysDict(
+                ((i, i + 1), i) for i in range(1000))
+        original.save(path)
+        d = structs.SortedTupleKeysDict.open(path)
+        for i in range(1000):
+            self.assertEqual(d[(i + 1, i)], i)
+        d.close()
+
+
+    def test_open_unsupported_mode(self):
+        self.assertRaises(
+                ValueError,
+                structs.SortedTupleKeysDict.open,
+                self.path,
+                'w'
+        )
+
+
+    def test_not_a_saved_dict(self):
+        self.assertRaises(
+                ValueError,
+                structs.MappedSortedTupleKeysDict,
+                b'\x00' * 64
+        )
+
+
+class TestCachedSortedTupleKeysDict(TestSortedTupleKeysDict):
+    """Tests for CachedSortedTupleKeysDict"""
+
+    def setUp(self):
+        self.d = structs.CachedSortedTupleKeysDict((
+            ((2, 1), 'x'),
+            (('a',), 'waka'),
+            (('c', 'b'), 'spam')
+        ))
+        self.d.clear_cache()
+
+
+    def test_cache_hits_and_misses(self):
+        self.d[(2, 1)]
+        self.d[(2, 1)]
+        self.assertTrue((2, 1) in self.d)
+        info = self.d.cache_info()
+        self.assertEqual(info.hits, 2)
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.currsize, 1)
+
+
+    def test_canonical_keys_interned(self):
+        first = self.d.__keytransform__((1, 2))
+        second = self.d.__keytransform__((2, 1))
+        self.assertEqual(second, (1, 2))
+        self.assertTrue(first is second)
+
+
+    def test_canonical_keys_interned_either_way(self):
+        first = self.d.__keytransform__((4, 3))
+        second = self.d.__keytransform__((3, 4))
+        self.assertEqual(first, (3, 4))
+        self.assertTrue(first is second)
+        self.d[(6, 5)] = 'y'
+        self.assertTrue(self.d.__keytransform__((5, 6)) is
+                        self.d.__keytransform__((6, 5)))
+
+
+    def test_hits_counted_through_eviction(self):
+        d = structs.CachedSortedTupleKeysDict(cache_size=2)
+        d[(2, 1)] = 'x'
+        d[(2, 1)]
+        d[(4, 3)] = 'y'
+        d[(6, 5)] = 'z'
+        d[(8, 7)] = 'w'
+        info = d.cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 4)
+        self.assertEqual(info.currsize, 2)
+        # Evicted canonical keys are no longer interned.
+        self.assertEqual(len(d._key_cache._interned), 2)
+
+
+    def test_cache_bounded(self):
+        d = structs.CachedSortedTupleKeysDict(cache_size=2)
+        for i in range(10):
+            d[(i, i + 1)] = i
+        self.assertEqual(d.cache_info().currsize, 2)
+        self.assertEqual(d[(6, 5)], 5)
+        self.assertEqual(len(d), 10)
+
+
+    def test_unhashable_key(self):
+        self.assertEqual(self.d[[2, 1]], 'x')
+        self.assertEqual(self.d.cache_info().currsize, 0)
+
+
+class TestClockCache(unittest.TestCase):
+    """Tests for _ClockCache"""
+
+    def test_evicts_unreferenced_first(self):
+        cache = structs._ClockCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+        cache['c'] = 3
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+
+
+    def test_pop_frees_slot(self):
+        cache = structs._ClockCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.pop('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertTrue('b' in cache)
+        self.assertEqual(cache.pop('a', 'missing'), 'missing')
+
+
+    def test_invalid_maxsize(self):
+        self.assertRaises(ValueError, structs._ClockCache, 0)
+
+
+    def test_hits(self):
+        cache = structs._ClockCache(1)
+        cache['a'] = 1
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.peek('a'), 1)
+        cache['b'] = 2
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.info(), (2, 1, 1, 1))
+
+
+class TestIndexedSortedTupleKeysDict(TestSortedTupleKeysDict):
+    """Tests for IndexedSortedTupleKeysDict"""
+
+    def setUp(self):
+        self.d = structs.IndexedSortedTupleKeysDict((
+            ((2, 1), 'x'),
+            (('a',), 'waka'),
+            (('c', 'b'), 'spam'),
+            (('b', 'd'), 'eggs'),
+            (('b', 'b'), 'ham')
+        ))
+        del self.d[('d', 'b')]
+        del self.d[('b', 'b')]
+
+
+    def test_keys_containing(self):
+        self.d[('b', 'e')] = 1
+        self.assertEqual(
+                self.d.keys_containing('b'),
+                set([('b', 'c'), ('b', 'e')])
+        )
+        self.assertEqual(self.d.keys_containing(1), set([(1, 2)]))
+
+
+    def test_keys_containing_raises_key_error(self):
+        self.assertRaises(KeyError, self.d.keys_containing, 'd')
+
+
+    def test_index_updated_on_delete(self):
+        del self.d[('c', 'b')]
+        self.assertRaises(KeyError, self.d.keys_containing, 'b')
+        self.assertRaises(KeyError, self.d.keys_containing, 'c')
+
+
+    def test_index_unchanged_on_reassign(self):
+        self.d[('c', 'b')] = 'eggs'
+        self.assertEqual(self.d.keys_containing('c'), set([('b', 'c')]))
+
+
+    def test_neighbors(self):
+        self.d[('e', 'b')] = 1
+        self.d[('b', 'b')] = 2
+        self.assertEqual(self.d.neighbors('b'), set(['b', 'c', 'e']))
+        self.assertEqual(self.d.neighbors('c'), set(['b']))
+        self.assertEqual(self.d.neighbors('a'), set())
+
+
+    def test_clear(self):
+        self.d.clear()
+        self.assertEqual(len(self.d), 0)
+        self.assertRaises(KeyError, self.d.keys_containing, 'b')
+
+
+    @unittest.skipIf(structs.numpy is None, "NumPy is not installed")
+    def test_set_many_indexes_keys(self):
+        self.d.set_many((['b', 'e'], ['f', 'b']), [1, 2])
+        self.assertEqual(
+                self.d.keys_containing('b'),
+                set([('b', 'c'), ('b', 'f'), ('b', 'e')])
+        )
+
+
+class TestValueOrderedSortedTupleKeysDict(unittest.TestCase):
+    """Tests for ValueOrderedSortedTupleKeysDict"""
+
+    def setUp(self):
+        self.weights = structs.ValueOrderedSortedTupleKeysDict((
+            ((2, 1), 5),
+            ((3, 1), 1),
+            ((3, 2), 3),
+            (('a', 'b'), 4)
+        ))
+
+
+    def test_top_k(self):
+        self.assertEqual(
+                self.weights.top_k(2),
+                [((1, 2), 5), (('a', 'b'), 4)]
+        )
+        self.assertEqual(len(self.weights.top_k(10)), 4)
+
+
+    def test_bottom_k(self):
+        self.assertEqual(
+                self.weights.bottom_k(2),
+                [((1, 3), 1), ((2, 3), 3)]
+        )
+
+
+    def test_value_range(self):
+        self.assertEqual(
+                self.weights.value_range(2, 4),
+                [((2, 3), 3), (('a', 'b'), 4)]
+        )
+        self.assertEqual(self.weights.value_range(6, 9), [])
+
+
+    def test_order_follows_setitem_and_delitem(self):
+        self.weights[(1, 3)] = 10
+        del self.weights[(1, 2)]
+        self.assertEqual(
+                self.weights.top_k(2),
+                [((1, 3), 10), (('a', 'b'), 4)]
+        )
+        self.assertEqual(self.weights[(3, 1)], 10)
+        self.assertEqual(len(self.weights), 3)
+        self.assertRaises(KeyError, self.weights.__delitem__, (1, 2))
+
+
+    def test_clear(self):
+        self.weights.clear()
+        self.assertEqual(self.weights.top_k(1), [])
+
+
+    def test_many_values(self):
+        d = structs.ValueOrderedSortedTupleKeysDict()
+        for i in range(3000):
+            d[(i, 0)] = (i * 7919) % 3001
+        for i in range(0, 3000, 2):
+            del d[(0, i)]
+        values = [value for (key, value) in d.bottom_k(len(d))]
+        self.assertEqual(values, sorted(d.values()))
+        self.assertEqual(d.top_k(1)[0][1], max(d.values()))
+
+
+    @unittest.skipIf(structs.numpy is None, "NumPy is not installed")
+    def test_set_many_orders_values(self):
+        self.weights.set_many(([1, 9], [2, 8]), [0, 7])
+        self.assertEqual(self.weights.top_k(1), [((8, 9), 7)])
+        self.assertEqual(self.weights.bottom_k(1), [((1, 2), 0)])
+
+
+class TestConcurrentSortedTupleKeysDict(TestSortedTupleKeysDict):
+    """Tests for ConcurrentSortedTupleKeysDict"""
+
+    def setUp(self):
+        self.d = structs.ConcurrentSortedTupleKeysDict((
+            ((2, 1), 'x'),
+            (('a',), 'waka'),
+            (('c', 'b'), 'spam')
+        ), num_stripes=4)
+
+
+    def test_iter_and_clear(self):
+        self.assertEqual(set(self.d), set([(1, 2), ('a',), ('b', 'c')]))
+        self.d.clear()
+        self.assertEqual(len(self.d), 0)
+
+
+    def test_pop(self):
+        self.assertEqual(self.d.pop(('c', 'b')), 'spam')
+        self.assertFalse(('b', 'c') in self.d)
+        self.assertEqual(self.d.pop(('c', 'b'), None), None)
+        self.assertRaises(KeyError, self.d.pop, ('c', 'b'))
+
+
+    def test_setdefault(self):
+        self.assertEqual(self.d.setdefault((2, 1), 'y'), 'x')
+        self.assertEqual(self.d.setdefault((3, 1), 'y'), 'y')
+        self.assertEqual(self.d[(1, 3)], 'y')
+
+
+    def test_update_value(self):
+        self.assertEqual(self.d.update_value((4, 3), len, 'ab'), 2)
+        self.assertEqual(self.d.update_value((3, 4), str), '2')
+        self.assertRaises(KeyError, self.d.update_value, (5, 6), str)
+
+
+    def test_update_value_from_threads(self):
+        keys = [(1, 2), (2, 1), (3, 4), (4, 3)]
+        def count():
+            for i in range(1000):
+                for key in keys:
+                    self.d.update_value(key, lambda n: n + 1, 0)
+        self.d.clear()
+        threads = [threading.Thread(target=count) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.d[(1, 2)], 16000)
+        self.assertEqual(self.d[(3, 4)], 16000)
+
+
+    def test_items_and_values(self):
+        self.assertEqual(
+                dict(self.d.items()),
+                {(1, 2): 'x', ('a',): 'waka', ('b', 'c'): 'spam'}
+        )
+        self.assertEqual(dict(self.d.iteritems()), dict(self.d.items()))
+        self.assertEqual(sorted(self.d.values()), ['spam', 'waka', 'x'])
+        self.assertEqual(sorted(self.d.itervalues()), sorted(self.d.values()))
+
+
+    def test_items_while_deleting_from_threads(self):
+        errors = []
+        done = threading.Event()
+
+        def churn():
+            for i in range(2000):
+                self.d[(i % 50, -1)] = i
+                if i >= 25:
+                    del self.d[(-1, (i - 25) % 50)]
+
+        def read():
+            try:
+                while not done.is_set():
+                    for key, value in self.d.items():
+                        self.assertTrue(value is not None)
+                    for value in self.d.values():
+                        self.assertTrue(value is not None)
+            except Exception as error:
+                errors.append(error)
+
+        readers = [threading.Thread(target=read) for i in range(4)]
+        writers = [threading.Thread(target=churn)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.d), 3 + 25)
+
+
+    def test_invalid_num_stripes(self):
+        self.assertRaises(
+                ValueError,
+                structs.ConcurrentSortedTupleKeysDict,
+                num_stripes=0
+        )
+
+
+class TestSortedPairKeysDict(unittest.TestCase):
+    """Tests for SortedPairKeysDict"""
+
+    def setUp(self):
+        self.d = structs.SortedPairKeysDict((
+            ((2, 1), 1.5),
+            (('c', 'b'), 2.0)
+        ))
+
+
+    def test_empty_init(self):
+        structs.SortedPairKeysDict()
+
+
+    def test_contains(self):
+        self.assertTrue((1, 2) in self.d)
+        self.assertTrue((2, 1) in self.d)
+        self.assertTrue(('b', 'c') in self.d)
+        self.assertFalse(('b', 'd') in self.d)
+        self.assertFalse((1, 'b') in self.d)
+        self.assertFalse(('a',) in self.d)
+
+
+    def test_getitem(self):
+        self.assertEqual(self.d[('c', 'b')], 2.0)
+        self.assertEqual(self.d[('b', 'c')], 2.0)
+        self.assertEqual(self.d[(2, 1)], 1.5)
+
+
+    def test_getitem_raises_key_error(self):
+        self.assertRaises(KeyError, self.d.__getitem__, ('m', 'n'))
+        self.assertRaises(KeyError, self.d.__getitem__, (1, 'c'))
+
+
+    def test_setitem(self):
+        self.d[(2, 1)] = 3
+        self.assertEqual(self.d[(1, 2)], 3.0)
+        self.d[('m', 'n')] = 5
+        self.assertEqual(self.d[('n', 'm')], 5.0)
+        self.assertEqual(len(self.d), 3)
+
+
+    def test_setitem_raises_type_error_for_value(self):
+        self.assertRaises(TypeError, self.d.__setitem__, ('m', 'n'), 'x')
+        self.assertFalse(('m', 'n') in self.d)
+        self.assertEqual(len(self.d), 2)
+
+
+    def test_typecode(self):
+        d = structs.SortedPairKeysDict([((1, 2), 3)], typecode='i')
+        self.assertEqual(d[(2, 1)], 3)
+        self.assertRaises(TypeError, d.__setitem__, (1, 3), 1.5)
+
+
+    def test_setitem_raises_value_error(self):
+        self.assertRaises(ValueError, self.d.__setitem__, ('a',), 1)
+
+
+    def test_del(self):
+        del self.d[(2, 1)]
+        self.assertFalse((1, 2) in self.d)
+        self.assertRaises(KeyError, self.d.__delitem__, (2, 1))
+
+
+    def test_iter_yields_sorted_keys(self):
+        self.d[(3, 2)] = 4
+        self.assertEqual(
+                set(self.d),
+                set([(1, 2), (2, 3), ('b', 'c')])
+        )
+
+
+    def test_many_keys(self):
+        d = structs.SortedPairKeysDict(typecode='l')
+        expected = {}
+        for i in range(300):
+            for j in range(i % 7, 20, 3):
+                d[(j, i)] = i * j
+                expected[tuple(sorted((i, j)))] = i * j
+        for i in range(0, 300, 2):
+            for j in range(i % 7, 20, 6):
+                del d[(i, j)]
+                del expected[tuple(sorted((i, j)))]
+        self.assertEqual(len(d), len(expected))
+        self.assertEqual(dict(d.items()), expected)
+        for key in expected:
+            self.assertTrue(key in d)
+        self.assertFalse((0, 0) in d)
+
+
+    def test_clear(self):
+        self.d.clear()
+        self.assertEqual(len(self.d), 0)
+        self.assertEqual(list(self.d), [])
+        self.d[(1, 2)] = 1
+        self.assertEqual(self.d[(2, 1)], 1.0)
+
+
+    def test_integer_elements(self):
+        d = structs.SortedPairKeysDict(
+                [((7, 2 ** 32 - 2), 1), ((3, 0), 2)],
+                integer_elements=True
+        )
+        self.assertEqual(d[(2 ** 32 - 2, 7)], 1.0)
+        self.assertEqual(d[(0, 3)], 2.0)
+        self.assertEqual(set(d), set([(7, 2 ** 32 - 2), (0, 3)]))
+        self.assertFalse((0, 7) in d)
+        self.assertFalse(('a', 7) in d)
+        self.assertFalse((-1, 7) in d)
+        self.assertRaises(ValueError, d.__setitem__, ('a', 7), 1)
+        self.assertRaises(ValueError, d.__setitem__, (2 ** 32 - 1, 7), 1)
+        self.assertRaises(ValueError, d.__setitem__, (-1, 7), 1)
+        del d[(3, 0)]
+        self.assertEqual(len(d), 1)
+
+
+class TestDenseSortedPairKeysDict(unittest.TestCase):
+    """Tests for DenseSortedPairKeysDict"""
+
+    def setUp(self):
+        self.d = structs.DenseSortedPairKeysDict(
+                'dcba',
+                [(('b', 'a'), 1.5), (('c', 'c'), 2.0)]
+        )
+
+
+    def test_getitem(self):
+        self.assertEqual(self.d[('a', 'b')], 1.5)
+        self.assertEqual(self.d[('b', 'a')], 1.5)
+        self.assertEqual(self.d[('c', 'c')], 2.0)
+
+
+    def test_getitem_raises_key_error(self):
+        self.assertRaises(KeyError, self.d.__getitem__, ('a', 'c'))
+        self.assertRaises(KeyError, self.d.__getitem__, ('a', 'z'))
+
+
+    def test_setitem_and_len(self):
+        self.d[('d', 'a')] = 3
+        self.d[('a', 'd')] = 4
+        self.assertEqual(self.d[('a', 'd')], 4.0)
+        self.assertEqual(len(self.d), 3)
+
+
+    def test_setitem_unknown_element(self):
+        self.assertRaises(KeyError, self.d.__setitem__, ('a', 'z'), 1)
+
+
+    def test_del(self):
+        del self.d[('c', 'c')]
+        self.assertFalse(('c', 'c') in self.d)
+        self.assertEqual(len(self.d), 1)
+        self.assertRaises(KeyError, self.d.__delitem__, ('c', 'c'))
+
+
+    def test_iter(self):
+        self.d[('d', 'c')] = 1
+        self.d[('d', 'd')] = 1
+        self.assertEqual(
+                list(self.d),
+                [('a', 'b'), ('c', 'c'), ('c', 'd'), ('d', 'd')]
+        )
+
+
 class TwoWaySetDictTests(unittest.TestCase):
 
     def setize_kv_pairs(self, kv_pairs):
@@ -341,23 +1058,164 @@ class TwoWaySetDictTests(unittest.TestCase):
         )
 
 
-    def test_clear(self):
+    def test_copy_shares_until_changed(self):
         self.two_way_dict['a'] = set([1, 2])
-        self.two_way_dict['b'] = set([1])
-        self.two_way_dict.clear()
-        expected_items = set()
-        expected_reverse_store = {}
+        twd_copy = self.two_way_dict.copy()
+        self.assertIs(twd_copy._store, self.two_way_dict._store)
+        twd_copy.add_item('a', 3)
+        self.assertIsNot(twd_copy._store, self.two_way_dict._store)
+        self.assertEqual(self.two_way_dict['a'], set([1, 2]))
+
+
+    def test_copy_changes_independent(self):
+        self.two_way_dict.update(a=set([1, 2]), b=set([1]), c=set([3]))
+        twd_copy = self.two_way_dict.copy()
+        twd_copy.add_item('a', 4)
+        twd_copy.remove_item('b', 1)
+        twd_copy.apply_delta('c', added=[5], removed=[3])
+        twd_copy['d'] = set([1])
+        self.two_way_dict.remove_item_from_all_keys(1)
+        self.two_way_dict.add_items('c', [6])
+        del self.two_way_dict['a']
+        self.check_items_and_reverse_store(
+                twd_copy,
+                set([
+                    ('a', frozenset([1, 2, 4])),
+                    ('b', frozenset()),
+                    ('c', frozenset([5])),
+                    ('d', frozenset([1]))
+                ]),
+                {
+                    1: set(['a', 'd']),
+                    2: set(['a']),
+                    4: set(['a']),
+                    5: set(['c'])
+                }
+        )
         self.check_items_and_reverse_store(
                 self.two_way_dict,
-                expected_items,
-                expected_reverse_store
+                set([('b', frozenset()), ('c', frozenset([3, 6]))]),
+                {3: set(['c']), 6: set(['c'])}
         )
 
 
-    def test_item_has_key_raises_KeyError(self):
-        self.two_way_dict['a'] = set([1, 2])
-        self.assertRaises(
-                KeyError,
+    def test_copy_of_copy(self):
+        self.two_way_dict['a'] = set([1])
+        first = self.two_way_dict.copy()
+        first.add_item('a', 2)
+        second = first.copy()
+        second.remove_items_from_all_keys([1])
+        first.clear()
+        self.assertEqual(self.two_way_dict['a'], set([1]))
+        self.assertEqual(self.two_way_dict.get_item_keys(1), set(['a']))
+        self.assertEqual(len(first), 0)
+        self.assertEqual(second['a'], set([2]))
+        self.assertFalse(second.has_item(1))
+
+
+    def test_copy_set_value_back(self):
+        self.two_way_dict['a'] = set([1])
+        twd_copy = self.two_way_dict.copy()
+        twd_copy['a'] = twd_copy['a']
+        twd_copy.add_item('a', 99)
+        self.assertEqual(self.two_way_dict['a'], set([1]))
+        self.assertFalse(self.two_way_dict.has_item(99))
+        self.assertEqual(twd_copy['a'], set([1, 99]))
+        self.assertEqual(twd_copy.get_item_keys(99), set(['a']))
+
+
+    def test_copy_update_from_original(self):
+        self.two_way_dict.update(a=set([1]), b=set([2]))
+        twd_copy = self.two_way_dict.copy()
+        twd_copy.update(self.two_way_dict)
+        twd_copy.add_item('a', 99)
+        twd_copy.remove_item('b', 2)
+        self.assertEqual(self.two_way_dict['a'], set([1]))
+        self.assertEqual(self.two_way_dict['b'], set([2]))
+        self.assertFalse(self.two_way_dict.has_item(99))
+        self.assertEqual(self.two_way_dict.get_item_keys(2), set(['b']))
+        self.assertEqual(twd_copy['a'], set([1, 99]))
+        self.assertEqual(twd_copy['b'], set())
+
+
+    def test_pickle(self):
+        self.two_way_dict.update(
+                a=set([1, 2, 'x']),
+                b=set([1.0, 3]),
+                c=set()
+        )
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            unpickled = pickle.loads(
+                    pickle.dumps(self.two_way_dict, protocol))
+            self.assertEqual(type(unpickled), type(self.two_way_dict))
+            self.check_items_and_reverse_store(
+                    unpickled,
+                    set([
+                        ('a', frozenset([1, 2, 'x'])),
+                        ('b', frozenset([1, 3])),
+                        ('c', frozenset())
+                    ]),
+                    {
+                        1: set(['a', 'b']),
+                        2: set(['a']),
+                        3: set(['b']),
+                        'x': set(['a'])
+                    }
+            )
+            self.assertTrue(isinstance(list(unpickled['b'] - set([3]))[0],
+                                       float))
+            unpickled.add_item('c', 4)
+            self.assertEqual(unpickled.get_item_keys(4), set(['c']))
+
+
+    def test_changes_after_unpickling(self):
+        self.two_way_dict.update(
+                a=set([1, 2, 'x']),
+                b=set([1.0, 3]),
+                c=set()
+        )
+        unpickled = pickle.loads(pickle.dumps(self.two_way_dict))
+        # Change the unpickled dictionary before any reverse lookup.
+        del unpickled['a']
+        unpickled['d'] = set()
+        unpickled.pop('c')
+        unpickled.add_item('b', 5)
+        unpickled.remove_item('b', 3)
+        self.check_items_and_reverse_store(
+                unpickled,
+                set([
+                    ('b', frozenset([1, 5])),
+                    ('d', frozenset())
+                ]),
+                {
+                    1: set(['b']),
+                    5: set(['b'])
+                }
+        )
+        unpickled = pickle.loads(pickle.dumps(self.two_way_dict))
+        twd_copy = unpickled.copy()
+        twd_copy.add_item('c', 1)
+        self.assertEqual(unpickled.get_item_keys(1), set(['a', 'b']))
+        self.assertEqual(twd_copy.get_item_keys(1), set(['a', 'b', 'c']))
+
+
+    def test_clear(self):
+        self.two_way_dict['a'] = set([1, 2])
+        self.two_way_dict['b'] = set([1])
+        self.two_way_dict.clear()
+        expected_items = set()
+        expected_reverse_store = {}
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                expected_reverse_store
+        )
+
+
+    def test_item_has_key_raises_KeyError(self):
+        self.two_way_dict['a'] = set([1, 2])
+        self.assertRaises(
+                KeyError,
                 self.two_way_dict.item_has_key,
                 'unknown item',
                 'a'
@@ -533,34 +1391,2008 @@ class TwoWaySetDictTests(unittest.TestCase):
         self.assertFalse(self.two_way_dict.has_item(3))
 
 
-class TestSampleListDict(unittest.TestCase):
-    """Tests for sample_list_dict() and sample_list_dict_low_mem()"""
+    def test_update(self):
+        self.two_way_dict['a'] = set([1, 2])
+        self.two_way_dict['b'] = set([1])
+        self.two_way_dict.update(
+                {'a': set([2, 3]), 'c': set([1])},
+                d=set([3])
+        )
+        expected_items = set([
+                ('a', frozenset([2, 3])),
+                ('b', frozenset([1])),
+                ('c', frozenset([1])),
+                ('d', frozenset([3]))
+        ])
+        expected_reverse_store = {
+                1: set(['b', 'c']),
+                2: set(['a']),
+                3: set(['a', 'd'])
+        }
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                expected_reverse_store
+        )
+
+
+    def test_update_repeated_key_last_wins(self):
+        self.two_way_dict.update([
+                ('a', set([1])),
+                ('a', set()),
+                ('a', set([2]))
+        ])
+        expected_items = set([('a', frozenset([2]))])
+        expected_reverse_store = {2: set(['a'])}
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                expected_reverse_store
+        )
+
+
+    def test_update_raises_ValueError_unchanged(self):
+        self.two_way_dict['a'] = set([1])
+        self.assertRaises(
+                ValueError,
+                self.two_way_dict.update,
+                [('a', set([2])), ('b', [3])]
+        )
+        expected_items = set([('a', frozenset([1]))])
+        expected_reverse_store = {1: set(['a'])}
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                expected_reverse_store
+        )
+
+
+    def test_add_items(self):
+        self.two_way_dict['a'] = set([1])
+        self.two_way_dict['b'] = set([2])
+        self.two_way_dict.add_items('a', [1, 2, 3])
+        expected_items = set([
+                ('a', frozenset([1, 2, 3])),
+                ('b', frozenset([2]))
+        ])
+        expected_reverse_store = {
+                1: set(['a']),
+                2: set(['a', 'b']),
+                3: set(['a'])
+        }
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                expected_reverse_store
+        )
+        self.assertRaises(
+                KeyError,
+                self.two_way_dict.add_items,
+                'unknown key',
+                [1]
+        )
+
+
+    def test_remove_items(self):
+        self.two_way_dict['a'] = set([1, 2, 3])
+        self.two_way_dict['b'] = set([2])
+        self.two_way_dict.remove_items('a', [1, 2])
+        expected_items = set([
+                ('a', frozenset([3])),
+                ('b', frozenset([2]))
+        ])
+        expected_reverse_store = {2: set(['b']), 3: set(['a'])}
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                expected_reverse_store
+        )
+
+
+    def test_remove_items_raises_KeyError_unchanged(self):
+        self.two_way_dict['a'] = set([1, 2])
+        self.assertRaises(
+                KeyError,
+                self.two_way_dict.remove_items,
+                'a',
+                [1, 3]
+        )
+        self.assertEqual(self.two_way_dict['a'], set([1, 2]))
+
+
+    def test_remove_items_from_all_keys(self):
+        self.two_way_dict['a'] = set([1, 2, 3])
+        self.two_way_dict['b'] = set([1, 2])
+        self.two_way_dict.remove_items_from_all_keys([1, 2])
+        expected_items = set([
+                ('a', frozenset([3])),
+                ('b', frozenset())
+        ])
+        expected_reverse_store = {3: set(['a'])}
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                expected_reverse_store
+        )
+
+
+    def test_remove_items_from_all_keys_raises_KeyError(self):
+        self.two_way_dict['a'] = set([1, 2])
+        self.assertRaises(
+                KeyError,
+                self.two_way_dict.remove_items_from_all_keys,
+                [1, 3]
+        )
+        self.assertEqual(self.two_way_dict['a'], set([1, 2]))
+
+
+
+    def test_value_proxy_add_and_discard(self):
+        self.two_way_dict['a'] = set([1, 2])
+        self.two_way_dict['b'] = set([1])
+        value = self.two_way_dict.value_proxy('b')
+        value.add(3)
+        value.discard(1)
+        value.discard(4)
+        expected_items = set([
+                ('a', frozenset([1, 2])),
+                ('b', frozenset([3]))
+        ])
+        expected_reverse_store = {
+                1: set(['a']),
+                2: set(['a']),
+                3: set(['b'])
+        }
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                expected_reverse_store
+        )
+        self.assertRaises(KeyError, value.remove, 1)
+
+
+    def test_value_proxy_in_place_operators(self):
+        self.two_way_dict['a'] = set([1, 2, 3])
+        value = self.two_way_dict.value_proxy('a')
+        value |= set([4])
+        value -= set([1])
+        value &= set([2, 4, 5])
+        value ^= set([2, 6])
+        expected_items = set([('a', frozenset([4, 6]))])
+        expected_reverse_store = {4: set(['a']), 6: set(['a'])}
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                expected_reverse_store
+        )
+
+
+    def test_value_proxy_set_methods(self):
+        self.two_way_dict['a'] = set([1, 2, 3])
+        value = self.two_way_dict.value_proxy('a')
+        value.update([4], [5])
+        value.difference_update([1], [2])
+        value.intersection_update([3, 4, 5, 6], [3, 5])
+        self.assertEqual(value, set([3, 5]))
+        self.assertEqual(value | set([6]), set([3, 5, 6]))
+        self.assertTrue(isinstance(value | set([6]), set))
+        self.assertEqual(value.union([7]), set([3, 5, 7]))
+        self.assertTrue(value.issubset([3, 4, 5]))
+        value.clear()
+        expected_items = set([('a', frozenset())])
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                {}
+        )
+
+
+    def test_value_proxy_of_deleted_key(self):
+        self.two_way_dict['a'] = set([1])
+        value = self.two_way_dict.value_proxy('a')
+        del self.two_way_dict['a']
+        self.assertRaises(KeyError, value.add, 2)
+        self.assertRaises(KeyError, len, value)
+
+
+    def test_getitem_returns_set(self):
+        self.two_way_dict['a'] = set([1])
+        self.assertTrue(isinstance(self.two_way_dict['a'], set))
+        self.assertEqual(self.two_way_dict.pop('a'), set([1]))
+
+
+    def test_value_proxy_of_unknown_key(self):
+        self.assertRaises(KeyError, self.two_way_dict.value_proxy, 'a')
+
+
+    def test_value_proxy_pickles_as_set(self):
+        self.two_way_dict['a'] = set([1, 2])
+        value = self.two_way_dict.value_proxy('a')
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            unpickled = pickle.loads(pickle.dumps(value, protocol))
+            self.assertTrue(isinstance(unpickled, set))
+            self.assertEqual(unpickled, set([1, 2]))
+
+
+    def test_getitem_raises_KeyError(self):
+        self.assertRaises(
+                KeyError,
+                self.two_way_dict.__getitem__,
+                'unknown key'
+        )
+
+
+    def test_assign_value_proxy_copies(self):
+        self.two_way_dict['a'] = set([1])
+        self.two_way_dict['b'] = self.two_way_dict.value_proxy('a')
+        self.two_way_dict.update(c=self.two_way_dict.value_proxy('a'))
+        self.two_way_dict.add_item('b', 2)
+        expected_items = set([
+                ('a', frozenset([1])),
+                ('b', frozenset([1, 2])),
+                ('c', frozenset([1]))
+        ])
+        expected_reverse_store = {1: set(['a', 'b', 'c']), 2: set(['b'])}
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                expected_reverse_store
+        )
+
+
+    def test_apply_delta(self):
+        self.two_way_dict['a'] = set([1, 2, 3])
+        self.two_way_dict['b'] = set([2])
+        self.two_way_dict.apply_delta('a', added=[4, 1], removed=[1, 2, 5])
+        expected_items = set([
+                ('a', frozenset([1, 3, 4])),
+                ('b', frozenset([2]))
+        ])
+        expected_reverse_store = {
+                1: set(['a']),
+                2: set(['b']),
+                3: set(['a']),
+                4: set(['a'])
+        }
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                expected_reverse_store
+        )
+        self.assertRaises(
+                KeyError,
+                self.two_way_dict.apply_delta,
+                'unknown key',
+                [1]
+        )
+
+
+class TestLazyTwoWaySetDict(TwoWaySetDictTests):
+    """Tests for LazyTwoWaySetDict"""
 
     def setUp(self):
-        self.case = OrderedDict((
-            ('key1', [1, 5, 9]),
-            ('key2', [6, 42]),
-            ('key3', [7, 9001])
-        ))
-        self.expected = {
-            'key1': [5, 9],
-            'key3': [7]
+        self.two_way_dict = structs.LazyTwoWaySetDict()
+
+
+    def test_not_built_by_forward_changes(self):
+        self.two_way_dict.update(a=set([1, 2]), b=set([1]))
+        self.two_way_dict['c'] = set([3])
+        self.two_way_dict.add_item('a', 4)
+        self.two_way_dict.add_items('b', [5, 6])
+        self.two_way_dict.remove_item('a', 1)
+        self.two_way_dict.remove_items('b', [5])
+        del self.two_way_dict['c']
+        self.assertFalse(self.two_way_dict.reverse_store_built())
+        self.assertRaises(
+                ValueError,
+                self.two_way_dict.__setitem__,
+                'd',
+                [1]
+        )
+        self.assertRaises(
+                KeyError,
+                self.two_way_dict.remove_items,
+                'b',
+                [7]
+        )
+        self.assertEqual(
+                self.two_way_dict.get_item_keys(1),
+                set(['b'])
+        )
+        self.assertTrue(self.two_way_dict.reverse_store_built())
+        expected_items = set([
+                ('a', frozenset([2, 4])),
+                ('b', frozenset([1, 6]))
+        ])
+        expected_reverse_store = {
+                1: set(['b']),
+                2: set(['a']),
+                4: set(['a']),
+                6: set(['b'])
         }
+        self.check_items_and_reverse_store(
+                self.two_way_dict,
+                expected_items,
+                expected_reverse_store
+        )
 
 
-    def test_sample_list_dict(self):
-        sampled_values = [('key1', 5), ('key1', 9), ('key3', 7)]
-        randmock = MagicMock(return_value=sampled_values)
-        with patch('random.sample', randmock):
-            result = structs.sample_list_dict(self.case, 3)
-            self.assertEqual(result, self.expected)
+    def test_incremental_after_built(self):
+        self.two_way_dict['a'] = set([1])
+        self.assertTrue(self.two_way_dict.has_item(1))
+        self.two_way_dict['b'] = set([1, 2])
+        self.two_way_dict.add_item('a', 3)
+        self.assertEqual(
+                self.two_way_dict._lazy_reverse_store,
+                {1: set(['a', 'b']), 2: set(['b']), 3: set(['a'])}
+        )
 
 
-    def test_sample_list_dict_low_mem(self):
-        randmock = MagicMock(return_value=[1, 2, 5])
-        with patch('random.sample', randmock):
-            result = structs.sample_list_dict_low_mem(self.case, 1)
-            self.assertEqual(result, self.expected)
+    def test_clear_resets(self):
+        self.two_way_dict['a'] = set([1])
+        self.two_way_dict.has_item(1)
+        self.two_way_dict.clear()
+        self.assertFalse(self.two_way_dict.reverse_store_built())
+        self.assertFalse(self.two_way_dict.has_item(1))
+
+
+    def test_copy_before_built(self):
+        self.two_way_dict['a'] = set([1])
+        twd_copy = self.two_way_dict.copy()
+        self.assertFalse(twd_copy.reverse_store_built())
+        twd_copy.add_item('a', 2)
+        self.assertEqual(twd_copy.get_item_keys(2), set(['a']))
+        self.assertFalse(self.two_way_dict.reverse_store_built())
+        self.assertEqual(self.two_way_dict['a'], set([1]))
+        self.assertFalse(self.two_way_dict.has_item(2))
+
+
+class TestBloomFilter(unittest.TestCase):
+    """Tests for _BloomFilter"""
+
+    def test_no_false_negatives(self):
+        bloom_filter = structs._BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom_filter.add(i)
+        for i in range(1000):
+            self.assertTrue(i in bloom_filter)
+
+
+    def test_false_positive_rate(self):
+        bloom_filter = structs._BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom_filter.add(i)
+        false_positives = sum(
+                1 for i in range(1000, 11000) if i in bloom_filter)
+        self.assertTrue(false_positives < 300)
+        fill_ratio = bloom_filter.fill_ratio()
+        self.assertTrue(0.3 < fill_ratio < 0.7)
+
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, structs._BloomFilter, 0, 0.01)
+        self.assertRaises(ValueError, structs._BloomFilter, 10, 0)
+        self.assertRaises(ValueError, structs._BloomFilter, 10, 1)
+
+
+class TestBloomFilteredTwoWaySetDict(TwoWaySetDictTests):
+    """Tests for BloomFilteredTwoWaySetDict"""
+
+    def setUp(self):
+        self.two_way_dict = structs.BloomFilteredTwoWaySetDict(
+                capacity=100)
+
+
+    def test_misses_counted(self):
+        self.two_way_dict.update(a=set([1, 2]), b=set([2, 3]))
+        self.assertTrue(self.two_way_dict.has_item(2))
+        self.assertEqual(self.two_way_dict.get_item_keys(2),
+                         set(['a', 'b']))
+        self.assertTrue(self.two_way_dict.item_has_key(1, 'a'))
+        for item in range(100, 200):
+            self.assertFalse(self.two_way_dict.has_item(item))
+        self.assertRaises(KeyError, self.two_way_dict.get_item_keys, 4)
+        self.assertRaises(KeyError, self.two_way_dict.item_has_key, 4,
+                          'a')
+        info = self.two_way_dict.filter_info()
+        self.assertEqual(info.capacity, 100)
+        self.assertEqual(info.error_rate, 0.01)
+        self.assertEqual(info.negatives + info.false_positives, 102)
+        self.assertEqual(
+                info.false_positive_rate,
+                float(info.false_positives) / 102
+        )
+        self.assertTrue(info.fill_ratio > 0)
+
+
+    def test_removed_items_rebuild(self):
+        self.two_way_dict.update(a=set(range(50)))
+        self.two_way_dict.remove_items('a', range(50))
+        for item in range(50):
+            self.assertFalse(self.two_way_dict.has_item(item))
+        self.assertEqual(self.two_way_dict.filter_info().false_positives,
+                         50)
+        self.two_way_dict.rebuild_filter(capacity=200)
+        info = self.two_way_dict.filter_info()
+        self.assertEqual(info.capacity, 200)
+        self.assertEqual(info.fill_ratio, 0.0)
+        self.assertEqual(info.false_positives, 0)
+        self.assertFalse(self.two_way_dict.has_item(1))
+        self.assertEqual(self.two_way_dict.filter_info().negatives, 1)
+
+
+    def test_copy_filter_independent(self):
+        self.two_way_dict['a'] = set([1])
+        twd_copy = self.two_way_dict.copy()
+        twd_copy.add_item('a', 2)
+        self.assertTrue(twd_copy.has_item(2))
+        self.assertFalse(self.two_way_dict.has_item(2))
+        self.assertEqual(self.two_way_dict.filter_info().capacity, 100)
+
+
+    def test_pickle_keeps_filter_settings(self):
+        d = structs.BloomFilteredTwoWaySetDict(
+                capacity=50, error_rate=0.05, a=set([1]))
+        unpickled = pickle.loads(pickle.dumps(d))
+        info = unpickled.filter_info()
+        self.assertEqual(info.capacity, 50)
+        self.assertEqual(info.error_rate, 0.05)
+        self.assertTrue(unpickled.has_item(1))
+
+
+    def test_clear_empties_filter(self):
+        self.two_way_dict['a'] = set([1])
+        self.two_way_dict.clear()
+        self.assertEqual(self.two_way_dict.filter_info().fill_ratio, 0.0)
+
+
+    def test_copy_filters_independent(self):
+        self.two_way_dict['a'] = set([1])
+        twd_copy = self.two_way_dict.copy()
+        twd_copy.clear()
+        self.assertTrue(self.two_way_dict.has_item(1))
+        self.assertTrue(self.two_way_dict.filter_info().fill_ratio > 0)
+        self.two_way_dict.add_item('a', 2)
+        self.assertEqual(twd_copy.filter_info().fill_ratio, 0.0)
+        self.assertFalse(twd_copy.has_item(2))
+
+
+class TestDegreeTrackingTwoWaySetDict(TwoWaySetDictTests):
+    """Tests for DegreeTrackingTwoWaySetDict"""
+
+    def setUp(self):
+        self.two_way_dict = structs.DegreeTrackingTwoWaySetDict()
+
+
+    def check_degrees(self, two_way_dict):
+        """Checks the tracked degrees against ones counted afresh."""
+        key_histogram = {}
+        for key, value in two_way_dict.items():
+            self.assertEqual(two_way_dict.key_degree(key), len(value))
+            key_histogram[len(value)] = key_histogram.get(
+                    len(value), 0) + 1
+        self.assertEqual(two_way_dict.key_degree_histogram(),
+                         key_histogram)
+        item_histogram = {}
+        for item, keys in two_way_dict.reverse_items():
+            self.assertEqual(two_way_dict.item_degree(item), len(keys))
+            item_histogram[len(keys)] = item_histogram.get(
+                    len(keys), 0) + 1
+        self.assertEqual(two_way_dict.item_degree_histogram(),
+                         item_histogram)
+
+
+    def test_degrees_through_changes(self):
+        d = self.two_way_dict
+        d.update(a=set([1, 2, 3]), b=set([1, 2]), c=set([1]))
+        self.check_degrees(d)
+        d['b'] = set([2, 4])
+        d.add_item('c', 5)
+        d.add_items('a', [3, 4, 6])
+        d.remove_item('a', 6)
+        d['d'] = set()
+        self.check_degrees(d)
+        d.update(a=set([1]), e=set([1, 2]))
+        d.apply_delta('b', added=[7, 8], removed=[2, 9])
+        d.remove_items('b', [7])
+        self.check_degrees(d)
+        d.remove_item_from_all_keys(1)
+        d.remove_items_from_all_keys([4, 5])
+        del d['e']
+        self.check_degrees(d)
+        d.clear()
+        self.check_degrees(d)
+        self.assertEqual(d.top_items(3), [])
+
+
+    def test_top_keys_and_items(self):
+        self.two_way_dict.update(
+                a=set([1, 2, 3]),
+                b=set([1, 2]),
+                c=set([1]),
+                d=set()
+        )
+        self.assertEqual(self.two_way_dict.top_items(2),
+                         [(1, 3), (2, 2)])
+        self.assertEqual(self.two_way_dict.top_items(10),
+                         [(1, 3), (2, 2), (3, 1)])
+        self.assertEqual(self.two_way_dict.top_keys(2),
+                         [('a', 3), ('b', 2)])
+        self.assertEqual(self.two_way_dict.top_keys(10),
+                         [('a', 3), ('b', 2), ('c', 1)])
+        self.assertEqual(self.two_way_dict.item_degree(4), 0)
+        self.assertRaises(KeyError, self.two_way_dict.key_degree, 'e')
+
+
+    def test_pickle_keeps_degrees(self):
+        self.two_way_dict.update(
+                a=set([1, 2, 3]),
+                b=set([1, 2]),
+                c=set([1.0]),
+                d=set()
+        )
+        unpickled = pickle.loads(pickle.dumps(self.two_way_dict))
+        self.check_degrees(unpickled)
+        self.assertEqual(unpickled.top_items(1), [(1, 3)])
+        unpickled.remove_item('a', 1)
+        self.check_degrees(unpickled)
+
+
+    def test_copy_degrees_independent(self):
+        self.two_way_dict['a'] = set([1])
+        twd_copy = self.two_way_dict.copy()
+        twd_copy.add_item('a', 2)
+        self.assertEqual(self.two_way_dict.top_keys(1), [('a', 1)])
+        self.assertEqual(twd_copy.top_keys(1), [('a', 2)])
+        self.check_degrees(self.two_way_dict)
+        self.check_degrees(twd_copy)
+
+
+    def test_clear_copy_keeps_degrees(self):
+        self.two_way_dict['a'] = set([1])
+        twd_copy = self.two_way_dict.copy()
+        twd_copy.clear()
+        self.two_way_dict.add_item('a', 2)
+        self.assertEqual(self.two_way_dict.top_keys(1), [('a', 2)])
+        self.assertEqual(twd_copy.top_keys(1), [])
+        self.check_degrees(self.two_way_dict)
+        self.check_degrees(twd_copy)
+
+
+class TestPackIds(unittest.TestCase):
+    """Tests for _pack_ids and _unpack_ids"""
+
+    def test_round_trip(self):
+        for ids in ([], [0, 3, 255], [256, 0], [70000, 1, 65535]):
+            self.assertEqual(
+                    list(structs._unpack_ids(structs._pack_ids(ids))), ids)
+
+
+    def test_narrowest_width(self):
+        self.assertEqual(len(structs._pack_ids([255, 1])), 1 + 2)
+        self.assertEqual(len(structs._pack_ids([256, 1])), 1 + 4)
+        self.assertEqual(len(structs._pack_ids([65536, 1])), 1 + 8)
+
+
+class TestReadWriteLock(unittest.TestCase):
+    """Tests for _ReadWriteLock"""
+
+    def setUp(self):
+        self.lock = structs._ReadWriteLock()
+
+
+    def run_in_thread(self, func):
+        """Runs the function in another thread, and returns whether it
+        finished within a short time.
+
+        """
+        finished = threading.Event()
+        def target():
+            func()
+            finished.set()
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        finished.wait(0.5)
+        return thread, finished
+
+
+    def test_readers_share(self):
+        with self.lock.read_lock:
+            with self.lock.read_lock:
+                thread, finished = self.run_in_thread(
+                        self.lock.acquire_read)
+                self.assertTrue(finished.is_set())
+
+
+    def test_writer_excludes_readers(self):
+        self.lock.acquire_write()
+        thread, finished = self.run_in_thread(self.lock.acquire_read)
+        self.assertFalse(finished.is_set())
+        self.lock.release_write()
+        thread.join(5)
+        self.assertTrue(finished.is_set())
+
+
+    def test_reader_excludes_writers(self):
+        self.lock.acquire_read()
+        thread, finished = self.run_in_thread(self.lock.acquire_write)
+        self.assertFalse(finished.is_set())
+        self.lock.release_read()
+        thread.join(5)
+        self.assertTrue(finished.is_set())
+
+
+    def test_writer_reenters(self):
+        with self.lock.write_lock:
+            with self.lock.read_lock:
+                with self.lock.write_lock:
+                    pass
+        thread, finished = self.run_in_thread(self.lock.acquire_write)
+        self.assertTrue(finished.is_set())
+
+
+    def test_cannot_upgrade(self):
+        with self.lock.read_lock:
+            self.assertRaises(RuntimeError, self.lock.acquire_write)
+
+
+    def test_release_unacquired(self):
+        self.assertRaises(RuntimeError, self.lock.release_read)
+        self.assertRaises(RuntimeError, self.lock.release_write)
+
+
+class TestConcurrentTwoWaySetDict(unittest.TestCase):
+    """Tests for ConcurrentTwoWaySetDict"""
+
+    def setUp(self):
+        self.d = structs.ConcurrentTwoWaySetDict(
+                a=set([1, 2]), b=set([1]))
+
+
+    def test_snapshots(self):
+        value = self.d['a']
+        self.assertEqual(value, frozenset([1, 2]))
+        keys = self.d.get_item_keys(1)
+        self.d.add_item('a', 3)
+        self.d.remove_item('b', 1)
+        self.assertEqual(value, frozenset([1, 2]))
+        self.assertEqual(keys, frozenset(['a', 'b']))
+        self.assertEqual(self.d['a'], frozenset([1, 2, 3]))
+        self.assertEqual(
+                dict(self.d.reverse_items()),
+                {1: frozenset(['a']), 2: frozenset(['a']),
+                 3: frozenset(['a'])}
+        )
+
+
+    def test_mapping_methods(self):
+        self.assertTrue('a' in self.d)
+        self.assertEqual(len(self.d), 2)
+        self.assertEqual(sorted(self.d), ['a', 'b'])
+        self.assertEqual(self.d.pop('b'), frozenset([1]))
+        self.assertEqual(self.d.get_item_keys(1), frozenset(['a']))
+        self.assertEqual(self.d.setdefault('c', set([4])),
+                         frozenset([4]))
+        self.assertEqual(self.d.keys_containing_any([1, 4]),
+                         set(['a', 'c']))
+        d_copy = self.d.copy()
+        d_copy.clear()
+        self.assertEqual(len(self.d), 2)
+
+
+    def test_items_and_values(self):
+        self.assertEqual(
+                sorted(self.d.items()),
+                [('a', frozenset([1, 2])), ('b', frozenset([1]))]
+        )
+        self.assertEqual(sorted(self.d.iteritems()), sorted(self.d.items()))
+        self.assertEqual(sorted(map(sorted, self.d.values())),
+                         [[1], [1, 2]])
+        self.assertEqual(len(list(self.d.itervalues())), 2)
+
+
+    def test_pickle(self):
+        unpickled = pickle.loads(pickle.dumps(self.d))
+        self.assertEqual(unpickled['a'], frozenset([1, 2]))
+        unpickled.add_item('b', 3)
+        self.assertEqual(unpickled.get_item_keys(3), frozenset(['b']))
+
+
+    def test_changes_from_threads(self):
+        errors = []
+        done = threading.Event()
+
+        def write(offset):
+            for i in range(200):
+                key = offset + i % 10
+                self.d[key] = set(range(i, i + 5))
+                self.d.add_item(key, -1 - offset)
+                self.d.remove_item_from_all_keys(-1 - offset)
+
+        def churn():
+            for i in range(1000):
+                self.d[1000 + i % 10] = set([i])
+                if i >= 5:
+                    del self.d[1000 + (i - 5) % 10]
+            for i in range(995, 1000):
+                del self.d[1000 + i % 10]
+
+        def read():
+            try:
+                while not done.is_set():
+                    for item, keys in self.d.reverse_items():
+                        self.d.has_item(item)
+                    for key in self.d:
+                        self.d.get(key)
+                    for key, value in self.d.items():
+                        self.assertTrue(isinstance(value, frozenset))
+                    for value in self.d.values():
+                        self.assertTrue(isinstance(value, frozenset))
+                    self.d.keys_containing_any(range(10))
+            except Exception as error:
+                errors.append(error)
+
+        readers = [threading.Thread(target=read) for i in range(4)]
+        writers = [threading.Thread(target=write, args=(100 * i,))
+                   for i in range(4)]
+        writers.append(threading.Thread(target=churn))
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.d), 42)
+        self.assertEqual(
+                self.d.keys_containing_any([-1, -101, -201, -301]), set())
+        for item, keys in self.d.reverse_items():
+            for key in keys:
+                self.assertTrue(item in self.d[key])
+
+
+    def test_value_proxy(self):
+        value = self.d.value_proxy('a')
+        self.assertTrue(1 in value)
+        self.assertEqual(len(value), 2)
+        self.assertEqual(set(value), set([1, 2]))
+        value.add(3)
+        value.discard(1)
+        value ^= set([2, 4])
+        self.assertEqual(self.d['a'], frozenset([3, 4]))
+        self.assertEqual(self.d.get_item_keys(4), frozenset(['a']))
+        self.assertEqual(self.d.get_item_keys(1), frozenset(['b']))
+        value.clear()
+        self.assertEqual(self.d['a'], frozenset())
+        self.assertFalse(self.d.has_item(3))
+        self.assertRaises(KeyError, self.d.value_proxy, 'c')
+
+
+    def test_value_proxy_from_threads(self):
+        errors = []
+        done = threading.Event()
+        value = self.d.value_proxy('a')
+
+        def write():
+            for i in range(500):
+                self.d.add_item('a', 10 + i % 20)
+                if i >= 10:
+                    self.d.remove_item('a', 10 + (i - 10) % 20)
+
+        def toggle():
+            for i in range(200):
+                value.symmetric_difference_update([-1])
+
+        def read():
+            try:
+                while not done.is_set():
+                    for item in value:
+                        self.assertTrue(isinstance(item, int))
+                    len(value)
+            except Exception as error:
+                errors.append(error)
+
+        readers = [threading.Thread(target=read) for i in range(4)]
+        writers = [threading.Thread(target=write)]
+        writers.extend(threading.Thread(target=toggle) for i in range(4))
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(
+                self.d['a'],
+                frozenset([1, 2]) | frozenset(10 + i % 20 for i in
+                                              range(490, 500))
+        )
+        self.assertFalse(self.d.has_item(-1))
+
+
+class TestTwoWaySetDictQueries(unittest.TestCase):
+    """Tests for the inverted-index queries of TwoWaySetDict"""
+
+    def setUp(self):
+        self.d = structs.TwoWaySetDict(
+                a=set([1, 2, 3]),
+                b=set([1, 2]),
+                c=set([2, 3, 4]),
+                d=set([5])
+        )
+
+
+    def test_keys_containing_all(self):
+        self.assertEqual(self.d.keys_containing_all([1, 2]),
+                         set(['a', 'b']))
+        self.assertEqual(self.d.keys_containing_all([2, 3, 3]),
+                         set(['a', 'c']))
+        self.assertEqual(self.d.keys_containing_all([1, 5]), set())
+        self.assertEqual(self.d.keys_containing_all([1, 6]), set())
+        self.assertEqual(self.d.keys_containing_all([]),
+                         set(['a', 'b', 'c', 'd']))
+
+
+    def test_keys_containing_all_does_not_alias(self):
+        result = self.d.keys_containing_all([5])
+        result.add('z')
+        self.assertEqual(self.d.get_item_keys(5), set(['d']))
+
+
+    def test_keys_containing_any(self):
+        self.assertEqual(self.d.keys_containing_any([4, 5, 6]),
+                         set(['c', 'd']))
+        self.assertEqual(self.d.keys_containing_any([6]), set())
+
+
+    def test_keys_containing_at_least(self):
+        self.assertEqual(
+                self.d.keys_containing_at_least([1, 2, 3, 4], 2),
+                set(['a', 'b', 'c'])
+        )
+        self.assertEqual(
+                self.d.keys_containing_at_least([1, 2, 3, 4], 3),
+                set(['a', 'c'])
+        )
+        self.assertEqual(
+                self.d.keys_containing_at_least([1, 5, 6], 1),
+                set(['a', 'b', 'd'])
+        )
+        self.assertEqual(
+                self.d.keys_containing_at_least([1, 6], 2),
+                set()
+        )
+        self.assertEqual(
+                self.d.keys_containing_at_least([6], 0),
+                set(['a', 'b', 'c', 'd'])
+        )
+
+
+    def test_top_overlap(self):
+        self.assertEqual(
+                sorted(self.d.top_overlap('a', 2)),
+                [('b', 2), ('c', 2)]
+        )
+        self.assertEqual(self.d.top_overlap('b', 1), [('a', 2)])
+        self.assertEqual(self.d.top_overlap('d', 3), [])
+        self.assertRaises(KeyError, self.d.top_overlap, 'z', 1)
+
+
+class TestFrozenTwoWaySetDict(unittest.TestCase):
+    """Tests for TwoWaySetDict.freeze() and FrozenTwoWaySetDict"""
+
+    def setUp(self):
+        self.original = structs.TwoWaySetDict(
+                a=set([1, 2, 3]),
+                b=set([2]),
+                c=set(),
+                d=set(['x', 3])
+        )
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'frozen.bin')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def check_contents(self, frozen):
+        self.assertEqual(len(frozen), 4)
+        self.assertEqual(
+                dict(frozen.items()),
+                dict((key, set(value)) for (key, value) in
+                     self.original.items())
+        )
+        self.assertEqual(
+                dict(frozen.reverse_items()),
+                dict(self.original.reverse_items())
+        )
+        self.assertEqual(frozen.get_item_keys(3), set(['a', 'd']))
+        self.assertTrue(frozen.has_item('x'))
+        self.assertFalse(frozen.has_item(4))
+        self.assertTrue(frozen.item_has_key(2, 'b'))
+        self.assertFalse(frozen.item_has_key(2, 'd'))
+        self.assertFalse(frozen.item_has_key(2, 'unknown key'))
+        self.assertRaises(KeyError, frozen.get_item_keys, 4)
+        self.assertRaises(KeyError, frozen.__getitem__, 'e')
+        self.assertTrue('c' in frozen)
+
+
+    def test_freeze(self):
+        self.check_contents(self.original.freeze())
+
+
+    def test_save_and_load(self):
+        self.original.freeze().save(self.path)
+        frozen = structs.FrozenTwoWaySetDict.load(self.path)
+        self.check_contents(frozen)
+        frozen.close()
+
+
+    def test_save_loaded(self):
+        self.original.freeze().save(self.path)
+        frozen = structs.FrozenTwoWaySetDict.load(self.path)
+        path = os.path.join(self.tempdir, 'copy.bin')
+        frozen.save(path)
+        frozen.close()
+        frozen = structs.FrozenTwoWaySetDict.load(path)
+        self.check_contents(frozen)
+        frozen.close()
+
+
+    def test_empty(self):
+        structs.TwoWaySetDict().freeze().save(self.path)
+        frozen = structs.FrozenTwoWaySetDict.load(self.path)
+        self.assertEqual(len(frozen), 0)
+        self.assertEqual(frozen.reverse_items(), [])
+        frozen.close()
+
+
+    def test_thaw(self):
+        thawed = self.original.freeze().thaw()
+        thawed.add_item('c', 4)
+        self.assertEqual(thawed.get_item_keys(4), set(['c']))
+        self.assertFalse(self.original.has_item(4))
+
+
+    def test_freeze_lazy_does_not_build_reverse(self):
+        lazy = structs.LazyTwoWaySetDict(self.original)
+        self.check_contents(lazy.freeze())
+        self.assertFalse(lazy.reverse_store_built())
+
+
+    def test_not_a_saved_dict(self):
+        self.assertRaises(
+                ValueError,
+                structs.FrozenTwoWaySetDict.from_buffer,
+                b'\x00' * 64
+        )
+
+
+class TestBitsetTwoWaySetDict(unittest.TestCase):
+    """Tests for BitsetTwoWaySetDict"""
+
+    def setUp(self):
+        self.d = structs.BitsetTwoWaySetDict(
+                [('a', set([1, 2])), ('b', set([1]))],
+                c=frozenset([2, 3])
+        )
+
+
+    def check_reverse(self, expected):
+        self.assertEqual(dict(self.d.reverse_items()), expected)
+
+
+    def test_init(self):
+        self.assertEqual(
+                dict(self.d.items()),
+                {'a': set([1, 2]), 'b': set([1]), 'c': set([2, 3])}
+        )
+        self.check_reverse({
+            1: set(['a', 'b']),
+            2: set(['a', 'c']),
+            3: set(['c'])
+        })
+
+
+    def test_from_two_way_set_dict(self):
+        twd = structs.TwoWaySetDict(a=set([1, 2]), b=set([1]))
+        expected = {'a': set([1, 2]), 'b': set([1])}
+        self.assertEqual(dict(structs.BitsetTwoWaySetDict(twd).items()),
+                         expected)
+        self.assertEqual(
+                dict(structs.BitsetTwoWaySetDict(twd.items()).items()),
+                expected
+        )
+        self.d['d'] = twd.value_proxy('a')
+        self.assertEqual(self.d['d'], set([1, 2]))
+
+
+    def test_init_bad_items(self):
+        self.assertRaises(
+                ValueError,
+                structs.BitsetTwoWaySetDict,
+                [('a', set([1])), ('b', 2)]
+        )
+
+
+    def test_reassign_entry(self):
+        self.d['a'] = set([2, 4])
+        self.assertEqual(self.d['a'], set([2, 4]))
+        self.check_reverse({
+            1: set(['b']),
+            2: set(['a', 'c']),
+            3: set(['c']),
+            4: set(['a'])
+        })
+
+
+    def test_del(self):
+        del self.d['c']
+        self.assertFalse('c' in self.d)
+        self.check_reverse({1: set(['a', 'b']), 2: set(['a'])})
+        self.assertRaises(KeyError, self.d.__delitem__, 'c')
+
+
+    def test_ids_reused(self):
+        del self.d['c']
+        self.d['e'] = set([5])
+        self.assertEqual(len(self.d._keys.objects), 3)
+        self.assertEqual(len(self.d._items.objects), 3)
+        self.assertEqual(self.d.get_item_keys(5), set(['e']))
+
+
+    def test_has_item(self):
+        self.assertTrue(self.d.has_item(3))
+        self.assertFalse(self.d.has_item(4))
+
+
+    def test_item_has_key(self):
+        self.assertTrue(self.d.item_has_key(2, 'c'))
+        self.assertFalse(self.d.item_has_key(2, 'b'))
+        self.assertFalse(self.d.item_has_key(2, 'unknown key'))
+        self.assertRaises(KeyError, self.d.item_has_key, 4, 'a')
+
+
+    def test_add_and_remove_item(self):
+        self.d.add_item('b', 3)
+        self.d.add_item('b', 3)
+        self.assertEqual(self.d.get_item_keys(3), set(['b', 'c']))
+        self.d.remove_item('c', 3)
+        self.assertEqual(self.d.get_item_keys(3), set(['b']))
+        self.assertRaises(KeyError, self.d.remove_item, 'c', 3)
+        self.assertRaises(KeyError, self.d.add_item, 'unknown key', 3)
+
+
+    def test_remove_item_from_all_keys(self):
+        self.d.remove_item_from_all_keys(2)
+        self.assertEqual(self.d['a'], set([1]))
+        self.assertEqual(self.d['c'], set([3]))
+        self.assertFalse(self.d.has_item(2))
+        self.assertRaises(
+                KeyError,
+                self.d.remove_item_from_all_keys,
+                2
+        )
+
+
+    def test_set_algebra(self):
+        self.assertEqual(self.d.key_intersection('a', 'c'), set([2]))
+        self.assertEqual(self.d.key_union('b', 'c'), set([1, 2, 3]))
+        self.assertEqual(self.d.key_difference('a', 'b'), set([2]))
+        self.assertEqual(self.d.key_overlap('a', 'b'), 1)
+        self.assertEqual(self.d.key_intersection(), set())
+        self.assertRaises(KeyError, self.d.key_union, 'a', 'unknown')
+
+
+    def test_copy_and_clear(self):
+        d_copy = self.d.copy()
+        self.d.clear()
+        self.assertEqual(len(self.d), 0)
+        self.assertEqual(self.d.reverse_items(), [])
+        self.assertEqual(d_copy['c'], set([2, 3]))
+
+
+    def test_wide_bitsets(self):
+        d = structs.BitsetTwoWaySetDict()
+        for i in range(200):
+            d[i] = set(range(i, 300, 7))
+        for i in range(200):
+            self.assertEqual(d[i], set(range(i, 300, 7)))
+        self.assertEqual(
+                d.get_item_keys(150),
+                set(i for i in range(151) if (150 - i) % 7 == 0)
+        )
+
+
+class TestBitmap(unittest.TestCase):
+    """Tests for _Bitmap"""
+
+    def setUp(self):
+        # A sparse container, a dense one, and one far above them.
+        self.sparse_ids = set(range(0, 60000, 97))
+        self.dense_ids = set(range(65536, 65536 + 30000, 3))
+        self.far_ids = set([2 ** 32 + 5, 2 ** 32 + 7])
+        self.ids = self.sparse_ids | self.dense_ids | self.far_ids
+        self.bitmap = structs._Bitmap(self.ids)
+
+
+    def test_containers(self):
+        containers = self.bitmap._containers
+        self.assertEqual(self.bitmap._highs, [0, 1, 2 ** 16])
+        self.assertFalse(isinstance(containers[0], tuple))
+        self.assertTrue(isinstance(containers[1], tuple))
+        self.assertFalse(isinstance(containers[2], tuple))
+
+
+    def test_contents(self):
+        self.assertEqual(list(self.bitmap), sorted(self.ids))
+        self.assertEqual(len(self.bitmap), len(self.ids))
+        for i in (0, 97, 65536, 65539, 2 ** 32 + 7):
+            self.assertTrue(i in self.bitmap)
+        for i in (1, 65537, 2 ** 32 + 6, 2 ** 40):
+            self.assertFalse(i in self.bitmap)
+        self.assertFalse(structs._Bitmap())
+        self.assertTrue(self.bitmap)
+
+
+    def test_add_and_discard(self):
+        self.assertTrue(self.bitmap.add(1))
+        self.assertFalse(self.bitmap.add(1))
+        self.assertTrue(self.bitmap.add(65537))
+        self.assertFalse(self.bitmap.add(65537))
+        self.assertTrue(self.bitmap.discard(65537))
+        self.assertFalse(self.bitmap.discard(65537))
+        self.assertTrue(self.bitmap.discard(2 ** 32 + 5))
+        self.assertTrue(self.bitmap.discard(2 ** 32 + 7))
+        self.assertFalse(self.bitmap.discard(2 ** 32 + 7))
+        self.assertEqual(self.bitmap._highs, [0, 1])
+        self.assertEqual(list(self.bitmap),
+                         sorted(self.sparse_ids | self.dense_ids | set([1])))
+
+
+    def test_containers_convert(self):
+        bitmap = structs._Bitmap()
+        for i in range(5000):
+            bitmap.add(i)
+        self.assertTrue(isinstance(bitmap._containers[0], tuple))
+        for i in range(2000):
+            bitmap.discard(i)
+        self.assertFalse(isinstance(bitmap._containers[0], tuple))
+        self.assertEqual(list(bitmap), list(range(2000, 5000)))
+
+
+    def test_set_algebra(self):
+        other_ids = (set(range(0, 60000, 2)) |
+                     set(range(65536, 65536 + 40000, 2)) |
+                     set([2 ** 32 + 5, 2 ** 33]))
+        other = structs._Bitmap(other_ids)
+        self.assertEqual(list(self.bitmap & other),
+                         sorted(self.ids & other_ids))
+        self.assertEqual(list(self.bitmap | other),
+                         sorted(self.ids | other_ids))
+        self.assertEqual(list(self.bitmap - other),
+                         sorted(self.ids - other_ids))
+        self.assertEqual(list(other - self.bitmap),
+                         sorted(other_ids - self.ids))
+        # The operands are left unchanged.
+        self.assertEqual(list(self.bitmap), sorted(self.ids))
+        self.assertEqual(list(other), sorted(other_ids))
+
+
+    def test_copy(self):
+        bitmap_copy = self.bitmap.copy()
+        bitmap_copy.add(1)
+        bitmap_copy.discard(65536)
+        self.assertFalse(1 in self.bitmap)
+        self.assertTrue(65536 in self.bitmap)
+
+
+def attach_and_get(name, key, queue):
+    """Attaches a published dictionary in a child process and puts the
+    value of the key on the queue.
+
+    """
+    shared = structs.attach_shared(name)
+    queue.put(shared[key])
+    shared.close()
+
+
+@unittest.skipIf(structs.shared_memory is None,
+                 "multiprocessing.shared_memory is not available")
+class TestSharedMemory(unittest.TestCase):
+    """Tests for publish_shared() and attach_shared()"""
+
+    def setUp(self):
+        self.blocks = []
+
+
+    def tearDown(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+
+    def publish(self, d):
+        block = structs.publish_shared(d)
+        self.blocks.append(block)
+        return block
+
+
+    def test_sorted_tuple_keys_dict(self):
+        block = self.publish(structs.SortedTupleKeysDict((
+            ((2, 1), 'x'),
+            (('c', 'b'), {'spam': [1]})
+        )))
+        shared = structs.attach_shared(block.name)
+        self.assertTrue(isinstance(shared,
+                                   structs.MappedSortedTupleKeysDict))
+        self.assertEqual(shared[(1, 2)], 'x')
+        self.assertEqual(shared[('b', 'c')], {'spam': [1]})
+        self.assertFalse(('a', 'b') in shared)
+        self.assertEqual(len(shared), 2)
+        shared.close()
+
+
+    def test_two_way_set_dict(self):
+        block = self.publish(structs.TwoWaySetDict(
+                a=set([1, 2]), b=set([2])))
+        shared = structs.attach_shared(block.name)
+        self.assertTrue(isinstance(shared, structs.FrozenTwoWaySetDict))
+        self.assertEqual(shared['a'], frozenset([1, 2]))
+        self.assertEqual(shared.get_item_keys(2), frozenset(['a', 'b']))
+        shared.close()
+
+
+    def test_child_process(self):
+        block = self.publish(structs.TwoWaySetDict(a=set([1, 2])))
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+                target=attach_and_get,
+                args=(block.name, 'a', queue)
+        )
+        process.start()
+        self.assertEqual(queue.get(timeout=10), frozenset([1, 2]))
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+
+
+    def run_python(self, code):
+        """Runs code in a new interpreter, unrelated to this process,
+        and waits for it and its resource tracker to exit.
+
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(
+                os.path.dirname(os.path.abspath(structs.__file__)))
+        process = subprocess.Popen(
+                [sys.executable, '-c', code],
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+        )
+        # The resource tracker inherits the pipes, so this also waits
+        # for it to finish its cleanup.
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0, stderr)
+        return stdout
+
+
+    def test_unrelated_process(self):
+        block = self.publish(structs.TwoWaySetDict(a=set([1, 2])))
+        stdout = self.run_python(
+                "from convutils import structs\n"
+                "shared = structs.attach_shared({0!r})\n"
+                "print(sorted(shared['a']))\n"
+                "shared.close()\n".format(block.name)
+        )
+        self.assertEqual(stdout.strip(), b'[1, 2]')
+        # The unrelated process's tracker left the block alone.
+        shared = structs.attach_shared(block.name)
+        self.assertEqual(shared['a'], frozenset([1, 2]))
+        shared.close()
+
+
+    def test_publisher_exits_without_unlink(self):
+        stdout = self.run_python(
+                "from convutils import structs\n"
+                "block = structs.publish_shared(\n"
+                "        structs.TwoWaySetDict(a=set([1])))\n"
+                "structs.attach_shared(block.name).close()\n"
+                "block.close()\n"
+                "print(block.name)\n"
+        )
+        name = stdout.strip().decode('ascii')
+        # The publisher's tracker unlinked the block it leaked.
+        self.assertRaises(OSError, structs.shared_memory.SharedMemory,
+                          name)
+
+
+    def test_unpublishable(self):
+        self.assertRaises(TypeError, structs.publish_shared, {'a': 1})
+
+
+    def test_attach_unpublished(self):
+        block = structs.shared_memory.SharedMemory(create=True, size=16)
+        self.blocks.append(block)
+        self.assertRaises(ValueError, structs.attach_shared, block.name)
+
+
+class TestSqliteTwoWaySetDict(unittest.TestCase):
+    """Tests for SqliteTwoWaySetDict"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'sets.db')
+        self.d = structs.SqliteTwoWaySetDict(
+                self.path,
+                (('a', set([1, 2])), ('b', set([1])), ('c', set())),
+                cache_size=2
+        )
+
+
+    def tearDown(self):
+        self.d.close()
+        shutil.rmtree(self.tempdir)
+
+
+    def test_mapping(self):
+        self.assertEqual(len(self.d), 3)
+        self.assertEqual(set(self.d), set(['a', 'b', 'c']))
+        self.assertEqual(self.d['a'], set([1, 2]))
+        self.assertEqual(self.d['c'], set())
+        self.assertTrue('b' in self.d)
+        self.assertFalse('d' in self.d)
+        self.assertRaises(KeyError, self.d.__getitem__, 'd')
+        self.assertRaises(ValueError, self.d.__setitem__, 'd', [1])
+
+
+    def test_from_two_way_set_dict(self):
+        twd = structs.TwoWaySetDict(a=set([1, 2]), b=set([1]))
+        d = structs.SqliteTwoWaySetDict(
+                os.path.join(self.tempdir, 'copy.db'), twd)
+        d['c'] = twd.value_proxy('b')
+        self.assertEqual(d['a'], set([1, 2]))
+        self.assertEqual(d.get_item_keys(1), set(['a', 'b', 'c']))
+        d.close()
+
+
+    def test_equal_keys_from_different_objects(self):
+        d = structs.SqliteTwoWaySetDict(
+                os.path.join(self.tempdir, 'tuples.db'), cache_size=1)
+        element = 'gene1'
+        k1 = (element, element)
+        k2 = ('gene1', ''.join(['gene', '1']))
+        d[k1] = set([k1])
+        d[k2] = set([k2, 1])
+        d[('other', 'key')] = set()
+        self.assertEqual(len(d), 2)
+        self.assertTrue(k1 in d)
+        self.assertTrue(k2 in d)
+        self.assertEqual(d[k1], set([k1, 1]))
+        self.assertEqual(d.get_item_keys(k2), set([k1]))
+        d.close()
+
+
+    def test_setitem_and_delitem(self):
+        self.d['a'] = set([2, 3])
+        self.assertEqual(self.d['a'], set([2, 3]))
+        self.assertEqual(self.d.get_item_keys(1), set(['b']))
+        del self.d['b']
+        self.assertFalse(self.d.has_item(1))
+        self.assertRaises(KeyError, self.d.__delitem__, 'b')
+        self.assertEqual(len(self.d), 2)
+
+
+    def test_reverse_lookups(self):
+        self.assertTrue(self.d.has_item(1))
+        self.assertFalse(self.d.has_item(3))
+        self.assertEqual(self.d.get_item_keys(1), set(['a', 'b']))
+        self.assertRaises(KeyError, self.d.get_item_keys, 3)
+        self.assertTrue(self.d.item_has_key(2, 'a'))
+        self.assertFalse(self.d.item_has_key(2, 'b'))
+        self.assertRaises(KeyError, self.d.item_has_key, 3, 'a')
+        self.assertEqual(
+                dict(self.d.reverse_iteritems()),
+                {1: set(['a', 'b']), 2: set(['a'])}
+        )
+        self.assertEqual(set(self.d.reverse_keys()), set([1, 2]))
+        self.assertEqual(len(self.d.reverse_values()), 2)
+
+
+    def test_add_and_remove_items(self):
+        self.assertEqual(self.d['a'], set([1, 2]))
+        self.d.add_item('a', 3)
+        self.d.add_item('c', 1)
+        self.assertEqual(self.d['a'], set([1, 2, 3]))
+        self.assertEqual(self.d.get_item_keys(1), set(['a', 'b', 'c']))
+        self.d.remove_item('a', 1)
+        self.assertEqual(self.d['a'], set([2, 3]))
+        self.assertRaises(KeyError, self.d.remove_item, 'a', 1)
+        self.assertRaises(KeyError, self.d.add_item, 'd', 1)
+        self.d.remove_item_from_all_keys(1)
+        self.assertEqual(self.d['b'], set())
+        self.assertEqual(self.d['c'], set())
+        self.assertRaises(KeyError, self.d.remove_item_from_all_keys, 1)
+
+
+    def test_cached_set_changed_in_place(self):
+        value = self.d['a']
+        self.d.add_item('a', 3)
+        cached = self.d._cache.peek('a')
+        self.d.add_item('a', 4)
+        self.d.remove_item('a', 1)
+        self.assertIs(self.d._cache.peek('a'), cached)
+        self.assertEqual(value, frozenset([1, 2]))
+        new_value = self.d['a']
+        self.assertEqual(new_value, frozenset([2, 3, 4]))
+        self.assertTrue(isinstance(new_value, frozenset))
+        self.assertIs(self.d['a'], new_value)
+        self.d.add_item('a', 5)
+        self.assertEqual(new_value, frozenset([2, 3, 4]))
+        self.assertEqual(self.d['a'], frozenset([2, 3, 4, 5]))
+
+
+    def test_cache(self):
+        self.d.flush()
+        self.d['a']
+        self.d['a']
+        info = self.d.cache_info()
+        self.assertEqual(info.maxsize, 2)
+        self.assertTrue(info.hits >= 1)
+
+
+    def test_persists(self):
+        self.d.add_item('b', 5)
+        self.d.close()
+        self.d = structs.SqliteTwoWaySetDict(self.path)
+        self.assertEqual(self.d['b'], set([1, 5]))
+        self.assertEqual(self.d.get_item_keys(5), set(['b']))
+
+
+    def test_batches_commit(self):
+        d = structs.SqliteTwoWaySetDict(
+                os.path.join(self.tempdir, 'batched.db'),
+                batch_size=3
+        )
+        d['x'] = set([1, 2])
+        self.assertEqual(d._pending, 0)
+        d.add_item('x', 3)
+        self.assertEqual(d._pending, 1)
+        d.flush()
+        self.assertEqual(d._pending, 0)
+        d.close()
+
+
+    def test_clear(self):
+        self.d.clear()
+        self.assertEqual(len(self.d), 0)
+        self.assertEqual(self.d.reverse_items(), [])
+
+
+class TestSampleListDict(unittest.TestCase):
+    """Tests for sample_list_dict() and sample_list_dict_low_mem()"""
+
+    def setUp(self):
+        self.case = OrderedDict((
+            ('key1', [1, 5, 9]),
+            ('key2', [6, 42]),
+            ('key3', [7, 9001])
+        ))
+        self.expected = {
+            'key1': [5, 9],
+            'key3': [7]
+        }
+
+
+    def test_sample_list_dict(self):
+        sampled_values = [('key1', 5), ('key1', 9), ('key3', 7)]
+        randmock = MagicMock(return_value=sampled_values)
+        with patch('random.sample', randmock):
+            result = structs.sample_list_dict(self.case, 3)
+            self.assertEqual(result, self.expected)
+
+
+    def test_sample_list_dict_low_mem(self):
+        randmock = MagicMock(return_value=[1, 2, 5])
+        with patch('convutils.structs._sample_sorted_indices', randmock):
+            result = structs.sample_list_dict_low_mem(self.case, 1)
+            self.assertEqual(result, self.expected)
+        randmock.assert_called_once_with(7, 1)
+
+
+class RecordingSequence(object):
+    """A sequence of the integers up to a length, which records the
+    indices accessed.
+
+    """
+
+    def __init__(self, length):
+        self.length = length
+        self.accessed = []
+
+
+    def __len__(self):
+        return self.length
+
+
+    def __getitem__(self, index):
+        self.accessed.append(index)
+        return index
+
+
+class TestSampleIndex(unittest.TestCase):
+    """Tests for SampleIndex"""
+
+    def setUp(self):
+        self.case = {
+            'key1': [1, 5, 9],
+            'key2': [6, 42],
+            'key3': [7, 9001],
+            'key4': []
+        }
+        self.index = structs.SampleIndex(self.case)
+
+
+    def check_sample(self, sampled, k, replacement=False):
+        self.assertEqual(sum(len(v) for v in sampled.values()), k)
+        for key, values in sampled.items():
+            if not replacement:
+                self.assertEqual(len(set(values)), len(values))
+            self.assertTrue(set(values) <= set(self.case[key]))
+
+
+    def test_len(self):
+        self.assertEqual(len(self.index), 7)
+
+
+    def test_sample(self):
+        for k in range(8):
+            self.check_sample(self.index.sample(k), k)
+        self.assertRaises(ValueError, self.index.sample, 8)
+
+
+    def test_sample_mocked(self):
+        randmock = MagicMock(return_value=[1, 2, 5])
+        index = structs.SampleIndex(OrderedDict((
+            ('key1', [1, 5, 9]),
+            ('key2', [6, 42]),
+            ('key3', [7, 9001])
+        )))
+        with patch('convutils.structs._sample_sorted_indices', randmock):
+            self.assertEqual(index.sample(3),
+                             {'key1': [5, 9], 'key3': [7]})
+
+
+    def test_sample_walk(self):
+        d = OrderedDict(
+                (key, list(range(key * 100, key * 100 + key % 5))) for key
+                in range(1000)
+        )
+        flattened = [(key, v) for (key, values) in d.items() for v in
+                     values]
+        index = structs.SampleIndex(d)
+        for k in (1, 2, 10, 100, len(flattened)):
+            indices = sorted(random.sample(range(len(flattened)), k))
+            expected = {}
+            for i in indices:
+                key, value = flattened[i]
+                expected.setdefault(key, []).append(value)
+            randmock = MagicMock(return_value=indices)
+            with patch('convutils.structs._sample_sorted_indices',
+                       randmock):
+                self.assertEqual(index.sample(k), expected)
+
+
+    def test_sample_huge(self):
+        d = {'key1': RecordingSequence(10 ** 9),
+             'key2': RecordingSequence(10 ** 9)}
+        index = structs.SampleIndex(d)
+        self.assertEqual(len(index), 2 * 10 ** 9)
+        sampled = index.sample(10)
+        self.assertEqual(sum(len(v) for v in sampled.values()), 10)
+        # Only the sampled sub-elements are ever touched.
+        self.assertEqual(
+                len(d['key1'].accessed) + len(d['key2'].accessed), 10)
+
+
+    @unittest.skipIf(tracemalloc is None, "tracemalloc is not available")
+    def test_sample_memory_bounded_by_k(self):
+        index = structs.SampleIndex({'key': RecordingSequence(10 ** 8)})
+        tracemalloc.start()
+        try:
+            index.sample(1000)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # Materializing the indices would take hundreds of megabytes.
+        self.assertLess(peak, 1024 * 1024)
+
+
+    def test_sample_many(self):
+        samples = self.index.sample_many(3, 5)
+        self.assertEqual(len(samples), 5)
+        for sampled in samples:
+            self.check_sample(sampled, 3)
+        self.assertEqual(self.index.sample_many(3, 0), [])
+
+
+    def test_sample_with_replacement(self):
+        sampled = self.index.sample_with_replacement(20)
+        self.check_sample(sampled, 20, replacement=True)
+        self.assertEqual(self.index.sample_with_replacement(0), {})
+        self.assertRaises(ValueError,
+                          structs.SampleIndex({}).sample_with_replacement,
+                          1)
+
+
+    def test_not_stale(self):
+        self.assertFalse(self.index.is_stale())
+        self.case['key1'][0] = 2
+        self.assertFalse(self.index.is_stale())
+
+
+    def test_stale_key_added(self):
+        self.case['key5'] = [3]
+        self.assertTrue(self.index.is_stale())
+        self.assertRaises(RuntimeError, self.index.sample, 1)
+
+
+    def test_stale_key_replaced(self):
+        del self.case['key1']
+        self.case['key5'] = [1, 5, 9]
+        self.assertTrue(self.index.is_stale())
+        self.assertRaises(RuntimeError, self.index.sample, 7)
+
+
+    def test_stale_length_changed(self):
+        self.case['key2'].append(43)
+        self.assertTrue(self.index.is_stale())
+        self.assertRaises(RuntimeError, self.index.sample, 7)
+
+
+    def test_refresh(self):
+        self.case['key4'].extend([10, 11])
+        self.index.refresh()
+        self.assertFalse(self.index.is_stale())
+        self.assertEqual(len(self.index), 9)
+        sampled = self.index.sample(9)
+        self.assertEqual(sorted(sampled['key4']), [10, 11])
+
+
+class TestWeightedSampleIndex(unittest.TestCase):
+    """Tests for WeightedSampleIndex and sample_list_dict_weighted()"""
+
+    def setUp(self):
+        random.seed(0)
+        self.case = OrderedDict((
+            ('key1', [1, 5, 9]),
+            ('key2', [6, 42]),
+            ('key3', [7]),
+            ('key4', [])
+        ))
+        self.key_weights = {'key1': 3, 'key2': 1, 'key3': 0, 'key4': 5}
+        self.element_weights = {
+            'key1': [1, 0, 2],
+            'key2': [0, 4],
+            'key3': [1],
+            'key4': []
+        }
+
+
+    def count_draws(self, samples):
+        counts = Counter()
+        for sampled in samples:
+            for key, values in sampled.items():
+                counts.update((key, value) for value in values)
+        return counts
+
+
+    def test_uniform(self):
+        index = structs.WeightedSampleIndex(self.case)
+        counts = self.count_draws(
+                [index.sample_with_replacement(6) for i in range(1000)])
+        # Each sub-element is expected 1000 times.
+        for key, values in self.case.items():
+            for value in values:
+                self.assertTrue(850 < counts[key, value] < 1150, counts)
+        sampled = index.sample(6)
+        self.assertEqual(
+                dict((key, sorted(values)) for (key, values) in
+                     sampled.items()),
+                dict((key, values) for (key, values) in self.case.items()
+                     if values)
+        )
+
+
+    def test_key_weights_with_replacement(self):
+        index = structs.WeightedSampleIndex(self.case, self.key_weights)
+        counts = self.count_draws(
+                [index.sample_with_replacement(8) for i in range(1000)])
+        self.assertEqual(sum(counts.values()), 8000)
+        # key1 weighs 3 split over 3 sub-elements, key2 1 over 2.
+        for value in (1, 5, 9):
+            self.assertTrue(1800 < counts['key1', value] < 2200, counts)
+        for value in (6, 42):
+            self.assertTrue(850 < counts['key2', value] < 1150, counts)
+        self.assertEqual(counts['key3', 7], 0)
+
+
+    def test_element_weights_with_replacement(self):
+        index = structs.WeightedSampleIndex(
+                self.case, element_weights=self.element_weights)
+        counts = self.count_draws(
+                [index.sample_with_replacement(8) for i in range(1000)])
+        self.assertEqual(counts['key1', 5], 0)
+        self.assertEqual(counts['key2', 6], 0)
+        # Weights 1, 2, 4, and 1 out of 8.
+        self.assertTrue(850 < counts['key1', 1] < 1150, counts)
+        self.assertTrue(1800 < counts['key1', 9] < 2200, counts)
+        self.assertTrue(3700 < counts['key2', 42] < 4300, counts)
+        self.assertTrue(850 < counts['key3', 7] < 1150, counts)
+
+
+    def test_key_weights_without_replacement(self):
+        index = structs.WeightedSampleIndex(self.case, self.key_weights)
+        counts = self.count_draws(index.sample_many(1, 4000))
+        self.assertEqual(sum(counts.values()), 4000)
+        for value in (1, 5, 9):
+            self.assertTrue(850 < counts['key1', value] < 1150, counts)
+        for value in (6, 42):
+            self.assertTrue(400 < counts['key2', value] < 600, counts)
+        sampled = index.sample(5)
+        self.assertEqual(sorted(sampled['key1']), [1, 5, 9])
+        self.assertEqual(sorted(sampled['key2']), [6, 42])
+        self.assertRaises(ValueError, index.sample, 6)
+
+
+    def test_element_weights_without_replacement(self):
+        index = structs.WeightedSampleIndex(
+                self.case, element_weights=self.element_weights)
+        for i in range(100):
+            sampled = index.sample(3)
+            self.assertEqual(sum(len(v) for v in sampled.values()), 3)
+            self.assertNotIn(5, sampled.get('key1', []))
+            self.assertNotIn(6, sampled.get('key2', []))
+        self.assertEqual(
+                index.sample(4),
+                {'key1': [1, 9], 'key2': [42], 'key3': [7]}
+        )
+        self.assertRaises(ValueError, index.sample, 5)
+
+
+    def test_invalid_weights(self):
+        self.assertRaises(ValueError, structs.WeightedSampleIndex,
+                          self.case, self.key_weights,
+                          self.element_weights)
+        self.element_weights['key2'].append(1)
+        self.assertRaises(ValueError, structs.WeightedSampleIndex,
+                          self.case, element_weights=self.element_weights)
+        self.key_weights['key2'] = -1
+        self.assertRaises(ValueError, structs.WeightedSampleIndex,
+                          self.case, self.key_weights)
+        index = structs.WeightedSampleIndex(
+                self.case, dict.fromkeys(self.case, 0))
+        self.assertRaises(ValueError, index.sample_with_replacement, 1)
+        self.assertEqual(index.sample_with_replacement(0), {})
+        self.assertEqual(index.sample(0), {})
+
+
+    def test_refresh(self):
+        index = structs.WeightedSampleIndex(self.case, self.key_weights)
+        self.case['key4'].append(10)
+        self.assertTrue(index.is_stale())
+        index.refresh()
+        sampled = index.sample(6)
+        self.assertEqual(sampled['key4'], [10])
+
+
+    def test_sample_list_dict_weighted(self):
+        sampled = structs.sample_list_dict_weighted(
+                self.case, 4, element_weights=self.element_weights)
+        self.assertEqual(sampled,
+                         {'key1': [1, 9], 'key2': [42], 'key3': [7]})
+        sampled = structs.sample_list_dict_weighted(
+                self.case, 10, self.key_weights, replace=True)
+        self.assertEqual(sum(len(v) for v in sampled.values()), 10)
+        self.assertNotIn('key3', sampled)
+
+
+class TestAliasTable(unittest.TestCase):
+    """Tests for _AliasTable"""
+
+    def test_draw(self):
+        random.seed(0)
+        weights = [0, 1, 2, 3, 4, 0]
+        table = structs._AliasTable(weights)
+        self.assertEqual(len(table), 6)
+        counts = Counter(table.draw() for i in range(10000))
+        self.assertEqual(counts[0], 0)
+        self.assertEqual(counts[5], 0)
+        for i in range(1, 5):
+            # Expected 1000 times the weight.
+            self.assertTrue(abs(counts[i] - 1000 * i) < 200, counts)
+
+
+class TestSampleSortedIndices(unittest.TestCase):
+    """Tests for _sample_sorted_indices()"""
+
+    def test_sample(self):
+        for n in range(6):
+            for k in range(n + 1):
+                indices = structs._sample_sorted_indices(n, k)
+                self.assertEqual(len(indices), k)
+                self.assertEqual(indices, sorted(set(indices)))
+                self.assertTrue(all(0 <= i < n for i in indices))
+
+
+    def test_sample_too_large(self):
+        self.assertRaises(ValueError, structs._sample_sorted_indices,
+                          3, 4)
+        self.assertRaises(ValueError, structs._sample_sorted_indices,
+                          3, -1)
+
+
+    def test_huge_population(self):
+        n = 10 ** 15
+        indices = structs._sample_sorted_indices(n, 5)
+        self.assertEqual(len(set(indices)), 5)
+        self.assertEqual(indices, sorted(indices))
+        self.assertTrue(all(0 <= i < n for i in indices))
+
+
+    def test_uniform(self):
+        random.seed(0)
+        counts = Counter()
+        for i in range(5000):
+            counts.update(structs._sample_sorted_indices(10, 3))
+        for i in range(10):
+            self.assertTrue(1350 < counts[i] < 1650, counts)
+
+
+class TestReservoirSample(unittest.TestCase):
+    """Tests for reservoir_sample_records() and
+    reservoir_sample_groups()
+
+    """
+
+    def setUp(self):
+        random.seed(0)
+        self.case = OrderedDict((
+            ('key1', [1, 5, 9]),
+            ('key2', [6, 42]),
+            ('key3', [7, 9001]),
+            ('key4', [])
+        ))
+        self.records = [
+                (key, value) for (key, values) in self.case.items() for
+                value in values
+        ]
+
+
+    def check_sample(self, sampled, k):
+        self.assertEqual(sum(len(v) for v in sampled.values()), k)
+        for key, values in sampled.items():
+            # Sampled elements keep their order within each key.
+            expected = [v for v in self.case[key] if v in values]
+            self.assertEqual(values, expected)
+
+
+    def test_sample_records(self):
+        for k in range(8):
+            self.check_sample(
+                    structs.reservoir_sample_records(
+                        iter(self.records), k),
+                    k
+            )
+
+
+    def test_sample_groups(self):
+        groups = ((key, iter(values)) for (key, values) in
+                  self.case.items())
+        self.check_sample(structs.reservoir_sample_groups(groups, 4), 4)
+        self.assertEqual(
+                structs.reservoir_sample_groups(self.case.items(), 7),
+                dict((key, values) for (key, values) in self.case.items()
+                     if values)
+        )
+
+
+    def test_sample_too_large(self):
+        self.assertRaises(ValueError, structs.reservoir_sample_records,
+                          self.records, 8)
+        self.assertRaises(ValueError, structs.reservoir_sample_groups,
+                          self.case.items(), -1)
+        self.assertEqual(structs.reservoir_sample_records([], 0), {})
+
+
+    def test_uniform(self):
+        records = [('key', i) for i in range(10)]
+        counts = Counter()
+        for i in range(5000):
+            sampled = structs.reservoir_sample_records(records, 3)
+            counts.update(sampled['key'])
+        self.assertEqual(sum(counts.values()), 15000)
+        for i in range(10):
+            # Each record is expected 1500 times; the standard
+            # deviation is about 32.
+            self.assertTrue(1350 < counts[i] < 1650, counts)
+
+
+    def test_long_stream(self):
+        records = (('key{0}'.format(i % 7), i) for i in range(200000))
+        sampled = structs.reservoir_sample_records(records, 50)
+        self.assertEqual(sum(len(v) for v in sampled.values()), 50)
+        for key, values in sampled.items():
+            self.assertEqual(values, sorted(values))
+            for value in values:
+                self.assertEqual('key{0}'.format(value % 7), key)
+
+
+@unittest.skipIf(
+        structs.numpy is None or
+        not hasattr(structs.numpy.random, 'default_rng'),
+        "NumPy 1.17 or newer is not installed"
+)
+class TestSampleListDictNumpy(unittest.TestCase):
+    """Tests for sample_list_dict_numpy()"""
+
+    def setUp(self):
+        self.case = {
+            'key1': [1, 5, 9],
+            'key2': [6, 42],
+            'key3': [7, 9001],
+            'key4': []
+        }
+
+
+    def check_sample(self, sampled, k):
+        self.assertEqual(sum(len(v) for v in sampled.values()), k)
+        for key, values in sampled.items():
+            self.assertEqual(len(set(values)), len(values))
+            self.assertTrue(set(values) <= set(self.case[key]))
+
+
+    def test_sample(self):
+        for k in range(8):
+            self.check_sample(
+                    structs.sample_list_dict_numpy(self.case, k), k)
+
+
+    def test_whole_population(self):
+        sampled = structs.sample_list_dict_numpy(self.case, 7, seed=1)
+        self.assertEqual(
+                dict((key, sorted(values)) for (key, values) in
+                     sampled.items()),
+                dict((key, values) for (key, values) in self.case.items()
+                     if values)
+        )
+
+
+    def test_seed_reproducible(self):
+        first = structs.sample_list_dict_numpy(self.case, 4, seed=42)
+        second = structs.sample_list_dict_numpy(
+                self.case, 4, seed=structs.numpy.random.default_rng(42))
+        self.assertEqual(first, second)
+
+
+    def test_large(self):
+        d = dict((i, list(range(i * 1000, i * 1000 + i))) for i in
+                 range(200))
+        sampled = structs.sample_list_dict_numpy(d, 10000, seed=0)
+        self.assertEqual(sum(len(v) for v in sampled.values()), 10000)
+        for key, values in sampled.items():
+            for value in values:
+                self.assertEqual(value // 1000, key)
+
+
+    def test_sample_too_large(self):
+        self.assertRaises(ValueError, structs.sample_list_dict_numpy,
+                          self.case, 8)
+        self.assertEqual(structs.sample_list_dict_numpy({}, 0), {})
 
 
 if __name__ == '__main__':